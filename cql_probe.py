@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Protocol level CQL readiness probe.
+
+Talks the native protocol directly (OPTIONS, then STARTUP) so checking a
+node doesn't need to spawn cqlsh inside the container. query_cql() goes one
+step further and runs a query with cassandra-driver, when it's installed.
+"""
+
+import time
+import socket
+import struct
+
+try:
+    from cassandra.cluster import Cluster
+    from cassandra.policies import WhiteListRoundRobinPolicy
+except ImportError:
+    Cluster = None
+
+from avocado import Test
+
+CQL_PORT = 9042
+PROTOCOL_VERSION = 4
+
+OPCODE_ERROR = 0x00
+OPCODE_STARTUP = 0x01
+OPCODE_READY = 0x02
+OPCODE_AUTHENTICATE = 0x03
+OPCODE_OPTIONS = 0x05
+OPCODE_SUPPORTED = 0x06
+
+HEADER = struct.Struct('>BBhBL')
+
+
+class CQLProbeError(Exception):
+    pass
+
+
+def _frame(opcode, body='', stream=0, version=PROTOCOL_VERSION):
+    return HEADER.pack(version, 0, stream, opcode, len(body)) + body
+
+
+def _string(value):
+    return struct.pack('>H', len(value)) + value
+
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise CQLProbeError('connection closed by server')
+        data += chunk
+    return data
+
+
+def _request(sock, opcode, body='', stream=0):
+    sock.sendall(_frame(opcode, body, stream))
+    _, _, _, resp_opcode, length = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    resp_body = _recv_exactly(sock, length)
+    if resp_opcode == OPCODE_ERROR:
+        code = struct.unpack('>L', resp_body[:4])[0]
+        msg_len = struct.unpack('>H', resp_body[4:6])[0]
+        raise CQLProbeError('error 0x{:04x}: {}'.format(code, resp_body[6:6 + msg_len]))
+    return resp_opcode
+
+
+def probe_cql(host, port=CQL_PORT, timeout=1.0):
+    """
+    Return True when host accepts a native protocol session: OPTIONS is
+    answered with SUPPORTED and STARTUP with READY (or AUTHENTICATE, when
+    authentication is enabled). Raise CQLProbeError otherwise.
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except socket.error as ex:
+        raise CQLProbeError('connect {}:{}: {}'.format(host, port, ex))
+    try:
+        if _request(sock, OPCODE_OPTIONS, stream=1) != OPCODE_SUPPORTED:
+            raise CQLProbeError('unexpected reply to OPTIONS')
+        startup = struct.pack('>H', 1) + _string('CQL_VERSION') + _string('3.0.0')
+        if _request(sock, OPCODE_STARTUP, startup, stream=2) not in (OPCODE_READY, OPCODE_AUTHENTICATE):
+            raise CQLProbeError('unexpected reply to STARTUP')
+        return True
+    except (socket.error, struct.error) as ex:
+        raise CQLProbeError('{}:{}: {}'.format(host, port, ex))
+    finally:
+        sock.close()
+
+
+def query_cql(host, port=CQL_PORT, timeout=1.0):
+    """
+    Return the release_version of host once a driver session can SELECT
+    from system.local. The cheap probe_cql() handshake goes first, so the
+    driver session is only built once the node answers STARTUP. Without
+    cassandra-driver only the handshake is checked and None is returned.
+    Raise CQLProbeError otherwise.
+    """
+    probe_cql(host, port, timeout)
+    if Cluster is None:
+        return None
+    cluster = Cluster([host], port=port, connect_timeout=timeout, control_connection_timeout=timeout,
+                      load_balancing_policy=WhiteListRoundRobinPolicy([host]))
+    try:
+        session = cluster.connect()
+        rows = session.execute('SELECT release_version FROM system.local', timeout=timeout).current_rows
+        if not rows:
+            raise CQLProbeError('{}:{}: system.local is empty'.format(host, port))
+        return rows[0].release_version
+    except CQLProbeError:
+        raise
+    except Exception as ex:  # the driver errors don't share a base class
+        raise CQLProbeError('{}:{}: {}: {}'.format(host, port, type(ex).__name__, ex))
+    finally:
+        cluster.shutdown()
+
+
+class Backoff(object):
+    """
+    Adaptive poll interval: grows by factor up to max_delay while nothing
+    changes, reset() drops it back to min_delay once something happened.
+    """
+
+    def __init__(self, min_delay=0.1, max_delay=2.0, factor=1.5):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.delay = min_delay
+
+    def reset(self):
+        self.delay = self.min_delay
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.max_delay, self.delay * self.factor)
+        return delay
+
+    def sleep(self):
+        time.sleep(self.next())
+
+
+class CQLProbeEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
@@ -0,0 +1,591 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Minimal Docker Engine API client talking HTTP over the daemon unix socket.
+
+The client keeps one keep-alive connection for the request/response calls,
+so polling loops don't pay a `docker` CLI fork per call. FakeDockerDaemon
+serves the same subset of the API on a local unix socket, it's used to
+exercise the client (and the CLI, via DOCKER_HOST) without a real daemon.
+"""
+
+import os
+import re
+import json
+import time
+import Queue
+import select
+import socket
+import struct
+import urllib
+import httplib
+import logging
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+API_VERSION = 'v1.24'
+# requests that can be sent again when the response is lost
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+log = logging.getLogger('docker_api')
+
+
+class DockerAPIError(Exception):
+
+    def __init__(self, status, message):
+        super(DockerAPIError, self).__init__('{}: {}'.format(status, message))
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerAPIClient(object):
+    """
+    Subset of the Engine API used by ScyllaDocker.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=60):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def _url(path, params=None):
+        url = '/{}{}'.format(API_VERSION, path)
+        if params:
+            url += '?' + urllib.urlencode(params)
+        return url
+
+    @staticmethod
+    def _check(status, body):
+        if status >= 400:
+            try:
+                message = json.loads(body).get('message', body)
+            except ValueError:
+                message = body
+            raise DockerAPIError(status, message.strip())
+
+    def request(self, method, path, params=None, body=None, timeout=None):
+        """
+        Send a request over the persistent connection, reconnect once if the
+        daemon closed it in the meantime. Only idempotent requests are sent
+        again once they may have reached the daemon, a POST is retried only
+        when it couldn't be sent at all.
+        """
+        headers = {'Content-Type': 'application/json'}
+        data = json.dumps(body) if body is not None else None
+        with self._lock:
+            for attempt in (1, 2):
+                idle = self._conn.sock if self._conn is not None else None
+                if idle is not None and select.select([idle], [], [], 0)[0]:
+                    # an idle keep-alive connection is readable once the daemon closed it
+                    self.close()
+                if self._conn is None:
+                    self._conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+                sent = False
+                try:
+                    self._conn.timeout = timeout or self.timeout
+                    if self._conn.sock is not None:
+                        self._conn.sock.settimeout(self._conn.timeout)
+                    self._conn.request(method, self._url(path, params), data, headers)
+                    sent = True
+                    resp = self._conn.getresponse()
+                    content = resp.read()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    self.close()
+                    if attempt == 2 or (sent and method not in IDEMPOTENT_METHODS):
+                        raise
+            if resp.will_close:
+                self.close()
+        self._check(resp.status, content)
+        if content and resp.getheader('Content-Type', '').startswith('application/json'):
+            return json.loads(content)
+        return content
+
+    def ping(self):
+        return self.request('GET', '/_ping') == 'OK'
+
+    def inspect_container(self, name):
+        return self.request('GET', '/containers/{}/json'.format(name))
+
+    def list_containers(self, names=None):
+        params = {'all': 1}
+        if names:
+            params['filters'] = json.dumps({'name': names})
+        return self.request('GET', '/containers/json', params=params)
+
+    def events(self):
+        params = {'filters': json.dumps({'type': ['container']})}
+        return DockerEventStream(self.socket_path, self._url('/events', params))
+
+    def create_container(self, name, image, cmd=None, entrypoint=None, host_config=None):
+        body = {'Image': image}
+        if cmd:
+            body['Cmd'] = cmd
+        if entrypoint:
+            body['Entrypoint'] = entrypoint
+        if host_config:
+            body['HostConfig'] = host_config
+        return self.request('POST', '/containers/create', params={'name': name}, body=body)
+
+    def start_container(self, name):
+        self.request('POST', '/containers/{}/start'.format(name))
+
+    def stop_container(self, name, timeout=10):
+        self.request('POST', '/containers/{}/stop'.format(name), params={'t': timeout}, timeout=timeout + 30)
+
+    def restart_container(self, name, timeout=10):
+        self.request('POST', '/containers/{}/restart'.format(name), params={'t': timeout}, timeout=timeout + 30)
+
+    def remove_container(self, name):
+        self.request('DELETE', '/containers/{}'.format(name))
+
+    def create_network(self, name):
+        return self.request('POST', '/networks/create', body={'Name': name, 'CheckDuplicate': True})
+
+    def remove_network(self, name):
+        self.request('DELETE', '/networks/{}'.format(name))
+
+    def list_images(self, dangling=False):
+        params = {'filters': json.dumps({'dangling': ['true']})} if dangling else None
+        return self.request('GET', '/images/json', params=params)
+
+    def inspect_image(self, image):
+        return self.request('GET', '/images/{}/json'.format(image))
+
+    def remove_image(self, image):
+        self.request('DELETE', '/images/{}'.format(image))
+
+    def pull_image(self, image, timeout=600):
+        name, tag = image, 'latest'
+        if ':' in image.rsplit('/', 1)[-1]:
+            name, tag = image.rsplit(':', 1)
+        out = self.request('POST', '/images/create', params={'fromImage': name, 'tag': tag}, timeout=timeout)
+        # progress is streamed as concatenated json messages, a failure is
+        # reported in-band with an 'error' key
+        for line in out.splitlines():
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' in msg:
+                raise DockerAPIError(500, msg['error'])
+        return out
+
+    def _exec_frames(self, name, cmd, timeout):
+        """
+        Yield (exec_id, stream_type, data) frames of cmd as they arrive.
+
+        The exec output is a hijacked raw stream that the daemon closes at
+        the end, so it's read on its own connection to keep the persistent
+        one alive.
+        """
+        exec_id = self.request('POST', '/containers/{}/exec'.format(name),
+                               body={'Cmd': cmd, 'AttachStdout': True, 'AttachStderr': True})['Id']
+        deadline = time.time() + timeout
+        conn = UnixHTTPConnection(self.socket_path, timeout=timeout)
+        try:
+            conn.request('POST', self._url('/exec/{}/start'.format(exec_id)),
+                         json.dumps({'Detach': False, 'Tty': False}), {'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            if resp.status >= 400:
+                self._check(resp.status, resp.read())
+            while True:
+                header = resp.read(8)
+                if len(header) < 8:
+                    break
+                stream_type, size = struct.unpack('>BxxxL', header)
+                yield exec_id, stream_type, resp.read(size)
+                if time.time() > deadline:
+                    raise DockerAPIError(408, 'exec {} timed out after {}s'.format(cmd, timeout))
+        except socket.timeout:
+            raise DockerAPIError(408, 'exec {} timed out after {}s'.format(cmd, timeout))
+        finally:
+            conn.close()
+        yield exec_id, None, None
+
+    def _exec_exit_code(self, exec_id):
+        return self.request('GET', '/exec/{}/json'.format(exec_id))['ExitCode']
+
+    def exec_run(self, name, cmd, timeout=10):
+        """
+        Run cmd in container, return (exit_code, stdout, stderr).
+        """
+        out = {1: [], 2: []}
+        for exec_id, stream_type, data in self._exec_frames(name, cmd, timeout):
+            if stream_type is not None:
+                out.setdefault(stream_type, []).append(data)
+        return self._exec_exit_code(exec_id), ''.join(out[1]), ''.join(out[2])
+
+    def exec_stream(self, name, cmd, timeout=60):
+        """
+        Run cmd in container, yield (stream_type, data) while it runs. Raise
+        DockerAPIError when it exits with a non-zero status.
+        """
+        for exec_id, stream_type, data in self._exec_frames(name, cmd, timeout):
+            if stream_type is not None:
+                yield stream_type, data
+        exit_code = self._exec_exit_code(exec_id)
+        if exit_code:
+            raise DockerAPIError(500, 'exec {} exited with status {}'.format(cmd, exit_code))
+
+
+class DockerEventStream(object):
+    """
+    Iterate the /events stream as dicts, close() unblocks the reader.
+    """
+
+    def __init__(self, socket_path, url):
+        self._conn = UnixHTTPConnection(socket_path)
+        self._conn.request('GET', url)
+        self._resp = self._conn.getresponse()
+        DockerAPIClient._check(self._resp.status, '' if self._resp.status < 400 else self._resp.read())
+
+    def _chunks(self):
+        fp = self._resp.fp
+        if not self._resp.chunked:
+            for line in iter(fp.readline, ''):
+                yield line
+            return
+        while True:
+            size = int(fp.readline().split(';')[0].strip() or '0', 16)
+            if size == 0:
+                return
+            yield fp.read(size)
+            fp.read(2)
+
+    def __iter__(self):
+        buf = ''
+        try:
+            for chunk in self._chunks():
+                buf += chunk
+                while '\n' in buf:
+                    line, buf = buf.split('\n', 1)
+                    if line.strip():
+                        yield json.loads(line)
+        except (socket.error, ValueError, AttributeError):
+            # closed under our feet
+            return
+
+    def close(self):
+        try:
+            self._conn.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, AttributeError):
+            pass
+        self._conn.close()
+
+
+def mux_stream(stdout='', stderr=''):
+    frames = ''
+    for stream_type, data in ((1, stdout), (2, stderr)):
+        if data:
+            frames += struct.pack('>BxxxL', stream_type, len(data)) + data
+    return frames
+
+
+class _ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients dropping keep-alive or event stream connections
+        log.debug('fake docker: connection closed by client')
+
+
+class _FakeDockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', r'/_ping$', 'ping'),
+        ('HEAD', r'/_ping$', 'ping'),
+        ('GET', r'/version$', 'version'),
+        ('GET', r'/events$', 'events'),
+        ('GET', r'/containers/json$', 'list'),
+        ('POST', r'/containers/create$', 'create'),
+        ('GET', r'/containers/([^/]+)/json$', 'inspect'),
+        ('POST', r'/containers/([^/]+)/(start|stop|restart)$', 'lifecycle'),
+        ('DELETE', r'/containers/([^/]+)$', 'remove'),
+        ('POST', r'/containers/([^/]+)/exec$', 'exec_create'),
+        ('POST', r'/exec/([^/]+)/start$', 'exec_start'),
+        ('GET', r'/exec/([^/]+)/json$', 'exec_inspect'),
+        ('GET', r'/images/json$', 'images'),
+        ('GET', r'/images/(.+)/json$', 'inspect_image'),
+        ('POST', r'/images/create$', 'pull'),
+        ('DELETE', r'/images/(.+)$', 'rmi'),
+        ('POST', r'/networks/create$', 'network_create'),
+        ('DELETE', r'/networks/([^/]+)$', 'network_remove'),
+    ]
+
+    def address_string(self):
+        return self.server.server_address
+
+    def log_message(self, fmt, *args):
+        log.debug('fake docker: ' + fmt, *args)
+
+    def _reply(self, status, body=None, content_type='application/json', close=False):
+        data = json.dumps(body) if content_type == 'application/json' and body is not None else (body or '')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        else:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _error(self, status, message):
+        self._reply(status, {'message': message})
+
+    def _dispatch(self):
+        path, _, query = self.path.partition('?')
+        path = re.sub(r'^/v[\d.]+', '', path)
+        self.query = dict((k, v[-1]) for k, v in urlparse.parse_qs(query).items())
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.body = json.loads(self.rfile.read(length)) if length else {}
+        for method, pattern, handler in self.routes:
+            match = re.match(pattern, path)
+            if method == self.command and match:
+                with self.server.daemon.lock:
+                    self.server.daemon.calls += 1
+                if handler == 'events':
+                    # streams until the client goes away, don't hold the lock
+                    return self.do_events()
+                with self.server.daemon.lock:
+                    return getattr(self, 'do_' + handler)(*match.groups())
+        self._error(404, 'page not found')
+
+    do_GET = do_POST = do_DELETE = do_HEAD = _dispatch
+
+    def _container(self, name):
+        container = self.server.daemon.containers.get(name)
+        if container is None:
+            self._error(404, 'No such container: {}'.format(name))
+        return container
+
+    def do_ping(self):
+        self._reply(200, 'OK', content_type='text/plain')
+
+    def do_version(self):
+        self._reply(200, {'Version': '1.12.0-fake', 'ApiVersion': '1.24', 'MinAPIVersion': '1.12',
+                          'Os': 'linux', 'Arch': 'amd64', 'KernelVersion': '', 'GoVersion': ''})
+
+    def do_events(self):
+        events = self.server.daemon.subscribe()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.close_connection = 1
+        try:
+            while not self.server.daemon.stopped.is_set():
+                try:
+                    data = json.dumps(events.get(timeout=0.2)) + '\n'
+                except Queue.Empty:
+                    continue
+                self.wfile.write('{:x}\r\n{}\r\n'.format(len(data), data))
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            self.server.daemon.unsubscribe(events)
+
+    def do_list(self):
+        names = json.loads(self.query.get('filters', '{}')).get('name', [])
+        containers = []
+        for name, container in sorted(self.server.daemon.containers.items()):
+            if names and not any(n in name for n in names):
+                continue
+            running = container['State']['Running']
+            network = container['HostConfig'].get('NetworkMode', 'bridge')
+            containers.append({'Id': name, 'Names': ['/' + name], 'Image': container['Image'],
+                               'State': 'running' if running else 'exited',
+                               'Status': 'Up' if running else 'Exited (0)',
+                               'NetworkSettings': {'Networks': {network: container['NetworkSettings']}}})
+        self._reply(200, containers)
+
+    def do_create(self):
+        daemon = self.server.daemon
+        name = self.query.get('name')
+        if name in daemon.containers:
+            return self._error(409, 'Conflict. The name "/{}" is already in use'.format(name))
+        daemon.containers[name] = {'Id': name, 'Name': '/' + name, 'Image': self.body.get('Image'),
+                                   'Args': self.body.get('Cmd') or [],
+                                   'HostConfig': self.body.get('HostConfig') or {},
+                                   'State': {'Running': False, 'Status': 'created'},
+                                   'NetworkSettings': {'IPAddress': ''}}
+        daemon.publish(name, 'create')
+        self._reply(201, {'Id': name, 'Warnings': None})
+
+    def do_inspect(self, name):
+        container = self._container(name)
+        if container is not None:
+            self._reply(200, container)
+
+    def do_lifecycle(self, name, action):
+        container = self._container(name)
+        if container is None:
+            return
+        running = action != 'stop'
+        container['State'] = {'Running': running, 'Status': 'running' if running else 'exited'}
+        if running and not container['NetworkSettings']['IPAddress']:
+            self.server.daemon.last_ip += 1
+            container['NetworkSettings']['IPAddress'] = '172.17.0.{}'.format(self.server.daemon.last_ip)
+        self.server.daemon.publish(name, 'die' if action == 'stop' else action)
+        self._reply(204)
+
+    def do_network_create(self):
+        name = self.body.get('Name')
+        if name in self.server.daemon.networks:
+            return self._error(409, 'network with name {} already exists'.format(name))
+        self.server.daemon.networks.add(name)
+        self._reply(201, {'Id': name, 'Warning': ''})
+
+    def do_network_remove(self, name):
+        if name not in self.server.daemon.networks:
+            return self._error(404, 'network {} not found'.format(name))
+        self.server.daemon.networks.remove(name)
+        self._reply(204)
+
+    def do_remove(self, name):
+        if self._container(name) is not None:
+            del self.server.daemon.containers[name]
+            self.server.daemon.publish(name, 'destroy')
+            self._reply(204)
+
+    def do_exec_create(self, name):
+        if self._container(name) is not None:
+            daemon = self.server.daemon
+            exec_id = 'exec{}'.format(len(daemon.execs) + 1)
+            daemon.execs[exec_id] = {'container': name, 'cmd': self.body.get('Cmd'), 'ExitCode': None}
+            self._reply(201, {'Id': exec_id})
+
+    def do_exec_start(self, exec_id):
+        daemon = self.server.daemon
+        exec_info = daemon.execs[exec_id]
+        exit_code, stdout, stderr = daemon.exec_handler(exec_info['container'], exec_info['cmd'])
+        exec_info['ExitCode'] = exit_code
+        self._reply(200, mux_stream(stdout, stderr), content_type='application/vnd.docker.raw-stream', close=True)
+
+    def do_exec_inspect(self, exec_id):
+        self._reply(200, {'ID': exec_id, 'Running': False, 'ExitCode': self.server.daemon.execs[exec_id]['ExitCode']})
+
+    def do_images(self):
+        self._reply(200, [{'Id': image_id} for image_id in self.server.daemon.dangling_images])
+
+    def do_inspect_image(self, image):
+        if image not in self.server.daemon.images:
+            return self._error(404, 'No such image: {}'.format(image))
+        self._reply(200, self.server.daemon.images[image])
+
+    def do_pull(self):
+        daemon = self.server.daemon
+        image = '{}:{}'.format(self.query['fromImage'], self.query.get('tag', 'latest'))
+        daemon.pulls += 1
+        digest = daemon.registry_digests.get(image)
+        if digest:
+            daemon.images[image] = {'Id': image, 'RepoDigests': ['{}@{}'.format(self.query['fromImage'], digest)]}
+        self._reply(200, '{"status":"Status: Downloaded newer image"}\r\n', content_type='application/json')
+
+    def do_rmi(self, image):
+        if image not in self.server.daemon.dangling_images:
+            return self._error(404, 'No such image: {}'.format(image))
+        self.server.daemon.dangling_images.remove(image)
+        self._reply(200, [{'Deleted': image}])
+
+
+class FakeDockerDaemon(object):
+    """
+    In-process stand-in for dockerd, serving a subset of the Engine API on a
+    unix socket. Exec output comes from exec_handler(container, cmd), which
+    returns (exit_code, stdout, stderr).
+    """
+
+    def __init__(self, socket_path, exec_handler=None):
+        self.socket_path = socket_path
+        self.exec_handler = exec_handler or (lambda container, cmd: (0, '', ''))
+        self.containers = dict()
+        self.networks = set()
+        self.execs = dict()
+        self.dangling_images = list()
+        # images pulled so far, and what the registry would serve for a tag
+        self.images = dict()
+        self.registry_digests = dict()
+        self.pulls = 0
+        self.last_ip = 1
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self._subscribers = list()
+        self._server = None
+        self._thread = None
+
+    def subscribe(self):
+        events = Queue.Queue()
+        self._subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        self._subscribers.remove(events)
+
+    def publish(self, name, action):
+        """
+        Emit a container event, e.g. to simulate a crash: publish('node2', 'die')
+        """
+        event = {'Type': 'container', 'Action': action, 'status': action, 'id': name,
+                 'Actor': {'ID': name, 'Attributes': {'name': name}}, 'time': int(time.time())}
+        for events in list(self._subscribers):
+            events.put(event)
+
+    def start(self):
+        self.stopped.clear()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = _ThreadingUnixServer(self.socket_path, _FakeDockerHandler)
+        self._server.daemon = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+        os.unlink(self.socket_path)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Compare per-call latency of the ScyllaDocker CLI and Engine API backends.
+
+By default both backends talk to a FakeDockerDaemon, so this runs without
+dockerd (the CLI path still needs the docker client binary). Pass --socket
+and --node to measure against a real daemon and an existing container.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from avocado.utils import path
+
+from docker_api import DockerAPIClient, FakeDockerDaemon
+from scylla_docker import ScyllaDocker, ScyllaDockerAPI
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def measure(func, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.time()
+        func()
+        latencies.append((time.time() - start) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    print('{:<8} calls={:<6} mean={:8.3f}ms p50={:8.3f}ms p99={:8.3f}ms max={:8.3f}ms'.format(
+        name, len(latencies), sum(latencies) / len(latencies), percentile(latencies, 50),
+        percentile(latencies, 99), max(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--socket', help='docker daemon socket, a fake daemon is started if omitted')
+    parser.add_argument('--node', default='node1', help='container to inspect')
+    args = parser.parse_args()
+
+    fake = None
+    socket_path = args.socket
+    if socket_path is None:
+        socket_path = os.path.join(tempfile.mkdtemp(prefix='fake-docker'), 'docker.sock')
+        fake = FakeDockerDaemon(socket_path).start()
+        client = DockerAPIClient(socket_path)
+        client.create_container(args.node, 'scylladb/scylla-nightly')
+        client.start_container(args.node)
+    os.environ['DOCKER_HOST'] = 'unix://{}'.format(socket_path)
+
+    try:
+        api = ScyllaDockerAPI(docker_socket=socket_path)
+        report('api', measure(lambda: api.get_node_ip(args.node), args.calls))
+        try:
+            path.find_command('docker')
+        except path.CmdNotFoundError:
+            print('docker client not found, skipping the cli backend')
+        else:
+            cli = ScyllaDocker()
+            report('cli', measure(lambda: cli.get_node_ip(args.node), args.calls))
+    finally:
+        if fake is not None:
+            fake.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Look up the manifest digest of an image tag in its registry, without
+pulling it. FakeRegistry is a local stand-in serving manifest digests.
+"""
+
+import re
+import json
+import urllib
+import urllib2
+import logging
+import threading
+import BaseHTTPServer
+
+DOCKER_HUB = 'registry-1.docker.io'
+MANIFEST_TYPES = ', '.join(['application/vnd.docker.distribution.manifest.list.v2+json',
+                            'application/vnd.docker.distribution.manifest.v2+json',
+                            'application/vnd.oci.image.index.v1+json',
+                            'application/vnd.oci.image.manifest.v1+json'])
+
+log = logging.getLogger('docker_registry')
+
+
+class RegistryError(Exception):
+    pass
+
+
+def parse_image_ref(image):
+    """
+    Split an image reference into (registry, repository, tag).
+
+    >>> parse_image_ref('scylladb/scylla-nightly')
+    ('registry-1.docker.io', 'scylladb/scylla-nightly', 'latest')
+    >>> parse_image_ref('localhost:5000/scylla:3.0')
+    ('localhost:5000', 'scylla', '3.0')
+    """
+    registry = DOCKER_HUB
+    parts = image.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        registry, image = parts
+    repository, tag = image, 'latest'
+    if ':' in image:
+        repository, tag = image.rsplit(':', 1)
+    if registry == DOCKER_HUB and '/' not in repository:
+        repository = 'library/' + repository
+    return registry, repository, tag
+
+
+class _NoRedirect(urllib2.HTTPErrorProcessor):
+
+    def http_response(self, request, response):
+        return response
+
+    https_response = http_response
+
+
+def _head(url, headers):
+    request = urllib2.Request(url, headers=headers)
+    request.get_method = lambda: 'HEAD'
+    return urllib2.build_opener(_NoRedirect).open(request, timeout=30)
+
+
+def _bearer_token(challenge):
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop('realm')
+    resp = urllib2.urlopen('{}?{}'.format(realm, urllib.urlencode(params)), timeout=30)
+    body = json.load(resp)
+    return body.get('token') or body.get('access_token')
+
+
+def registry_digest(image, scheme=None):
+    """
+    Return the digest the registry currently serves for the image tag, as
+    in the RepoDigests of a pulled image ('sha256:...').
+    """
+    registry, repository, tag = parse_image_ref(image)
+    if scheme is None:
+        scheme = 'http' if registry.split(':')[0] in ('localhost', '127.0.0.1') else 'https'
+    url = '{}://{}/v2/{}/manifests/{}'.format(scheme, registry, repository, tag)
+    headers = {'Accept': MANIFEST_TYPES}
+    resp = _head(url, headers)
+    if resp.code == 401:
+        challenge = resp.info().getheader('WWW-Authenticate', '')
+        if not challenge.startswith('Bearer'):
+            raise RegistryError('unsupported registry auth: {}'.format(challenge))
+        headers['Authorization'] = 'Bearer {}'.format(_bearer_token(challenge))
+        resp = _head(url, headers)
+    if resp.code != 200:
+        raise RegistryError('{}: HTTP {}'.format(url, resp.code))
+    digest = resp.info().getheader('Docker-Content-Digest')
+    if not digest:
+        raise RegistryError('{}: no Docker-Content-Digest header'.format(url))
+    return digest
+
+
+class _FakeRegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, fmt, *args):
+        log.debug('fake registry: ' + fmt, *args)
+
+    def do_HEAD(self):
+        match = re.match(r'/v2/(.+)/manifests/([^/]+)$', self.path)
+        digest = self.server.registry.manifests.get(match.groups()) if match else None
+        self.server.registry.requests += 1
+        self.send_response(200 if digest else 404)
+        if digest:
+            self.send_header('Docker-Content-Digest', digest)
+            self.send_header('Content-Type', 'application/vnd.docker.distribution.manifest.list.v2+json')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_HEAD
+
+
+class FakeRegistry(object):
+    """
+    Local registry stand-in answering manifest digest lookups over http.
+
+    Use set_digest('scylla', 'latest', 'sha256:...') and refer to images as
+    'localhost:<port>/scylla:latest'.
+    """
+
+    def __init__(self, port=0):
+        self.manifests = dict()
+        self.requests = 0
+        self._server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _FakeRegistryHandler)
+        self._server.registry = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return 'localhost:{}'.format(self._server.server_address[1])
+
+    def set_digest(self, repository, tag, digest):
+        self.manifests[(repository, tag)] = digest
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
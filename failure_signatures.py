@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Failure signatures matched against output streams as they're produced.
+
+Signatures are declared in scylla-artifacts.py.data/failure_signatures.yaml
+(the data dir Avocado copies to the VM with the test). The ones of a category
+are compiled into one alternation, so every line is searched once however
+many signatures there are. run() is process.run() with a scanner attached,
+a fatal match kills the command right away.
+"""
+
+import os
+import re
+import time
+import shlex
+import signal
+import logging
+import threading
+import subprocess
+import collections
+
+import yaml
+
+from avocado import Test
+from avocado.utils import process
+
+DEFAULT_SIGNATURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scylla-artifacts.py.data',
+                                  'failure_signatures.yaml')
+SEVERITIES = ('info', 'warning', 'error', 'fatal')
+
+log = logging.getLogger('failure_signatures')
+
+Signature = collections.namedtuple('Signature', ['name', 'pattern', 'severity', 'category'])
+SignatureMatch = collections.namedtuple('SignatureMatch', ['name', 'severity', 'category', 'text', 'line',
+                                                           'lineno', 'source'])
+
+
+class FatalSignatureError(Exception):
+
+    def __init__(self, report):
+        fatal = report['fatal']
+        super(FatalSignatureError, self).__init__('{}: {} ({}), line {}: {}'.format(
+            report['source'], fatal['name'], fatal['category'], fatal['lineno'], fatal['line'].strip()))
+        self.report = report
+
+
+class FailureSignatures(object):
+
+    def __init__(self, signatures):
+        self.signatures = list(signatures)
+        for signature in self.signatures:
+            if signature.severity not in SEVERITIES:
+                raise ValueError('{}: unknown severity {}'.format(signature.name, signature.severity))
+        self._compiled = dict()
+
+    @classmethod
+    def load(cls, path=None):
+        with open(path or DEFAULT_SIGNATURES) as signatures_file:
+            entries = yaml.safe_load(signatures_file) or []
+        return cls(Signature(entry['name'], entry['pattern'], entry.get('severity', 'error'),
+                             entry.get('category', 'any')) for entry in entries)
+
+    def compiled(self, categories):
+        """
+        One regex for all the signatures of categories (plus 'any'), each
+        signature in a group named after its index.
+        """
+        key = tuple(sorted(categories))
+        if key not in self._compiled:
+            selected = [(idx, sig) for idx, sig in enumerate(self.signatures)
+                        if sig.category == 'any' or sig.category in categories]
+            pattern = '|'.join('(?P<s{}>{})'.format(idx, sig.pattern) for idx, sig in selected)
+            self._compiled[key] = re.compile(pattern) if selected else None
+        return self._compiled[key]
+
+    def scanner(self, source, categories, on_match=None):
+        if isinstance(categories, basestring):
+            categories = [categories]
+        return SignatureScanner(self, source, categories, on_match=on_match)
+
+
+_default = None
+
+
+def default_signatures(path=None):
+    """
+    The signatures of path, else of DEFAULT_SIGNATURES, loaded once by the
+    first call. Without either file nothing is matched.
+    """
+    global _default
+    if _default is None:
+        paths = [candidate for candidate in (path, DEFAULT_SIGNATURES) if candidate]
+        found = [candidate for candidate in paths if os.path.exists(candidate)]
+        if found:
+            _default = FailureSignatures.load(found[0])
+        else:
+            log.warning('No failure signatures in %s, output is not scanned', ' or '.join(paths))
+            _default = FailureSignatures([])
+    return _default
+
+
+class SignatureScanner(object):
+    """
+    Matches lines fed one at a time (thread safe) and collects the matches.
+
+    :param on_match: optional callback, called with every SignatureMatch
+    """
+
+    def __init__(self, signatures, source, categories, on_match=None):
+        self.signatures = signatures
+        self.source = source
+        self.categories = categories
+        self.on_match = on_match
+        self.matches = []
+        self.fatal = None
+        self.fatal_event = threading.Event()
+        self.lines = 0
+        self._pattern = signatures.compiled(categories)
+        self._lock = threading.Lock()
+
+    def feed_line(self, line):
+        with self._lock:
+            self.lines += 1
+            lineno = self.lines
+        if self._pattern is None:
+            return
+        for found in self._pattern.finditer(line):
+            signature = self.signatures.signatures[int(found.lastgroup[1:])]
+            match = SignatureMatch(signature.name, signature.severity, signature.category, found.group(0),
+                                   line, lineno, self.source)
+            with self._lock:
+                self.matches.append(match)
+                if signature.severity == 'fatal' and self.fatal is None:
+                    self.fatal = match
+                    self.fatal_event.set()
+            if self.on_match is not None:
+                self.on_match(match)
+
+    def feed(self, output):
+        for line in output.splitlines():
+            self.feed_line(line)
+        return self
+
+    def found(self, name):
+        return [match for match in self.matches if match.name == name]
+
+    def check(self):
+        if self.fatal is not None:
+            raise FatalSignatureError(self.report())
+
+    def report(self):
+        return {'source': self.source,
+                'categories': self.categories,
+                'lines': self.lines,
+                'matches': [match._asdict() for match in self.matches],
+                'fatal': self.fatal._asdict() if self.fatal else None}
+
+
+def run(cmd, scanner, timeout=None, shell=False, sudo=False, ignore_status=False):
+    """
+    Like process.run(), feeding stdout and stderr to scanner line by line
+    while cmd runs. A fatal match kills cmd (its whole process group).
+
+    :raise FatalSignatureError: on a fatal match, with the scanner report
+    :raise process.CmdError: on a non zero exit status, unless ignore_status
+    """
+    if sudo and os.getuid() != 0:
+        cmd = 'sudo -n ' + cmd
+    log.info('Running (scanned) %s', cmd)
+    start = time.time()
+    proc = subprocess.Popen(cmd if shell else shlex.split(cmd), shell=shell, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, preexec_fn=os.setsid)
+    output = {'stdout': [], 'stderr': []}
+
+    def read(stream, name):
+        for line in iter(stream.readline, ''):
+            output[name].append(line)
+            scanner.feed_line(line.rstrip('\n'))
+    readers = [threading.Thread(target=read, args=(proc.stdout, 'stdout')),
+               threading.Thread(target=read, args=(proc.stderr, 'stderr'))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    timed_out = False
+    while proc.poll() is None:
+        if scanner.fatal is not None or (timeout and time.time() - start > timeout):
+            timed_out = scanner.fatal is None
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            break
+        scanner.fatal_event.wait(0.1)
+    for reader in readers:
+        reader.join()
+    result = process.CmdResult(cmd, ''.join(output['stdout']), ''.join(output['stderr']), proc.returncode,
+                               time.time() - start)
+    scanner.check()
+    if timed_out:
+        raise process.CmdError(cmd, result, 'Command timed out after {}s'.format(timeout))
+    if result.exit_status and not ignore_status:
+        raise process.CmdError(cmd, result)
+    return result
+
+
+class FailureSignaturesEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Golden libvirt snapshots: a domain with the distro prerequisites of the
+installer (extended repos, keys, java, system upgrade) already in place.
+
+A golden snapshot is valid while its fingerprint matches: a digest of the
+base snapshot it was built from, the source of the installer prerequisite
+methods of scylla-artifacts.py and the golden_version of the matrix. The
+fingerprint is kept in the snapshot description. Snapshots older than
+max_age are rebuilt as well, so the system upgrade doesn't get too old.
+"""
+
+import os
+import re
+import imp
+import json
+import time
+import hashlib
+import inspect
+import logging
+import subprocess
+from xml.sax.saxutils import unescape
+
+log = logging.getLogger('golden_snapshot')
+
+ARTIFACTS_TEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scylla-artifacts.py')
+# installer methods run by install_phase 'prereqs'
+PREREQ_METHODS = ('prereq_setup', 'prepare_extend_repo', 'install_java18', '_centos_remove_system_packages',
+                  'write_golden_marker', 'unconfigure_package_cache')
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+_prereq_digest = None
+
+
+def prereq_source_digest(path=ARTIFACTS_TEST):
+    """
+    sha256 of the source of the prerequisite methods of every installer.
+    """
+    global _prereq_digest
+    if _prereq_digest is None:
+        module = imp.load_source('scylla_artifacts_golden', path)
+        digest = hashlib.sha256()
+        for name, cls in sorted(inspect.getmembers(module, inspect.isclass)):
+            if not name.startswith('ScyllaInstall'):
+                continue
+            for method in PREREQ_METHODS:
+                if method in cls.__dict__:
+                    digest.update('{}.{}\n{}'.format(name, method, inspect.getsource(cls.__dict__[method])))
+            if 'JAVA_ARGS' in cls.__dict__:
+                digest.update('{}.JAVA_ARGS={!r}'.format(name, cls.JAVA_ARGS))
+        _prereq_digest = digest.hexdigest()
+    return _prereq_digest
+
+
+class GoldenSnapshot(object):
+
+    def __init__(self, domain, base=None, name=None, max_age=DEFAULT_MAX_AGE, version=None):
+        self.domain = domain
+        self.base = base or '{}-orig'.format(domain)
+        self.name = name or '{}-golden'.format(domain)
+        self.max_age = max_age
+        self.version = version
+
+    def _virsh(self, *args):
+        return subprocess.check_output(('sudo', 'virsh') + args)
+
+    def _snapshot_xml(self, snapshot):
+        try:
+            return self._virsh('snapshot-dumpxml', self.domain, snapshot)
+        except subprocess.CalledProcessError:
+            return None
+
+    def fingerprint(self):
+        base_xml = self._snapshot_xml(self.base)
+        if base_xml is None:
+            raise ValueError('{} has no base snapshot {}'.format(self.domain, self.base))
+        inputs = {'domain': self.domain,
+                  'base': hashlib.sha256(base_xml).hexdigest(),
+                  'prereqs': prereq_source_digest(),
+                  'version': self.version}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def current(self):
+        """
+        Description of the existing golden snapshot ({'fingerprint', 'created'}),
+        None when there's none.
+        """
+        xml = self._snapshot_xml(self.name)
+        if xml is None:
+            return None
+        match = re.search(r'<description>(.*)</description>', xml, re.S)
+        try:
+            return json.loads(unescape(match.group(1), {'&quot;': '"', '&apos;': "'"})) if match else {}
+        except ValueError:
+            return {}
+
+    def stale_reason(self, fingerprint):
+        """
+        Why the golden snapshot must be (re)built, None if it's up to date.
+        """
+        current = self.current()
+        if current is None:
+            return 'missing'
+        if current.get('fingerprint') != fingerprint:
+            return 'fingerprint changed'
+        if self.max_age and time.time() - current.get('created', 0) > self.max_age:
+            return 'older than {}s'.format(self.max_age)
+        return None
+
+    def shutdown(self, timeout=300):
+        self._virsh('shutdown', self.domain)
+        end = time.time() + timeout
+        while time.time() < end:
+            if 'shut off' in self._virsh('domstate', self.domain):
+                return
+            time.sleep(5)
+        log.warning('%s did not shut down in %ss, destroying it', self.domain, timeout)
+        self._virsh('destroy', self.domain)
+
+    def save(self, fingerprint):
+        """
+        Replace the golden snapshot with the current (shut off) state of the domain.
+        """
+        if self.current() is not None:
+            self._virsh('snapshot-delete', self.domain, self.name)
+        description = json.dumps({'fingerprint': fingerprint, 'created': time.time()})
+        self._virsh('snapshot-create-as', self.domain, self.name, '--description', description)
+        log.info('Saved golden snapshot %s of %s', self.name, self.domain)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Facts about the host the artifacts are tested on, collected once.
+
+Every fact is read from /proc and /sys where possible instead of running
+commands, all of them at once in a thread pool. host_facts() returns the
+same immutable HostFacts to the installers and the checks; facts the
+install changes (the scylla_setup options, SELinux) are collected again
+with refresh_host_facts(), which replaces the shared snapshot.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+from avocado import Test
+from avocado.utils import distro
+
+log = logging.getLogger('host_facts')
+
+SCYLLA_SETUP = '/usr/lib/scylla/scylla_setup'
+# ARPHRD_ETHER, what 'ip link' shows as link/ether
+_ETHER_TYPE = '1'
+
+
+def _read(path):
+    with open(path) as fact_file:
+        return fact_file.read().strip()
+
+
+def _distro():
+    detected = distro.detect()
+    return {'distro_name': detected.name, 'distro_version': detected.version,
+            'distro_release': detected.release, 'distro_arch': detected.arch}
+
+
+def _is_systemd():
+    return {'is_systemd': 'systemd' in _read('/proc/1/comm')}
+
+
+def _nics():
+    """
+    Ethernet interfaces, in ifindex order.
+    """
+    nics = []
+    for nic in os.listdir('/sys/class/net'):
+        path = os.path.join('/sys/class/net', nic)
+        if nic != 'lo' and _read(os.path.join(path, 'type')) == _ETHER_TYPE:
+            nics.append((int(_read(os.path.join(path, 'ifindex'))), nic))
+    return {'nics': tuple(nic for _, nic in sorted(nics))}
+
+
+def _disks():
+    """
+    Second disks (/dev/hdb, /dev/sdb, /dev/vdb), the RAID candidates.
+    """
+    return {'disks': tuple(sorted('/dev/' + disk for disk in os.listdir('/sys/block')
+                                  if re.match(r'^[hvs]db$', disk)))}
+
+
+def _scylla_setup_options():
+    """
+    Options scylla_setup knows about, None before scylla is installed.
+    """
+    if not os.path.exists(SCYLLA_SETUP):
+        return {'scylla_setup_options': None}
+    return {'scylla_setup_options': tuple(sorted(set(re.findall(r'--[a-z][\w-]*', _read(SCYLLA_SETUP)))))}
+
+
+def _selinux():
+    """
+    getenforce output: Enforcing, Permissive or Disabled.
+    """
+    enforce = '/sys/fs/selinux/enforce'
+    if not os.path.exists(enforce):
+        return {'selinux': 'Disabled'}
+    return {'selinux': 'Enforcing' if _read(enforce) == '1' else 'Permissive'}
+
+
+COLLECTORS = collections.OrderedDict([('distro', _distro), ('is_systemd', _is_systemd), ('nics', _nics),
+                                      ('disks', _disks), ('scylla_setup_options', _scylla_setup_options),
+                                      ('selinux', _selinux)])
+
+
+class HostFacts(collections.namedtuple('HostFacts', ['distro_name', 'distro_version', 'distro_release',
+                                                     'distro_arch', 'is_systemd', 'nics', 'disks',
+                                                     'scylla_setup_options', 'selinux', 'errors',
+                                                     'collect_time'])):
+    """
+    Snapshot of the host facts, errors maps the facts that could not be
+    collected to why.
+    """
+    __slots__ = ()
+
+    @property
+    def distro(self):
+        return distro.LinuxDistro(self.distro_name, self.distro_version, self.distro_release, self.distro_arch)
+
+    @property
+    def distro_key(self):
+        return '%s-%s.%s' % (self.distro_name.lower(), self.distro_version, self.distro_release)
+
+    def to_dict(self):
+        facts = self._asdict()
+        facts['errors'] = dict(self.errors)
+        return dict(facts)
+
+
+def collect(names=None, base=None):
+    """
+    Collect the facts names (all of them by default) concurrently, the
+    other ones are taken from the base snapshot.
+    """
+    names = list(names or COLLECTORS)
+    facts = dict.fromkeys(HostFacts._fields)
+    errors = dict()
+    if base is not None:
+        facts.update(base._asdict())
+        errors.update(base.errors)
+
+    def run(name):
+        try:
+            return name, COLLECTORS[name](), None
+        except Exception as details:  # a missing fact must not stop the others
+            return name, None, '%s: %s' % (type(details).__name__, details)
+
+    start = time.time()
+    pool = ThreadPool(processes=len(names))
+    try:
+        results = pool.map(run, names)
+    finally:
+        pool.close()
+        pool.join()
+    for name, values, error in results:
+        errors.pop(name, None)
+        if error is not None:
+            log.warning('Failed to collect host fact %s: %s', name, error)
+            errors[name] = error
+            continue
+        facts.update(values)
+    facts['errors'] = tuple(sorted(errors.items()))
+    facts['collect_time'] = round(time.time() - start, 3)
+    return HostFacts(**facts)
+
+
+_facts = None
+_lock = threading.Lock()
+
+
+def host_facts():
+    """
+    The facts of this host, collected on first use.
+    """
+    global _facts
+    with _lock:
+        if _facts is None:
+            _facts = collect()
+        return _facts
+
+
+def refresh_host_facts(*names):
+    """
+    Collect names again, for the facts the install changes, and share the
+    new snapshot.
+    """
+    global _facts
+    with _lock:
+        _facts = collect(names, base=_facts) if _facts is not None else collect()
+        return _facts
+
+
+class HostFactsEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Latency histogram with the bucketing of HdrHistogram.
+
+Values (integer microseconds) land in power of two buckets split in
+linear sub-buckets, so every value is kept within a relative error of
+10^-significant_figures. Counts are sparse, only the used indexes are
+stored, and histograms with the same precision merge by adding counts.
+
+Histograms are stored in the compressed V2 encoding of HdrHistogram, the
+one of the interval logs cassandra-stress writes with '-log hdrfile=';
+parse_hdr_log() reads those logs back, one merged histogram per tag.
+corrected() gives the coordinated omission corrected view of a closed loop
+run (see expected_interval()).
+"""
+
+import math
+import zlib
+import base64
+import struct
+import threading
+import collections
+
+from avocado import Test
+
+# cassandra-stress summary key -> quantile
+SUMMARY_QUANTILES = (('Latency median', 0.5), ('Latency 95th percentile', 0.95),
+                     ('Latency 99th percentile', 0.99), ('Latency 99.9th percentile', 0.999))
+
+# HdrHistogram V2 encoding, the low byte bits 4-7 (word size) are ignored
+_ENCODING_COOKIE = 0x1c849313
+_COMPRESSED_COOKIE = 0x1c849314
+_COOKIE_MASK = ~0xf0
+_ENCODING_HEADER = struct.Struct('>iiiiqqd')
+_COMPRESSED_HEADER = struct.Struct('>ii')
+# cassandra-stress records nanoseconds, these histograms microseconds
+NS_PER_US = 1000
+
+
+def _put_varint(out, value):
+    """
+    ZigZag LEB128 of a 64 bits integer, as in HdrHistogram: at most 9
+    bytes, the 9th one keeps 8 bits.
+    """
+    value = ((value << 1) ^ (value >> 63)) & 0xffffffffffffffff
+    for _ in range(8):
+        if value < 0x80:
+            out.append(value)
+            return
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data, pos):
+    value = 0
+    for shift in range(0, 56, 7):
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+    else:
+        value |= data[pos] << 56
+        pos += 1
+    return (value >> 1) ^ -(value & 1), pos
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, significant_figures=3):
+        self.significant_figures = significant_figures
+        sub_bucket_count_magnitude = int(math.ceil(math.log(2 * 10 ** significant_figures, 2)))
+        self._half_magnitude = sub_bucket_count_magnitude - 1
+        self._half_count = 1 << self._half_magnitude
+        self._sub_bucket_mask = (1 << sub_bucket_count_magnitude) - 1
+        self.counts = dict()
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def _index(self, value):
+        bucket = (value | self._sub_bucket_mask).bit_length() - self._half_magnitude - 1
+        sub_bucket = value >> bucket
+        return ((bucket + 1) << self._half_magnitude) + sub_bucket - self._half_count
+
+    def _bucket(self, index):
+        bucket = (index >> self._half_magnitude) - 1
+        sub_bucket = (index & (self._half_count - 1)) + self._half_count
+        if bucket < 0:
+            sub_bucket -= self._half_count
+            bucket = 0
+        return bucket, sub_bucket
+
+    def lowest_equivalent(self, index):
+        bucket, sub_bucket = self._bucket(index)
+        return sub_bucket << bucket
+
+    def highest_equivalent(self, index):
+        bucket, sub_bucket = self._bucket(index)
+        return (sub_bucket << bucket) + (1 << bucket) - 1
+
+    def median_equivalent(self, index):
+        bucket, sub_bucket = self._bucket(index)
+        return (sub_bucket << bucket) + (1 << bucket >> 1)
+
+    def record(self, value, count=1):
+        """
+        Record value (microseconds, rounded to an int) count times.
+        """
+        value = max(0, int(value))
+        index = self._index(value)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + count
+            self.total += count
+            self.sum += value * count
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if other.significant_figures != self.significant_figures:
+            raise ValueError('can not merge histograms of {} and {} significant figures'.format(
+                self.significant_figures, other.significant_figures))
+        with self._lock:
+            for index, count in other.counts.items():
+                self.counts[index] = self.counts.get(index, 0) + count
+            self.total += other.total
+            self.sum += other.sum
+            if other.total:
+                self.min = other.min if self.min is None else min(self.min, other.min)
+                self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def record_corrected(self, value, expected_interval, count=1):
+        """
+        Record value, plus the values the requests held back behind it
+        would have seen: value - expected_interval, value - 2 *
+        expected_interval... down to expected_interval (HdrHistogram's
+        recordValueWithExpectedInterval).
+        """
+        self.record(value, count)
+        if expected_interval <= 0:
+            return
+        missing = value - expected_interval
+        while missing >= expected_interval:
+            self.record(missing, count)
+            missing -= expected_interval
+
+    def corrected(self, expected_interval):
+        """
+        Coordinated omission corrected copy, see record_corrected().
+        """
+        histogram = type(self)(self.significant_figures)
+        for index, count in sorted(self.counts.items()):
+            histogram.record_corrected(min(self.highest_equivalent(index), self.max), expected_interval, count)
+        return histogram
+
+    def percentile(self, quantile):
+        """
+        Smallest recorded value (its bucket's highest equivalent) that
+        quantile of the values are less than or equal to.
+        """
+        if not self.total:
+            return 0
+        target = max(1, int(math.ceil(quantile * self.total)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self.highest_equivalent(index), self.max)
+        return self.max
+
+    def mean(self):
+        return float(self.sum) / self.total if self.total else 0.0
+
+    def summary(self):
+        """
+        The latency keys of a cassandra-stress summary, in milliseconds.
+        """
+        summary = {'Latency mean': round(self.mean() / 1000.0, 3), 'Latency max': round((self.max or 0) / 1000.0, 3)}
+        for key, quantile in SUMMARY_QUANTILES:
+            summary[key] = round(self.percentile(quantile) / 1000.0, 3)
+        return summary
+
+    def encode(self):
+        """
+        Base64 of the compressed V2 encoding, readable by the HdrHistogram
+        libraries (values in microseconds).
+        """
+        payload = bytearray()
+        last = max(self.counts) if self.counts else -1
+        zeros = 0
+        for index in range(last + 1):
+            count = self.counts.get(index, 0)
+            if not count:
+                zeros += 1
+                continue
+            if zeros:
+                _put_varint(payload, -zeros)
+                zeros = 0
+            _put_varint(payload, count)
+        highest = max(2, self.highest_equivalent(last) if last >= 0 else 2)
+        encoded = _ENCODING_HEADER.pack(_ENCODING_COOKIE, len(payload), 0, self.significant_figures, 1,
+                                        highest, 1.0) + bytes(payload)
+        compressed = zlib.compress(encoded)
+        return base64.b64encode(_COMPRESSED_HEADER.pack(_COMPRESSED_COOKIE, len(compressed)) + compressed)
+
+    @classmethod
+    def decode(cls, data, unit_ratio=1):
+        """
+        Histogram of a base64 compressed V2 encoding, values divided by
+        unit_ratio (NS_PER_US for the nanoseconds of cassandra-stress).
+        Values are re-recorded at the middle of their source bucket, so
+        min, max and sum are within the precision of the encoding.
+        """
+        raw = base64.b64decode(data)
+        cookie, length = _COMPRESSED_HEADER.unpack_from(raw)
+        if cookie & _COOKIE_MASK != _COMPRESSED_COOKIE & _COOKIE_MASK:
+            raise ValueError('not a compressed V2 HdrHistogram (cookie {:#x})'.format(cookie))
+        encoded = zlib.decompress(raw[_COMPRESSED_HEADER.size:_COMPRESSED_HEADER.size + length])
+        cookie, length, _, significant_figures, lowest, _, _ = _ENCODING_HEADER.unpack_from(encoded)
+        if cookie & _COOKIE_MASK != _ENCODING_COOKIE & _COOKIE_MASK:
+            raise ValueError('not a V2 HdrHistogram encoding (cookie {:#x})'.format(cookie))
+        source = cls(significant_figures)
+        unit_magnitude = int(math.floor(math.log(lowest, 2))) if lowest > 1 else 0
+        histogram = cls(significant_figures)
+        payload = bytearray(encoded[_ENCODING_HEADER.size:_ENCODING_HEADER.size + length])
+        pos = index = 0
+        while pos < len(payload):
+            count, pos = _get_varint(payload, pos)
+            if count < 0:
+                index -= count
+                continue
+            if count:
+                value = source.median_equivalent(index) << unit_magnitude
+                histogram.record(value // unit_ratio, count)
+            index += 1
+        return histogram
+
+    def to_dict(self):
+        return {'significant_figures': self.significant_figures, 'unit': 'us', 'total': self.total,
+                'sum': self.sum, 'min': self.min, 'max': self.max, 'hdr': self.encode()}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls.decode(data['hdr'])
+        if histogram.significant_figures != data['significant_figures']:
+            raise ValueError('{} significant figures encoded as {}'.format(
+                data['significant_figures'], histogram.significant_figures))
+        histogram.total = data['total']
+        histogram.sum = data['sum']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+
+def merge_histograms(histograms):
+    merged = LatencyHistogram()
+    for histogram in histograms:
+        merged.merge(histogram)
+    return merged
+
+
+def expected_interval(concurrency, ops, duration):
+    """
+    Microseconds between two requests of one of the `concurrency` closed
+    loop clients at the throughput the run had, the expected interval of
+    the coordinated omission correction.
+    """
+    if not ops or not duration:
+        return 0
+    return int(concurrency * duration * 1000000 / ops)
+
+
+class HdrLog(object):
+    """
+    Interval histograms of an HdrHistogram log, merged per tag.
+
+    cassandra-stress tags them <OP>-st (service time, from the request
+    start), <OP>-rt (response time, from the time it was scheduled at, only
+    recorded with a fixed rate) and <OP>-wt (the difference).
+    """
+
+    def __init__(self):
+        self.histograms = collections.OrderedDict()
+        self.intervals = 0
+        self.start = None
+        self.end = None
+
+    def feed_line(self, line):
+        line = line.strip()
+        if not line or line.startswith('#') or line.startswith('"'):
+            return
+        fields = line.split(',')
+        tag = ''
+        if fields[0].startswith('Tag='):
+            tag = fields.pop(0)[len('Tag='):]
+        start, length, encoded = float(fields[0]), float(fields[1]), fields[3]
+        histogram = LatencyHistogram.decode(encoded, NS_PER_US)
+        self.histograms.setdefault(tag, LatencyHistogram(histogram.significant_figures)).merge(histogram)
+        self.intervals += 1
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = start + length if self.end is None else max(self.end, start + length)
+
+    def merge(self, other):
+        for tag, histogram in other.histograms.items():
+            self.histograms.setdefault(tag, LatencyHistogram(histogram.significant_figures)).merge(histogram)
+        self.intervals += other.intervals
+        if other.start is not None:
+            self.start = other.start if self.start is None else min(self.start, other.start)
+            self.end = other.end if self.end is None else max(self.end, other.end)
+        return self
+
+    def kind(self, suffix):
+        """
+        Histograms of every operation with the given tag suffix ('st', 'rt'
+        or 'wt') merged, None when the log has none.
+        """
+        histograms = [histogram for tag, histogram in self.histograms.items()
+                      if tag.rpartition('-')[2] == suffix and histogram.total]
+        return merge_histograms(histograms) if histograms else None
+
+    def report(self, concurrency):
+        """
+        latency_report() of the service times, corrected with the response
+        times when the run had a fixed rate, else with the expected interval
+        of `concurrency` closed loop clients.
+        """
+        service = self.kind('st') or self.kind('')
+        if service is None:
+            return dict()
+        response = self.kind('rt')
+        if response is not None:
+            return latency_report(service, corrected=response, correction='response time')
+        duration = (self.end - self.start) if self.start is not None else 0
+        return latency_report(service, expected_interval(concurrency, service.total, duration))
+
+    def to_dict(self):
+        return {'intervals': self.intervals, 'start': self.start, 'end': self.end,
+                'histograms': dict((tag, histogram.to_dict()) for tag, histogram in self.histograms.items())}
+
+
+def parse_hdr_log(text):
+    hdr_log = HdrLog()
+    for line in text.splitlines():
+        hdr_log.feed_line(line)
+    return hdr_log
+
+
+def latency_report(histogram, interval=0, corrected=None, correction=None):
+    """
+    Latency summaries (ms) of histogram and of its coordinated omission
+    corrected view: corrected if given, else histogram corrected with
+    interval (microseconds).
+    """
+    if corrected is None:
+        corrected = histogram.corrected(interval) if interval else histogram
+        correction = 'expected interval {}us'.format(interval) if interval else 'none'
+    return {'count': histogram.total, 'latency': histogram.summary(),
+            'corrected': corrected.summary(), 'correction': correction}
+
+
+class LatencyHistogramEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
@@ -1,6 +1,8 @@
 
-# recover vm to original clean point
-sudo virsh snapshot-revert --domain $1 --snapshotname $1-orig
+# recover vm to original clean point, or to the snapshot given as $2
+# (a golden snapshot of libvirt_matrix.py --golden)
+SNAPSHOT=${2:-$1-orig}
+sudo virsh snapshot-revert --domain $1 --snapshotname $SNAPSHOT
 
 # make sure vm isn't running
 sudo virsh domstate $1|grep running && sudo virsh destroy $1
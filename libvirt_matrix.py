@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Run scylla-artifacts.py on several distros at once, one libvirt domain each.
+
+The domains of libvirt_matrix.yaml are reverted with libvirt-check.sh and
+tested with 'avocado run --vm-domain' concurrently, as long as the vCPUs
+and memory of the running domains fit in what the host has (minus
+reserved_cpus and reserved_memory). A domain larger than the whole budget
+runs alone. The avocado output of every distro is streamed prefixed with
+its name, matrix.json collects the per-distro timings and results.
+
+With --golden the domains are reverted to golden snapshots that already
+have the distro prerequisites (see golden_snapshot.py) and only the scylla
+install runs; stale or missing golden snapshots are built first.
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import socket
+import argparse
+import threading
+import traceback
+import subprocess
+import multiprocessing
+
+import yaml
+
+from cql_probe import Backoff
+from golden_snapshot import DEFAULT_MAX_AGE, GoldenSnapshot
+from resource_profile import parse_size
+from scylla_docker_orchestrator import memory_available
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MATRIX = os.path.join(HERE, 'libvirt_matrix.yaml')
+DEFAULT_YAML = os.path.join(HERE, 'scylla-artifacts.py.data', 'scylla-artifacts.yaml')
+# modules scylla-artifacts.py imports. Avocado only copies the test refs
+# (and their .data dirs) to the VM, so they're passed as refs as well, their
+# EmptyTest placeholders making them tests
+HELPER_MODULES = ('check_version.py', 'cql_probe.py', 'failure_signatures.py', 'host_facts.py',
+                  'latency_histogram.py', 'load_generator.py', 'package_cache.py', 'perf_history.py',
+                  'phase_timing.py', 'scylla_rest.py', 'setup_checkpoints.py', 'stress_results.py',
+                  'stress_thresholds.py')
+
+
+def domain_resources(domain):
+    """
+    (vCPUs, max memory in bytes) of a libvirt domain, from 'virsh dominfo'.
+    """
+    output = subprocess.check_output(['sudo', 'virsh', 'dominfo', domain])
+    cpus = int(re.search(r'^CPU\(s\):\s+(\d+)', output, re.M).group(1))
+    memory = int(re.search(r'^Max memory:\s+(\d+) KiB', output, re.M).group(1)) * 1024
+    return cpus, memory
+
+
+def wait_for_ssh(hostname, timeout=300, port=22):
+    backoff = Backoff(min_delay=1, max_delay=10)
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection((hostname, port), timeout=5).close()
+            return True
+        except socket.error:
+            backoff.sleep()
+    return False
+
+
+def job_results(job_dir):
+    """
+    Summary of the latest avocado job in job_dir, from its results.json.
+    """
+    results = sorted(glob.glob(os.path.join(job_dir, 'job-*', 'results.json')), key=os.path.getmtime)
+    if not results:
+        return None
+    with open(results[-1]) as results_file:
+        results = json.load(results_file)
+    return {'pass': results.get('pass'), 'errors': results.get('errors'), 'failures': results.get('failures'),
+            'skip': results.get('skip'), 'debuglog': results.get('debuglog'),
+            'tests': [{'test': test.get('test'), 'status': test.get('status'), 'time': test.get('time')}
+                      for test in results.get('tests', [])]}
+
+
+class MatrixJob(object):
+
+    def __init__(self, distro, entry, cpus, memory):
+        self.distro = distro
+        self.domain = entry['domain']
+        self.hostname = entry.get('hostname')
+        self.params = entry.get('params') or {}
+        self.cpus = cpus
+        self.memory = memory
+        self.result = None
+
+
+class MatrixScheduler(object):
+
+    def __init__(self, jobs, params, results_dir, cpu_budget, memory_budget, vm_username='root',
+                 vm_password='', test='scylla-artifacts.py', avocado='avocado', boot_timeout=300,
+                 revert_cmd=None, golden=None, helper_modules=HELPER_MODULES):
+        self.jobs = jobs
+        self.params = params
+        self.results_dir = results_dir
+        self.cpu_budget = cpu_budget
+        self.memory_budget = memory_budget
+        self.vm_username = vm_username
+        self.vm_password = vm_password
+        self.test = test
+        self.avocado = avocado
+        self.helper_modules = helper_modules
+        self.boot_timeout = boot_timeout
+        self.revert_cmd = revert_cmd or ['bash', os.path.join(HERE, 'libvirt-check.sh')]
+        # golden snapshot settings (max_age, version), None reverts to the base snapshots
+        self.golden = golden
+        self.cpus_used = 0
+        self.memory_used = 0
+        self.running = 0
+        self._cond = threading.Condition()
+        self._print_lock = threading.Lock()
+
+    def _fits(self, job):
+        if not self.running:
+            return True
+        return (self.cpus_used + job.cpus <= self.cpu_budget and
+                self.memory_used + job.memory <= self.memory_budget)
+
+    def _emit(self, job, line):
+        with self._print_lock:
+            sys.stdout.write('[{}] {}\n'.format(job.distro, line))
+            sys.stdout.flush()
+
+    def _stream(self, job, cmd, log_file):
+        """
+        Run cmd, streaming its output to the console and to log_file.
+        """
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in iter(proc.stdout.readline, ''):
+            log_file.write(line)
+            self._emit(job, line.rstrip('\n'))
+        return proc.wait()
+
+    def _revert(self, job, log_file, snapshot=None):
+        """
+        Revert and boot the domain, True when it's up.
+        """
+        if self._stream(job, self.revert_cmd + [job.domain] + ([snapshot] if snapshot else []), log_file):
+            return False
+        return wait_for_ssh(job.hostname, self.boot_timeout) if job.hostname else True
+
+    def _avocado(self, job, test, params, job_dir, log_file):
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        yaml_path = os.path.join(job_dir, 'params.yaml')
+        with open(yaml_path, 'w') as yaml_file:
+            yaml.safe_dump(params, yaml_file, default_flow_style=False)
+        test_dir = os.path.dirname(test.split(':')[0])
+        helpers = [os.path.join(test_dir, module) for module in self.helper_modules]
+        cmd = ([self.avocado, 'run', test] + helpers +
+               ['--mux-yaml', yaml_path, '--job-results-dir', job_dir,
+                '--vm-domain', job.domain, '--vm-username', self.vm_username])
+        if self.vm_password:
+            cmd += ['--vm-password', self.vm_password]
+        if job.hostname:
+            cmd += ['--vm-hostname', job.hostname]
+        return self._stream(job, cmd, log_file)
+
+    def _ensure_golden(self, job, params, job_dir, log_file):
+        """
+        Build the golden snapshot of job's domain unless it's up to date.
+        """
+        golden = GoldenSnapshot(job.domain, max_age=self.golden.get('max_age', DEFAULT_MAX_AGE),
+                                version=self.golden.get('version'))
+        fingerprint = golden.fingerprint()
+        reason = golden.stale_reason(fingerprint)
+        status = {'snapshot': golden.name, 'fingerprint': fingerprint, 'rebuilt': reason is not None,
+                  'reason': reason, 'ready': reason is None}
+        if reason is None:
+            return status
+        self._emit(job, 'building golden snapshot {}: {}'.format(golden.name, reason))
+        start = time.time()
+        if self._revert(job, log_file):
+            params = dict(params, install_phase='prereqs', golden_fingerprint=fingerprint)
+            status['exit_code'] = self._avocado(job, self.test + ':ScyllaArtifactSanity.test_after_install',
+                                                params, os.path.join(job_dir, 'golden'), log_file)
+            if status['exit_code'] == 0:
+                golden.shutdown()
+                golden.save(fingerprint)
+                status['ready'] = True
+        status['build_time'] = round(time.time() - start, 3)
+        return status
+
+    def run_job(self, job):
+        job_dir = os.path.join(self.results_dir, job.distro)
+        os.makedirs(job_dir)
+        params = dict(self.params)
+        params.update(job.params)
+        result = {'distro': job.distro, 'domain': job.domain, 'cpus': job.cpus, 'memory': job.memory}
+        start = time.time()
+        with open(os.path.join(job_dir, 'matrix.log'), 'w') as log_file:
+            snapshot = None
+            if self.golden is not None:
+                result['golden'] = self._ensure_golden(job, params, job_dir, log_file)
+                if result['golden']['ready']:
+                    snapshot = result['golden']['snapshot']
+                    params['install_phase'] = 'scylla'
+            revert_start = time.time()
+            booted = self._revert(job, log_file, snapshot)
+            result['revert_time'] = round(time.time() - revert_start, 3)
+            result['exit_code'] = None
+            if booted:
+                test_start = time.time()
+                result['exit_code'] = self._avocado(job, self.test, params, job_dir, log_file)
+                result['test_time'] = round(time.time() - test_start, 3)
+        result['duration'] = round(time.time() - start, 3)
+        result['results'] = job_results(job_dir)
+        job.result = result
+        self._emit(job, 'done: exit code {} in {}s'.format(result['exit_code'], result['duration']))
+        return result
+
+    def _worker(self, job):
+        start = time.time()
+        try:
+            self.run_job(job)
+        except Exception as details:  # the report must still cover this distro
+            job.result = {'distro': job.distro, 'domain': job.domain, 'cpus': job.cpus, 'memory': job.memory,
+                          'exit_code': None, 'error': '{}: {}'.format(type(details).__name__, details),
+                          'duration': round(time.time() - start, 3)}
+            for line in traceback.format_exc().splitlines():
+                self._emit(job, line)
+        finally:
+            with self._cond:
+                self.cpus_used -= job.cpus
+                self.memory_used -= job.memory
+                self.running -= 1
+                self._cond.notify_all()
+
+    def run(self):
+        pending = list(self.jobs)
+        workers = []
+        start = time.time()
+        with self._cond:
+            while pending:
+                job = next((pending_job for pending_job in pending if self._fits(pending_job)), None)
+                if job is None:
+                    self._cond.wait()
+                    continue
+                pending.remove(job)
+                self.cpus_used += job.cpus
+                self.memory_used += job.memory
+                self.running += 1
+                worker = threading.Thread(target=self._worker, args=(job,), name=job.distro)
+                worker.start()
+                workers.append(worker)
+        for worker in workers:
+            worker.join()
+        report = {'duration': round(time.time() - start, 3),
+                  'serial_duration': round(sum(done.result['duration'] for done in self.jobs if done.result), 3),
+                  'cpu_budget': self.cpu_budget, 'memory_budget': self.memory_budget,
+                  'distros': [done.result for done in self.jobs]}
+        with open(os.path.join(self.results_dir, 'matrix.json'), 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('distros', nargs='*', help='distros of the matrix to run, all if omitted')
+    parser.add_argument('--matrix', default=DEFAULT_MATRIX, help='distros, domains and budget')
+    parser.add_argument('--yaml', default=DEFAULT_YAML, help='base parameters of every job')
+    parser.add_argument('--golden', action='store_true',
+                        help='revert to golden snapshots with the prerequisites installed, (re)building them')
+    parser.add_argument('--results-dir', default=os.path.expanduser('~/avocado/job-results/matrix'))
+    args = parser.parse_args()
+
+    with open(args.matrix) as matrix_file:
+        matrix = yaml.safe_load(matrix_file)
+    with open(args.yaml) as yaml_file:
+        params = yaml.safe_load(yaml_file) or {}
+    jobs = []
+    for distro in args.distros or sorted(matrix['domains']):
+        entry = matrix['domains'][distro]
+        jobs.append(MatrixJob(distro, entry, *domain_resources(entry['domain'])))
+    cpu_budget = multiprocessing.cpu_count() - matrix.get('reserved_cpus', 1)
+    memory_budget = memory_available() - parse_size(matrix.get('reserved_memory', '2G'))
+    results_dir = os.path.join(args.results_dir, time.strftime('%Y-%m-%dT%H.%M.%S'))
+    os.makedirs(results_dir)
+    print('running {} distros on {} CPUs / {}M, results in {}'.format(
+        len(jobs), cpu_budget, memory_budget // 1024 ** 2, results_dir))
+    report = MatrixScheduler(jobs, params, results_dir, cpu_budget, memory_budget,
+                             vm_username=matrix.get('vm_username', 'root'),
+                             vm_password=matrix.get('vm_password', ''),
+                             boot_timeout=matrix.get('boot_timeout', 300),
+                             golden=matrix.get('golden', {}) if args.golden else None,
+                             helper_modules=matrix.get('helper_modules', HELPER_MODULES)).run()
+    for result in report['distros']:
+        if result.get('error'):
+            print('{distro:<14} failed: {error}, total {duration}s'.format(**result))
+        else:
+            print('{distro:<14} exit code {exit_code}, revert {revert_time}s, total {duration}s'.format(**result))
+    print('{} distros in {duration}s ({serial_duration}s one after the other)'.format(len(jobs), **report))
+    return 1 if any(result['exit_code'] != 0 for result in report['distros']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
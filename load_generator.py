@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+cassandra-stress like load generator on top of cassandra-driver.
+
+Requests are prepared statements routed to a replica of their key
+(token aware), at most `concurrency` of them in flight per process. Every
+request latency goes to a LatencyHistogram; the result summary has the keys
+of a cassandra-stress summary, so the same asserts and perf gate apply, and
+latency_report() adds the coordinated omission corrected latencies.
+With processes > 1 the key range is split over that many processes, their
+histograms and counters are merged.
+"""
+
+import os
+import re
+import time
+import random
+import logging
+import threading
+import multiprocessing
+
+from avocado import Test
+
+from latency_histogram import LatencyHistogram, expected_interval, latency_report
+
+try:
+    from cassandra import ConsistencyLevel
+    from cassandra.cluster import Cluster
+    from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+except ImportError:
+    Cluster = None
+
+log = logging.getLogger('load_generator')
+
+KEYSPACE = 'loadgen'
+TABLE = 'standard1'
+COLUMNS = 5
+OPERATIONS = ('write', 'read', 'mixed')
+
+
+class LoadGeneratorError(Exception):
+    pass
+
+
+def stress_options(sub_opt):
+    """
+    run_load() keyword arguments for the cassandra-stress options this
+    generator understands (n=, duration=, cl=, -rate threads=,
+    -schema replication(factor=), -pop seq=), the others are ignored.
+    """
+    options = dict()
+    match = re.search(r'(?:^|\s)n=(\d+)', sub_opt)
+    if match:
+        options['op_cnt'] = int(match.group(1))
+    match = re.search(r'duration=(\d+)([smh]?)', sub_opt)
+    if match:
+        options['duration'] = int(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)]
+    match = re.search(r'cl=(\w+)', sub_opt)
+    if match:
+        options['consistency'] = match.group(1).upper()
+    match = re.search(r'threads=(\d+)', sub_opt)
+    if match:
+        options['concurrency'] = int(match.group(1))
+    match = re.search(r'replication\(factor=(\d+)\)', sub_opt)
+    if match:
+        options['replication_factor'] = int(match.group(1))
+    match = re.search(r'seq=(\d+)\.\.(\d+)', sub_opt)
+    if match:
+        options['key_range'] = (int(match.group(1)), int(match.group(2)))
+    return options
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class LoadResult(object):
+
+    def __init__(self, histogram=None, ops=0, errors=0, duration=0.0, processes=1, concurrency=0):
+        self.histogram = histogram or LatencyHistogram()
+        self.ops = ops
+        self.errors = errors
+        self.duration = duration
+        self.processes = processes
+        # requests in flight, over all the processes
+        self.concurrency = concurrency
+        self.first_error = None
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        self.ops += other.ops
+        self.errors += other.errors
+        self.concurrency += other.concurrency
+        self.duration = max(self.duration, other.duration)
+        self.first_error = self.first_error or other.first_error
+        return self
+
+    @property
+    def summary(self):
+        """
+        Same keys as a cassandra-stress summary (latencies in ms).
+        """
+        rate = round(self.ops / self.duration) if self.duration else 0.0
+        summary = {'Op rate': rate, 'Partition rate': rate, 'Row rate': rate,
+                   'Total partitions': float(self.ops), 'Total errors': float(self.errors),
+                   'Total GC count': 0.0, 'Total operation time': _format_duration(self.duration)}
+        summary.update(self.histogram.summary())
+        return summary
+
+    def latency_report(self):
+        """
+        Latencies with their coordinated omission corrected view, see
+        latency_histogram.latency_report().
+        """
+        return latency_report(self.histogram, expected_interval(self.concurrency, self.ops, self.duration))
+
+    def to_dict(self):
+        return {'summary': self.summary, 'histogram': self.histogram.to_dict(), 'ops': self.ops,
+                'errors': self.errors, 'duration': self.duration, 'processes': self.processes,
+                'concurrency': self.concurrency, 'first_error': self.first_error,
+                'latency_report': self.latency_report()}
+
+    @classmethod
+    def from_dict(cls, data):
+        result = cls(LatencyHistogram.from_dict(data['histogram']), data['ops'], data['errors'], data['duration'],
+                     data['processes'], data['concurrency'])
+        result.first_error = data['first_error']
+        return result
+
+
+class _Worker(object):
+    """
+    One session issuing requests; the submitting thread blocks once
+    `concurrency` requests are in flight, completions free a slot.
+    """
+
+    def __init__(self, session, op, statements, keys, concurrency, consistency, value_size, deadline):
+        self.session = session
+        self.op = op
+        self.statements = statements
+        self.keys = keys
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.concurrency = concurrency
+        self.consistency = consistency
+        self.value = os.urandom(value_size)
+        self.deadline = deadline
+        self.result = LoadResult(concurrency=concurrency)
+        self._lock = threading.Lock()
+
+    def _done(self, _, start, failed=None):
+        latency = (time.time() - start) * 1000000
+        with self._lock:
+            if failed is None:
+                self.result.ops += 1
+                self.result.histogram.record(latency)
+            else:
+                self.result.errors += 1
+                if self.result.first_error is None:
+                    self.result.first_error = '{}: {}'.format(type(failed).__name__, failed)
+        self.slots.release()
+
+    def _failed(self, error, start):
+        self._done(None, start, failed=error)
+
+    def _statement(self, key):
+        op = self.op if self.op != 'mixed' else random.choice(('write', 'read'))
+        args = (key,) + (self.value,) * COLUMNS if op == 'write' else (key,)
+        bound = self.statements[op].bind(args)
+        bound.consistency_level = self.consistency
+        return bound
+
+    def run(self):
+        start = time.time()
+        for key in self.keys:
+            if self.deadline and time.time() > self.deadline:
+                break
+            self.slots.acquire()
+            request_start = time.time()
+            try:
+                future = self.session.execute_async(self._statement(key))
+            except Exception as ex:  # the driver errors don't share a base class
+                self._failed(ex, request_start)
+                continue
+            future.add_callbacks(self._done, self._failed, callback_args=(request_start,),
+                                 errback_args=(request_start,))
+        for _ in range(self.concurrency):
+            self.slots.acquire()
+        self.result.duration = time.time() - start
+        return self.result
+
+
+def _keys(op, key_range, op_cnt, duration):
+    first, last = key_range
+    if op == 'write' and not duration:
+        for key in xrange(first, last + 1):
+            yield '{:010d}'.format(key)
+        return
+    count = 0
+    while not op_cnt or count < op_cnt:
+        yield '{:010d}'.format(random.randint(first, last))
+        count += 1
+
+
+def _connect(hosts, port):
+    if Cluster is None:
+        raise LoadGeneratorError('cassandra-driver is not installed')
+    cluster = Cluster(hosts, port=port, load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    return cluster, cluster.connect()
+
+
+def create_schema(hosts, port=9042, replication_factor=1):
+    cluster, session = _connect(hosts, port)
+    try:
+        replication = "{{'class': 'SimpleStrategy', 'replication_factor': {}}}".format(replication_factor)
+        session.execute('CREATE KEYSPACE IF NOT EXISTS {} WITH replication = {}'.format(KEYSPACE, replication))
+        session.execute('CREATE TABLE IF NOT EXISTS {}.{} (key blob PRIMARY KEY, {})'.format(
+            KEYSPACE, TABLE, ', '.join('c{} blob'.format(col) for col in range(COLUMNS))))
+    finally:
+        cluster.shutdown()
+
+
+def _run_process(kwargs):
+    """
+    Load of one process, kwargs are run_load() arguments for its key slice.
+    """
+    cluster, session = _connect(kwargs['hosts'], kwargs['port'])
+    try:
+        columns = ['c{}'.format(col) for col in range(COLUMNS)]
+        insert = 'INSERT INTO {}.{} (key, {}) VALUES (?, {})'.format(KEYSPACE, TABLE, ', '.join(columns),
+                                                                     ', '.join('?' * COLUMNS))
+        statements = {'write': session.prepare(insert),
+                      'read': session.prepare('SELECT * FROM {}.{} WHERE key = ?'.format(KEYSPACE, TABLE))}
+        duration = kwargs['duration']
+        worker = _Worker(session, kwargs['op'], statements,
+                         _keys(kwargs['op'], kwargs['key_range'], kwargs['op_cnt'], duration),
+                         kwargs['concurrency'], getattr(ConsistencyLevel, kwargs['consistency']),
+                         kwargs['value_size'], time.time() + duration if duration else None)
+        return worker.run().to_dict()
+    finally:
+        cluster.shutdown()
+
+
+def run_load(hosts, op='write', op_cnt=None, duration=None, concurrency=50, processes=1, port=9042,
+             consistency='ONE', replication_factor=1, key_range=None, value_size=34):
+    """
+    Run op ('write', 'read' or 'mixed', half reads) against hosts.
+
+    :param op_cnt: requests to issue, one per key of key_range when omitted
+                   (writes cover it once, reads pick that many random keys)
+    :param duration: seconds to run for instead of a request count
+    :param concurrency: requests in flight per process
+    :param processes: processes splitting the load (and the key range)
+    :param key_range: (first, last) key, 1..op_cnt by default
+    :return: LoadResult, its summary has the keys of a cassandra-stress summary
+    """
+    if op not in OPERATIONS:
+        raise LoadGeneratorError('unknown operation {}'.format(op))
+    if not op_cnt and not duration and not key_range:
+        raise LoadGeneratorError('one of op_cnt, duration or key_range is needed')
+    key_range = key_range or (1, op_cnt or 1000000)
+    if op == 'write':
+        create_schema(hosts, port, replication_factor)
+    first, last = key_range
+    if not op_cnt and not duration:
+        # reads pick random keys, they'd never stop without a count
+        op_cnt = last - first + 1
+    slices = []
+    for idx in range(processes):
+        slice_first = first + (last - first + 1) * idx // processes
+        slice_last = first + (last - first + 1) * (idx + 1) // processes - 1
+        slice_ops = op_cnt * (idx + 1) // processes - op_cnt * idx // processes if op_cnt else None
+        slices.append({'hosts': hosts, 'port': port, 'op': op, 'op_cnt': slice_ops, 'duration': duration,
+                       'concurrency': concurrency, 'consistency': consistency, 'value_size': value_size,
+                       'key_range': (slice_first, slice_last) if op == 'write' else key_range})
+    log.debug('run %s load on %s: %s processes x %s in flight', op, hosts, processes, concurrency)
+    if processes == 1:
+        results = [_run_process(slices[0])]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_run_process, slices)
+        finally:
+            pool.close()
+            pool.join()
+    merged = LoadResult(processes=processes)
+    for data in results:
+        merged.merge(LoadResult.from_dict(data))
+    if merged.first_error:
+        log.warning('%s of %s %s requests failed, first error: %s', merged.errors, merged.ops + merged.errors,
+                    op, merged.first_error)
+    return merged
+
+
+class LoadGeneratorEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
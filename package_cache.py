@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Caching package proxy, so reverted VMs don't download every package again.
+
+The proxy runs on the libvirt host (it outlives the VM snapshots):
+
+    python package_cache.py --root ~/.scylla-artifact-tests/package-cache --port 3142
+
+and the guests use it as their apt/yum http proxy. https repos can't go
+through a caching proxy, their URLs are rewritten to the mirror form
+http://<proxy>/https/<host>/<path> instead; the https URLs left (yum sends
+EPEL metalinks through its proxy too) are tunnelled with CONNECT, uncached.
+Package files (and apt by-hash metadata) are immutable, they're stored once
+per sha256 and indexed by URL. Other repo metadata always comes from
+upstream.
+"""
+
+import os
+import re
+import json
+import time
+import select
+import shutil
+import socket
+import sqlite3
+import urllib2
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+from avocado import Test
+from avocado.utils import process
+
+DEFAULT_PORT = 3142
+CHUNK_SIZE = 64 * 1024
+STATS_PATH = '/_stats'
+APT_CONF = '/etc/apt/apt.conf.d/01scylla-package-cache'
+
+CACHEABLE = re.compile(r'(\.(deb|udeb|rpm|jar)$)|(/by-hash/)')
+
+log = logging.getLogger('package_cache')
+
+
+def upstream_url(path):
+    """
+    Upstream URL of a proxy request: absolute URLs when used as a proxy,
+    /https/<host>/<path> and /http/<host>/<path> when used as a mirror.
+    """
+    if path.startswith('http://'):
+        return path
+    match = re.match(r'^/(https?)/(.+)$', path)
+    if match:
+        return '{}://{}'.format(match.group(1), match.group(2))
+    return None
+
+
+def is_cacheable(url):
+    return bool(CACHEABLE.search(urlparse.urlparse(url).path))
+
+
+class PackageCache(object):
+    """
+    Content addressed store: blobs/<sha256[:2]>/<sha256>, plus an SQLite
+    index of URL -> sha256 and the cumulative hit/miss counters.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.expanduser(root)
+        self.blobs = os.path.join(self.root, 'blobs')
+        if not os.path.isdir(self.blobs):
+            os.makedirs(self.blobs)
+        self.db = sqlite3.connect(os.path.join(self.root, 'index.db'), timeout=30, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, ts REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS stats (kind TEXT PRIMARY KEY, requests INTEGER, bytes INTEGER)')
+        self.db.commit()
+        self._lock = threading.Lock()
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def lookup(self, url):
+        """
+        Path and size of the cached content of url, None when not cached.
+        """
+        with self._lock:
+            row = self.db.execute('SELECT sha256, size FROM urls WHERE url = ?', (url,)).fetchone()
+        if row and os.path.isfile(self.blob_path(row[0])):
+            return self.blob_path(row[0]), row[1]
+        return None
+
+    def store(self, url, tmp_path, digest, size):
+        path = self.blob_path(digest)
+        if os.path.isfile(path):
+            os.unlink(tmp_path)
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(tmp_path, path)
+        with self._lock:
+            self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)', (url, digest, size, time.time()))
+            self.db.commit()
+
+    def count(self, kind, size):
+        with self._lock:
+            self.db.execute('INSERT OR IGNORE INTO stats VALUES (?, 0, 0)', (kind,))
+            self.db.execute('UPDATE stats SET requests = requests + 1, bytes = bytes + ? WHERE kind = ?',
+                            (size, kind))
+            self.db.commit()
+
+    def stats(self):
+        """
+        Cumulative counters: {kind: {'requests': n, 'bytes': n}} for hit,
+        miss, passthrough and error, plus the size of the cache.
+        """
+        with self._lock:
+            rows = self.db.execute('SELECT kind, requests, bytes FROM stats').fetchall()
+            cached = self.db.execute('SELECT COUNT(DISTINCT sha256), COALESCE(SUM(size), 0) FROM urls').fetchone()
+        stats = dict((kind, {'requests': requests, 'bytes': size}) for kind, requests, size in rows)
+        stats['cache'] = {'blobs': cached[0], 'bytes': cached[1]}
+        return stats
+
+
+class CacheProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, fmt, *args):
+        log.debug('%s %s', self.client_address[0], fmt % args)
+
+    def _send_file(self, path, size):
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+        with open(path, 'rb') as blob:
+            shutil.copyfileobj(blob, self.wfile, CHUNK_SIZE)
+
+    def do_GET(self):
+        cache = self.server.cache
+        if self.path == STATS_PATH:
+            body = json.dumps(cache.stats(), sort_keys=True)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        url = upstream_url(self.path)
+        if url is None:
+            self.send_error(404, 'not a proxy or mirror request')
+            return
+        cacheable = is_cacheable(url)
+        cached = cache.lookup(url) if cacheable else None
+        if cached:
+            self._send_file(*cached)
+            cache.count('hit', cached[1])
+            return
+        try:
+            upstream = self.server.opener.open(url, timeout=self.server.timeout)
+        except urllib2.HTTPError as details:
+            self.send_error(details.code, details.msg)
+            cache.count('error', 0)
+            return
+        except (urllib2.URLError, socket.error) as details:
+            self.send_error(502, str(details))
+            cache.count('error', 0)
+            return
+        self.send_response(200)
+        for header in ('Content-Type', 'Content-Length', 'Last-Modified', 'ETag'):
+            if upstream.info().getheader(header):
+                self.send_header(header, upstream.info().getheader(header))
+        self.end_headers()
+        expected = upstream.info().getheader('Content-Length')
+        digest = hashlib.sha256()
+        size = 0
+        tmp = tempfile.NamedTemporaryFile(dir=cache.root, prefix='.partial-', delete=False) if cacheable else None
+        try:
+            for chunk in iter(lambda: upstream.read(CHUNK_SIZE), ''):
+                self.wfile.write(chunk)
+                size += len(chunk)
+                if tmp:
+                    digest.update(chunk)
+                    tmp.write(chunk)
+        except (socket.error, IOError):
+            if tmp:
+                tmp.close()
+                os.unlink(tmp.name)
+            raise
+        finally:
+            upstream.close()
+        if tmp:
+            tmp.close()
+        # py2 read() returns short data on a cut-off download instead of raising
+        if expected and expected.isdigit() and size != int(expected):
+            log.warning('Truncated download of %s: %s of %s bytes', url, size, expected)
+            if tmp:
+                os.unlink(tmp.name)
+            cache.count('error', size)
+            return
+        if tmp:
+            cache.store(url, tmp.name, digest.hexdigest(), size)
+        cache.count('miss' if cacheable else 'passthrough', size)
+
+    def do_CONNECT(self):
+        """
+        Tunnel to host:port without caching, for the https requests of
+        clients using the proxy for everything (yum).
+        """
+        host, _, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=self.server.timeout)
+        except (ValueError, socket.error) as details:
+            self.send_error(502, str(details))
+            self.server.cache.count('error', 0)
+            return
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.close_connection = 1
+        peers = {self.connection: upstream, upstream: self.connection}
+        size = 0
+        try:
+            while True:
+                readable, _, _ = select.select(peers.keys(), [], [], self.server.timeout)
+                if not readable:
+                    break
+                data = ''
+                for sock in readable:
+                    data = sock.recv(CHUNK_SIZE)
+                    if not data:
+                        break
+                    peers[sock].sendall(data)
+                    if sock is upstream:
+                        size += len(data)
+                if not data:
+                    break
+        except socket.error as details:
+            log.debug('CONNECT %s closed: %s', self.path, details)
+        finally:
+            upstream.close()
+        self.server.cache.count('passthrough', size)
+
+
+class CacheProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, cache, address=('', DEFAULT_PORT), timeout=60):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheProxyHandler)
+        self.cache = cache
+        self.timeout = timeout
+        # upstream requests must not go through a proxy of the host
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+
+class PackageCacheClient(object):
+    """
+    Guest side: point apt/yum at the proxy and account for one run.
+
+    :param url: base URL of the proxy, e.g. http://192.168.122.1:3142
+    """
+
+    def __init__(self, url, timeout=5):
+        self.url = url.rstrip('/')
+        self.netloc = urlparse.urlparse(self.url).netloc
+        self.timeout = timeout
+        self._start = None
+
+    def stats(self):
+        try:
+            return json.load(urllib2.build_opener(urllib2.ProxyHandler({})).open(self.url + STATS_PATH,
+                                                                                 timeout=self.timeout))
+        except (urllib2.URLError, socket.error, ValueError) as details:
+            log.warning('Package cache %s unavailable: %s', self.url, details)
+            return None
+
+    def available(self):
+        return self.stats() is not None
+
+    def configure_apt(self):
+        conf = ('Acquire::http::Proxy "{0}";\\n'
+                'Acquire::http::Proxy::{1} "DIRECT";\\n').format(self.url, self.netloc.split(':')[0])
+        process.run("printf '{}' | sudo tee {}".format(conf, APT_CONF), shell=True)
+
+    def configure_yum(self):
+        process.run("sudo sed -i -e '/^proxy=/d' -e 's#^\\[main\\]#[main]\\nproxy={}#' /etc/yum.conf".format(self.url),
+                    shell=True)
+
+    @staticmethod
+    def unconfigure_apt():
+        process.run('sudo rm -f {}'.format(APT_CONF))
+
+    @staticmethod
+    def unconfigure_yum():
+        process.run("sudo sed -i -e '/^proxy=/d' /etc/yum.conf", shell=True)
+
+    def rewrite_repo_file(self, path):
+        """
+        Point the https URLs of a repo file at the mirror form of the proxy.
+        """
+        process.run("sudo sed -i -e 's#https://#{}/https/#g' {}".format(self.url, path), shell=True)
+
+    def start_run(self):
+        self._start = self.stats()
+
+    def run_report(self):
+        """
+        Requests, hit rate and bytes saved since start_run().
+        """
+        end = self.stats()
+        if self._start is None or end is None:
+            return {'url': self.url, 'available': False}
+
+        def delta(kind, field):
+            return end.get(kind, {}).get(field, 0) - self._start.get(kind, {}).get(field, 0)
+        hits, misses = delta('hit', 'requests'), delta('miss', 'requests')
+        return {'url': self.url, 'available': True,
+                'hits': hits, 'misses': misses,
+                'passthrough': delta('passthrough', 'requests'), 'errors': delta('error', 'requests'),
+                'hit_rate': round(float(hits) / (hits + misses), 3) if hits + misses else None,
+                'bytes_saved': delta('hit', 'bytes'),
+                'bytes_downloaded': delta('miss', 'bytes') + delta('passthrough', 'bytes'),
+                'cache': end.get('cache')}
+
+
+class PackageCacheEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', default='~/.scylla-artifact-tests/package-cache', help='cache directory')
+    parser.add_argument('--address', default='', help='listen address')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = CacheProxyServer(PackageCache(args.root), (args.address, args.port))
+    log.info('Package cache in %s listening on %s:%s', server.cache.root, args.address or '*', args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
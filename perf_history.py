@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Local history of stress results and a regression gate on top of it.
+
+Every run is stored in SQLite, keyed by test name, version (image digest or
+sw_repo) and distro (for docker runs, the host and cluster topology). A new
+run is compared with the median of the latest runs of the same test on the
+same distro. Runs that regressed are kept but marked, they don't make
+baselines. Latency histograms of a run are kept along with it, so the
+latencies of several runs can be merged.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+
+from avocado import Test
+
+from latency_histogram import LatencyHistogram, merge_histograms
+
+log = logging.getLogger('perf_history')
+
+# metric -> (summary key, True when higher is better)
+METRICS = {'op_rate': ('Op rate', True),
+           'latency_mean': ('Latency mean', False),
+           'latency_95': ('Latency 95th percentile', False),
+           'latency_99': ('Latency 99th percentile', False),
+           'latency_999': ('Latency 99.9th percentile', False),
+           'latency_max': ('Latency max', False),
+           'errors': ('Total errors', False),
+           'partitions': ('Total partitions', True)}
+
+# metrics the gate looks at by default
+GATED = ('op_rate', 'latency_99')
+
+
+def metrics_from_summary(summary):
+    metrics = dict()
+    for metric, (key, _) in METRICS.items():
+        try:
+            metrics[metric] = float(summary[key])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return metrics
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+class PerfHistory(object):
+
+    def __init__(self, path):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, test TEXT, version TEXT, '
+                        'distro TEXT, metrics TEXT, extra TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_key ON runs (test, distro, ts)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS histograms (run INTEGER, name TEXT, histogram TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS histograms_run ON histograms (run)')
+        if 'regressed' not in [row[1] for row in self.db.execute('PRAGMA table_info(runs)')]:
+            self.db.execute('ALTER TABLE runs ADD COLUMN regressed INTEGER DEFAULT 0')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def record(self, test, version, distro, metrics, extra=None, histograms=None, regressed=False):
+        """
+        :param histograms: {name: LatencyHistogram} of the run
+        :param regressed: the run failed the gate, keep it out of the baselines
+        """
+        cur = self.db.execute('INSERT INTO runs (ts, test, version, distro, metrics, extra, regressed) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (time.time(), test, version, distro, json.dumps(metrics), json.dumps(extra or {}),
+                               int(regressed)))
+        self.db.executemany('INSERT INTO histograms VALUES (?, ?, ?)',
+                            [(cur.lastrowid, name, json.dumps(histogram.to_dict()))
+                             for name, histogram in (histograms or {}).items()])
+        self.db.commit()
+        return cur.lastrowid
+
+    def merged_histogram(self, test, distro, name, runs=5):
+        """
+        Histogram name of the latest `runs` runs that have one, merged; None
+        when there's none.
+        """
+        rows = self.db.execute('SELECT histograms.histogram FROM histograms JOIN runs ON runs.id = histograms.run '
+                               'WHERE runs.test = ? AND runs.distro = ? AND histograms.name = ? '
+                               'ORDER BY runs.ts DESC LIMIT ?', (test, distro, name, runs)).fetchall()
+        if not rows:
+            return None
+        return merge_histograms(LatencyHistogram.from_dict(json.loads(row[0])) for row in rows)
+
+    def runs(self, test, distro, limit=None, regressed=False):
+        """
+        Latest runs first, without the regressed ones unless regressed.
+        """
+        sql = 'SELECT ts, version, metrics FROM runs WHERE test = ? AND distro = ?'
+        if not regressed:
+            sql += ' AND NOT regressed'
+        sql += ' ORDER BY ts DESC'
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        return [{'ts': ts, 'version': version, 'metrics': json.loads(metrics)}
+                for ts, version, metrics in self.db.execute(sql, (test, distro))]
+
+    def baseline(self, test, distro, runs=5, min_runs=3):
+        """
+        Median of every metric over the latest `runs` runs, None when there
+        are less than min_runs of them.
+        """
+        history = self.runs(test, distro, limit=runs)
+        if len(history) < min_runs:
+            return None
+        baseline = dict()
+        for metric in METRICS:
+            values = [run['metrics'][metric] for run in history if metric in run['metrics']]
+            if values:
+                baseline[metric] = _median(values)
+        return baseline
+
+    def check(self, test, distro, metrics, tolerance=0.1, runs=5, min_runs=3, gated=GATED):
+        """
+        Compare metrics with the rolling baseline.
+
+        :return: list of regression descriptions, empty when within tolerance
+        """
+        baseline = self.baseline(test, distro, runs=runs, min_runs=min_runs)
+        if baseline is None:
+            log.debug('%s on %s: not enough history for a baseline', test, distro)
+            return []
+        regressions = []
+        for metric in gated:
+            if metric not in metrics or not baseline.get(metric):
+                continue
+            higher_is_better = METRICS[metric][1]
+            expected, observed = baseline[metric], metrics[metric]
+            change = (observed - expected) / expected
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append('{}: {:.2f} vs baseline {:.2f} ({:+.1%}, tolerance {:.0%})'.format(
+                    metric, observed, expected, change, tolerance))
+        return regressions
+
+    def check_and_record(self, test, version, distro, summary, tolerance=0.1, runs=5, extra=None, histograms=None):
+        """
+        Gate a stress summary against the history, then add it to the
+        history, marked regressed when it failed the gate.
+        """
+        metrics = metrics_from_summary(summary)
+        regressions = self.check(test, distro, metrics, tolerance=tolerance, runs=runs)
+        self.record(test, version, distro, metrics, extra=extra, histograms=histograms, regressed=bool(regressions))
+        return regressions
+
+
+class PerfHistoryEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
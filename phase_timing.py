@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Wall and CPU time of the install pipeline phases and of every command.
+
+Phases are nested with PhaseTimer.phase(); instrument() wraps
+process.run() (and so process.system() and friends) to record each command
+under the phase running it. The result is a timeline, folded stacks for
+flamegraph.pl and a per-phase history in SQLite to trend slow phases.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import resource
+import threading
+import contextlib
+import collections
+
+from avocado import Test
+from avocado.utils import process
+
+log = logging.getLogger('phase_timing')
+
+
+def _cpu_time():
+    """
+    User plus system time of this process and its waited for children.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def command_name(cmd):
+    """
+    Short name of a command for the phase tree: 'sudo apt-get install -y x'
+    is 'apt-get install', '/usr/bin/nodetool status' is 'nodetool status'.
+    """
+    words = [word for word in cmd.split() if word != 'sudo' and '=' not in word.split('/')[0]]
+    if not words:
+        return cmd.strip()
+    name = os.path.basename(words[0])
+    if len(words) > 1 and words[1][0].isalpha():
+        name += ' ' + words[1]
+    return name
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._patched = []
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def phase(self, name, kind='phase'):
+        """
+        Time the block as phase name, nested in the phase running in this
+        thread. Yields the event dict, extra fields can be added to it.
+        """
+        stack = self._stack()
+        name = name.replace(';', ',')
+        event = {'name': name, 'kind': kind, 'depth': len(stack), 'status': 'ok',
+                 'path': ';'.join([parent['name'] for parent in stack] + [name]),
+                 'start': round(time.time() - self.start, 3)}
+        stack.append(event)
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            yield event
+        except BaseException as details:
+            event['status'] = 'error: %s' % type(details).__name__
+            raise
+        finally:
+            stack.pop()
+            event['wall'] = round(time.time() - wall, 3)
+            event['cpu'] = round(_cpu_time() - cpu, 3)
+            with self._lock:
+                self.events.append(event)
+
+    def instrument(self, module=process):
+        """
+        Record every module.run() call as a 'cmd' event, until restore().
+        """
+        original = module.run
+        timer = self
+
+        def run(cmd, *args, **kwargs):
+            with timer.phase(command_name(cmd), kind='cmd') as event:
+                event['cmd'] = cmd
+                try:
+                    result = original(cmd, *args, **kwargs)
+                except process.CmdError as details:
+                    if details.result is not None:
+                        event['exit_status'] = details.result.exit_status
+                    raise
+                event['exit_status'] = result.exit_status
+                return result
+        module.run = run
+        self._patched.append((module, original))
+
+    def restore(self):
+        while self._patched:
+            module, original = self._patched.pop()
+            module.run = original
+
+    def aggregate(self):
+        """
+        {path: {'count', 'wall', 'cpu', 'self_wall'}}, self_wall being the
+        time not spent in nested phases or commands.
+        """
+        with self._lock:
+            events = list(self.events)
+        phases = collections.OrderedDict()
+        for event in sorted(events, key=lambda event: event['start']):
+            phase = phases.setdefault(event['path'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'self_wall': 0.0})
+            phase['count'] += 1
+            phase['wall'] += event['wall']
+            phase['cpu'] += event['cpu']
+            phase['self_wall'] += event['wall']
+        for event in events:
+            parent = event['path'].rpartition(';')[0]
+            if parent in phases:
+                phases[parent]['self_wall'] -= event['wall']
+        for phase in phases.values():
+            for key in ('wall', 'cpu', 'self_wall'):
+                phase[key] = round(max(phase[key], 0.0), 3)
+        return phases
+
+    def timeline(self):
+        with self._lock:
+            return sorted(self.events, key=lambda event: (event['start'], event['depth']))
+
+    def folded(self):
+        """
+        Folded stacks ('a;b;c <ms>'), the input of flamegraph.pl.
+        """
+        return ''.join('{} {}\n'.format(path, int(phase['self_wall'] * 1000))
+                       for path, phase in self.aggregate().items() if phase['self_wall'] > 0)
+
+    def summary(self, top=15):
+        """
+        The phases and commands taking the most time, as text.
+        """
+        phases = sorted(self.aggregate().items(), key=lambda item: item[1]['self_wall'], reverse=True)
+        lines = ['{:>9} {:>9} {:>9} {:>5}  {}'.format('self', 'wall', 'cpu', 'count', 'phase')]
+        for path, phase in phases[:top]:
+            lines.append('{self_wall:>9.3f} {wall:>9.3f} {cpu:>9.3f} {count:>5}  '.format(**phase) + path)
+        return '\n'.join(lines)
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+class PhaseHistory(object):
+    """
+    Phase timings of the previous runs, per distro.
+    """
+
+    def __init__(self, path):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('CREATE TABLE IF NOT EXISTS phases ('
+                        'ts REAL, test TEXT, version TEXT, distro TEXT, path TEXT, '
+                        'count INTEGER, wall REAL, cpu REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS phases_key ON phases (test, distro, path, ts)')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def baseline(self, test, distro, path, runs=5, min_runs=3):
+        """
+        Median wall time of path over the latest `runs` runs, None when there
+        are less than min_runs of them.
+        """
+        rows = self.db.execute('SELECT wall FROM phases WHERE test = ? AND distro = ? AND path = ? '
+                               'ORDER BY ts DESC LIMIT ?', (test, distro, path, runs)).fetchall()
+        if len(rows) < min_runs:
+            return None
+        return _median([row[0] for row in rows])
+
+    def check_and_record(self, test, version, distro, phases, tolerance=0.5, runs=5, min_runs=3, min_wall=1.0):
+        """
+        Compare phases (PhaseTimer.aggregate()) with the median of the latest
+        runs, then record them. Returns the phases slower than the baseline
+        by more than tolerance, ignoring the ones under min_wall seconds and
+        the ones with less than min_runs runs of history.
+        """
+        slow = []
+        for path, phase in phases.items():
+            baseline = self.baseline(test, distro, path, runs, min_runs)
+            if baseline is not None and phase['wall'] >= min_wall and phase['wall'] > baseline * (1 + tolerance):
+                slow.append({'path': path, 'wall': phase['wall'], 'baseline': round(baseline, 3)})
+        now = time.time()
+        self.db.executemany('INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            [(now, test, version, distro, path, phase['count'], phase['wall'], phase['cpu'])
+                             for path, phase in phases.items()])
+        self.db.commit()
+        return slow
+
+
+class PhaseTimingEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Per-node CPU, memory and I/O limits for scylla containers.
+
+Cores are handed out whole (hyperthread siblings together) and never
+shared between nodes, so several nodes on one host don't fight over the
+same CPUs. Only when the host has too few cores for node_cnt the sets
+overlap, and scylla is then started with --overprovisioned.
+"""
+
+import os
+import re
+import glob
+import logging
+import multiprocessing
+
+log = logging.getLogger('resource_profile')
+
+SYSFS_CPU = '/sys/devices/system/cpu'
+
+# memory left to the container, besides what scylla is told to use
+MEMORY_RESERVE = 0.1
+MIN_MEMORY_RESERVE_MB = 256
+
+_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(size):
+    """
+    '2G' -> 2147483648, '512m' -> 536870912, 1024 -> 1024
+    """
+    if isinstance(size, (int, long)):
+        return size
+    match = re.match(r'^\s*(\d+)\s*([kmgt]?)b?\s*$', str(size).lower())
+    if not match:
+        raise ValueError('invalid size: {}'.format(size))
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+def _read(path, default=None):
+    try:
+        with open(path) as sysfs_file:
+            return sysfs_file.read().strip()
+    except IOError:
+        return default
+
+
+def host_cpu_topology(sysfs=SYSFS_CPU):
+    """
+    Online physical cores of the host, each a sorted list of its logical
+    CPUs, ordered by (package, core).
+    """
+    cores = dict()
+    for cpu_dir in glob.glob(os.path.join(sysfs, 'cpu[0-9]*')):
+        cpu = int(os.path.basename(cpu_dir)[3:])
+        if _read(os.path.join(cpu_dir, 'online'), '1') == '0':
+            continue
+        package = int(_read(os.path.join(cpu_dir, 'topology', 'physical_package_id'), 0))
+        core = int(_read(os.path.join(cpu_dir, 'topology', 'core_id'), cpu))
+        cores.setdefault((package, core), []).append(cpu)
+    if not cores:
+        return [[i] for i in range(multiprocessing.cpu_count())]
+    return [sorted(cpus) for _, cpus in sorted(cores.items())]
+
+
+class ResourceProfile(object):
+    """
+    Resources of one node: docker side limits plus the matching scylla
+    command line (--smp, --memory, --overprovisioned).
+    """
+
+    def __init__(self, cpuset=None, smp=None, memory=None, overprovisioned=False,
+                 io_device=None, io_read_bps=None, io_write_bps=None):
+        self.cpuset = sorted(cpuset or [])
+        self.smp = smp or (len(self.cpuset) if self.cpuset else None)
+        self.memory = parse_size(memory) if memory else None
+        self.overprovisioned = overprovisioned
+        self.io_device = io_device
+        self.io_read_bps = parse_size(io_read_bps) if io_read_bps else None
+        self.io_write_bps = parse_size(io_write_bps) if io_write_bps else None
+
+    @property
+    def scylla_memory_mb(self):
+        if not self.memory:
+            return None
+        memory_mb = self.memory // 1024 ** 2
+        return memory_mb - max(MIN_MEMORY_RESERVE_MB, int(memory_mb * MEMORY_RESERVE))
+
+    def docker_args(self):
+        args = []
+        if self.cpuset:
+            args += ['--cpuset-cpus', ','.join(str(cpu) for cpu in self.cpuset)]
+        if self.memory:
+            args += ['--memory', str(self.memory)]
+        if self.io_device and self.io_read_bps:
+            args += ['--device-read-bps', '{}:{}'.format(self.io_device, self.io_read_bps)]
+        if self.io_device and self.io_write_bps:
+            args += ['--device-write-bps', '{}:{}'.format(self.io_device, self.io_write_bps)]
+        return args
+
+    def host_config(self):
+        """
+        The docker_args() limits as Engine API HostConfig.
+        """
+        config = dict()
+        if self.cpuset:
+            config['CpusetCpus'] = ','.join(str(cpu) for cpu in self.cpuset)
+        if self.memory:
+            config['Memory'] = self.memory
+        if self.io_device and self.io_read_bps:
+            config['BlkioDeviceReadBps'] = [{'Path': self.io_device, 'Rate': self.io_read_bps}]
+        if self.io_device and self.io_write_bps:
+            config['BlkioDeviceWriteBps'] = [{'Path': self.io_device, 'Rate': self.io_write_bps}]
+        return config
+
+    def scylla_args(self):
+        args = []
+        if self.smp:
+            args += ['--smp', str(self.smp)]
+        if self.memory:
+            args += ['--memory', '{}M'.format(self.scylla_memory_mb)]
+        if self.overprovisioned:
+            args += ['--overprovisioned', '1']
+        return args
+
+    def to_dict(self):
+        return {'cpuset': self.cpuset, 'smp': self.smp, 'memory': self.memory,
+                'scylla_memory_mb': self.scylla_memory_mb, 'overprovisioned': self.overprovisioned,
+                'io_device': self.io_device, 'io_read_bps': self.io_read_bps, 'io_write_bps': self.io_write_bps}
+
+
+def plan_profiles(node_cnt, cpus=0, memory=None, reserved_cores=1, io_device=None, io_read_bps=None,
+                  io_write_bps=None, topology=None, slot=0, slots=1, memory_per_cpu=None):
+    """
+    Compute one ResourceProfile per node.
+
+    :param cpus: CPUs per node, 0 splits the available cores evenly
+    :param memory: memory limit per node, e.g. '2G'
+    :param memory_per_cpu: without memory, the limit is this times the CPUs
+                           of the node, e.g. '1G'
+    :param reserved_cores: cores left to the host, docker and the loaders
+    :param topology: host_cpu_topology() result, read from sysfs if omitted
+    :param slot: which of `slots` equal shares of the cores this cluster
+                 gets, when several clusters run on the host at once
+    """
+    cores = topology or host_cpu_topology()
+    if len(cores) > reserved_cores:
+        cores = cores[reserved_cores:]
+    share = len(cores) // slots
+    if share:
+        cores = cores[slot * share:(slot + 1) * share]
+    threads = len(cores[0])
+    cores_per_node = -(-cpus // threads) if cpus else len(cores) // node_cnt
+    limits = dict(io_device=io_device, io_read_bps=io_read_bps, io_write_bps=io_write_bps)
+
+    def node_memory(cpuset):
+        if memory or not memory_per_cpu:
+            return memory
+        return parse_size(memory_per_cpu) * len(cpuset)
+    if cores_per_node and cores_per_node * node_cnt <= len(cores):
+        profiles = []
+        for i in range(node_cnt):
+            cpuset = sum(cores[i * cores_per_node:(i + 1) * cores_per_node], [])
+            cpuset = cpuset[:cpus] if cpus else cpuset
+            profiles.append(ResourceProfile(cpuset=cpuset, memory=node_memory(cpuset), **limits))
+        return profiles
+    # not enough cores for disjoint sets, share them round robin
+    flat = sum(cores, [])
+    per_node = cpus or 1
+    log.warning('%s CPUs available for %s nodes of %s CPUs, nodes share CPUs (overprovisioned)',
+                len(flat), node_cnt, per_node)
+    profiles = []
+    for i in range(node_cnt):
+        cpuset = set(flat[(i * per_node + j) % len(flat)] for j in range(per_node))
+        profiles.append(ResourceProfile(cpuset=cpuset, memory=node_memory(cpuset), overprovisioned=True, **limits))
+    return profiles
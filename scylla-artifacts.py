@@ -2,24 +2,101 @@
 
 import os
 import re
+import json
+import contextlib
+import collections
+import time
 import logging
 import threading
 import datetime
+import subprocess
 from pkg_resources import parse_version
 try:
     from check_version import CheckVersionDB
 except:
     # Avocado may not copy check_version.py to VM
     print "failed to import CheckVersionDB"
+try:
+    from failure_signatures import FatalSignatureError, default_signatures
+    from failure_signatures import run as run_scanned
+except ImportError:
+    # Avocado may not copy failure_signatures.py to VM, command output and
+    # scylla logs are not scanned then
+    default_signatures = None
+
+    class FatalSignatureError(Exception):
+        pass
+try:
+    from host_facts import host_facts, refresh_host_facts
+except ImportError:
+    # Avocado may not copy host_facts.py to VM, the facts are collected with
+    # commands on every use then
+    def host_facts(*names):
+        return InlineHostFacts()
+    refresh_host_facts = host_facts
+try:
+    from phase_timing import PhaseHistory, PhaseTimer
+except ImportError:
+    # Avocado may not copy phase_timing.py to VM, nothing is timed then
+    PhaseHistory = None
+
+    class PhaseTimer(object):
+
+        @contextlib.contextmanager
+        def phase(self, name, kind='phase'):
+            yield {}
+
+        def instrument(self, module=None):
+            pass
+
+        def restore(self):
+            pass
+
+        def aggregate(self):
+            return {}
+try:
+    from setup_checkpoints import SetupCheckpoints
+except ImportError:
+    # Avocado may not copy setup_checkpoints.py to VM, the setup runs once
+    # per job then, as before the checkpoints
+    SetupCheckpoints = None
+try:
+    from perf_history import PerfHistory
+    from stress_results import parse_stress_output
+    from stress_thresholds import StressThresholds, format_diff
+except ImportError:
+    # Avocado may not copy them to VM either, the perf gate and the
+    # thresholds are skipped then
+    PerfHistory = None
+try:
+    from scylla_rest import RingStatus
+except ImportError:
+    RingStatus = None
+try:
+    from cql_probe import Backoff, CQLProbeError, query_cql
+except ImportError:
+    query_cql = None
+try:
+    from latency_histogram import parse_hdr_log
+except ImportError:
+    parse_hdr_log = None
+try:
+    from load_generator import run_load, stress_options
+except ImportError:
+    run_load = None
+try:
+    from package_cache import PackageCacheClient
+except ImportError:
+    PackageCacheClient = None
 
 from avocado import Test
 from avocado import main
-from avocado.utils import distro
 from avocado.utils import process
 from avocado.utils import path
 from avocado.utils import service
 from avocado.utils import wait
 from avocado.utils import network
+from avocado.utils import distro
 
 from avocado.utils.software_manager import AptBackend
 from avocado.utils.software_manager import YumBackend
@@ -31,19 +108,74 @@ from avocado.utils import path as utils_path
 
 SCRIPTLET_FAILURE_LIST = []
 TEST_PARAMS = {}
+# written when the prerequisites of a golden snapshot are in place
+GOLDEN_MARKER = '/var/lib/scylla-artifact-tests/golden.json'
+
+
+class InlineHostFacts(object):
+    """
+    The host facts used here, collected with commands when host_facts.py
+    isn't on the VM (see host_facts.HostFacts).
+    """
+
+    def __init__(self):
+        self.distro = distro.detect()
+        self.distro_name = self.distro.name
+        self.distro_version = self.distro.version
+        self.distro_release = self.distro.release
+        self.distro_key = '%s-%s.%s' % (self.distro_name.lower(), self.distro_version, self.distro_release)
+        self.is_systemd = 'systemd' in process.run('cat /proc/1/comm').stdout
+        result = process.run('ip -o link show |grep ether |awk -F": " \'{print $2}\'', shell=True)
+        self.nics = tuple(result.stdout.split())
+        result = process.run('ls /dev/[hvs]db', shell=True, ignore_status=True)
+        self.disks = tuple(result.stdout.split())
+        self.scylla_setup_options = None
+        if os.path.exists('/usr/lib/scylla/scylla_setup'):
+            with open('/usr/lib/scylla/scylla_setup') as setup_file:
+                self.scylla_setup_options = tuple(sorted(set(re.findall(r'--[a-z][\w-]*', setup_file.read()))))
+        result = process.run('getenforce 2>/dev/null', shell=True, ignore_status=True)
+        self.selinux = result.stdout.strip() or 'Disabled'
 
+    def to_dict(self):
+        facts = dict(self.__dict__)
+        del facts['distro']
+        return facts
 
-def _search_scriptlet_failure(result):
-    global SCRIPTLET_FAILURE_LIST
-    output = result.stdout + result.stderr
-    failure_pattern = 'scriptlet failure in rpm package scylla.*'
-    if re.search(failure_pattern, output):
-        pkgs = []
-        occurrences = re.findall(failure_pattern, output)
-        for occurrence in occurrences:
-            pkg = occurrence.split()[-1]
-            pkgs.append(pkg)
-            SCRIPTLET_FAILURE_LIST.append(pkg)
+
+def signature_scanner(source, categories):
+    """
+    Scanner of the default failure signatures, None without
+    failure_signatures.py.
+    """
+    if default_signatures is None:
+        return None
+    return default_signatures().scanner(source, categories)
+
+
+def _install_scanned(i_cmd):
+    """
+    Run a package install command, matching its output against the install
+    failure signatures while it runs. RPM scriptlet failures are collected
+    in SCRIPTLET_FAILURE_LIST.
+    """
+    scanner = signature_scanner(i_cmd, 'install')
+    if scanner is None:
+        try:
+            process.run(i_cmd, sudo=True)
+            return True
+        except process.CmdError:
+            return False
+    try:
+        run_scanned(i_cmd, scanner, sudo=True)
+        return True
+    except FatalSignatureError as details:
+        logging.getLogger('avocado.test').error('Install aborted: %s', details)
+        return False
+    except process.CmdError:
+        return False
+    finally:
+        for match in scanner.found('rpm_scriptlet_failure'):
+            SCRIPTLET_FAILURE_LIST.append(match.text.split()[-1])
 
 
 class ScyllaYumBackend(YumBackend):
@@ -53,12 +185,7 @@ class ScyllaYumBackend(YumBackend):
         Installs package [name]. Handles local installs.
         """
         i_cmd = self.base_command + ' ' + 'install' + ' ' + name
-
-        try:
-            _search_scriptlet_failure(process.run(i_cmd, sudo=True))
-            return True
-        except process.CmdError:
-            return False
+        return _install_scanned(i_cmd)
 
 
 class ScyllaDnfBackend(DnfBackend):
@@ -68,12 +195,7 @@ class ScyllaDnfBackend(DnfBackend):
         Installs package [name]. Handles local installs.
         """
         i_cmd = self.base_command + ' ' + 'install' + ' ' + name
-
-        try:
-            _search_scriptlet_failure(process.run(i_cmd, sudo=True))
-            return True
-        except process.CmdError:
-            return False
+        return _install_scanned(i_cmd)
 
 
 class ScyllaAptBackend(AptBackend):
@@ -85,14 +207,9 @@ class ScyllaAptBackend(AptBackend):
         executable = utils_path.find_command('apt-get')
         self.base_command = executable + ' --yes'
 
-    def upgrade(self, name=None):
+    def refresh(self):
         """
-        Upgrade all packages of the system with eventual new versions.
-
-        Optionally, upgrade individual packages.
-
-        :param name: optional parameter wildcard spec to upgrade
-        :type name: str
+        Update the package lists.
         """
         def update_pkg_list():
             ud_command = 'update'
@@ -103,8 +220,21 @@ class ScyllaAptBackend(AptBackend):
             except process.CmdError:
                 return False
 
-        wait.wait_for(update_pkg_list, timeout=300, step=30,
-                      text="Wait until package list is up to date...")
+        return wait.wait_for(update_pkg_list, timeout=300, step=30,
+                             text="Wait until package list is up to date...")
+
+    def upgrade(self, name=None, refresh=True):
+        """
+        Upgrade all packages of the system with eventual new versions.
+
+        Optionally, upgrade individual packages.
+
+        :param name: optional parameter wildcard spec to upgrade
+        :type name: str
+        :param refresh: update the package lists first
+        """
+        if refresh:
+            self.refresh()
 
         if name:
             up_command = 'install --only-upgrade'
@@ -168,6 +298,111 @@ class ScyllaSoftwareManager(object):
         return self.backend.__getattribute__(name)
 
 
+class PackageTransaction(object):
+
+    """
+    Plan of the package manager work of an install.
+
+    Repo changes, metadata refreshes, upgrades and installs are recorded as
+    they're requested and run on commit() as the fewest package manager
+    calls: one refresh after the last repo change, one upgrade and one
+    batched install per set of install arguments. ensure_metadata() runs a
+    pending refresh right away, for queries that need the new repos.
+    """
+
+    def __init__(self, sw_manager):
+        self.sw_manager = sw_manager
+        self.log = logging.getLogger('avocado.test')
+        self.requested = collections.Counter()
+        self.calls = []
+        self._fresh = False
+        self._upgrade = False
+        self._installs = collections.OrderedDict()
+        self._post_install = []
+
+    def _call(self, kind, func, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.calls.append((kind, time.time() - start))
+
+    def _backend_ready(self):
+        if not self.sw_manager.initialized:
+            # the apt backend updates the package lists when it's set up
+            self._call('init', self.sw_manager._init_on_demand)
+            self._fresh = True
+
+    def repo_changed(self):
+        self.requested['repo_change'] += 1
+        self._fresh = False
+
+    def refresh(self):
+        self.requested['refresh'] += 1
+
+    def upgrade(self):
+        self.requested['upgrade'] += 1
+        self._upgrade = True
+
+    def install(self, *pkgs, **kwargs):
+        """
+        Queue packages for the batched install.
+
+        :param args: extra package manager arguments, e.g. '-t jessie-backports'
+        """
+        self.requested['install'] += 1
+        queued = self._installs.setdefault(kwargs.get('args', '').strip(), [])
+        queued.extend(pkg for pkg in pkgs if pkg not in queued)
+
+    def run_after_install(self, cmd):
+        self._post_install.append(cmd)
+
+    def ensure_metadata(self):
+        self._backend_ready()
+        if not self._fresh:
+            refresh = getattr(self.sw_manager.backend, 'refresh', None)
+            if refresh is not None:
+                self._call('refresh', refresh)
+            self._fresh = True
+
+    def commit(self):
+        self.ensure_metadata()
+        if self._upgrade:
+            backend = self.sw_manager.backend
+            kwargs = {'refresh': False} if isinstance(backend, ScyllaAptBackend) else {}
+            self._call('upgrade', wait.wait_for, lambda: backend.upgrade(**kwargs), timeout=300, step=30,
+                       text="Wait until system is up to date...")
+            self._upgrade = False
+        for args, pkgs in self._installs.items():
+            names = ' '.join(([args] if args else []) + pkgs)
+            if not self._call('install', self.sw_manager.install, names):
+                raise InstallPackageError('Packages %s could not be installed '
+                                          '(see logs for details)' % names)
+        self._installs.clear()
+        for cmd in self._post_install:
+            self._call('post_install', process.run, cmd, shell=True)
+        self._post_install = []
+        self.log.info('Package transaction: %s', json.dumps(self.report(), sort_keys=True))
+
+    def report(self):
+        """
+        Requested and executed operations. The saved time is an estimate:
+        every skipped operation is counted at the average duration of the
+        executed ones of its kind.
+        """
+        executed = collections.Counter(kind for kind, _ in self.calls)
+        durations = collections.defaultdict(float)
+        for kind, duration in self.calls:
+            durations[kind] += duration
+        saved = 0.0
+        for kind in ('refresh', 'upgrade', 'install'):
+            if executed[kind] and self.requested[kind] > executed[kind]:
+                saved += (self.requested[kind] - executed[kind]) * durations[kind] / executed[kind]
+        return {'requested': dict(self.requested), 'executed': dict(executed),
+                'durations': dict((kind, round(duration, 3)) for kind, duration in durations.items()),
+                'estimated_time_saved': round(saved, 3)}
+
+
 class StartServiceError(Exception):
     pass
 
@@ -184,6 +419,38 @@ class InstallPackageError(Exception):
     pass
 
 
+def _debian_like():
+    return host_facts().distro_name.lower() in ('ubuntu', 'debian')
+
+
+def package_version(pkg):
+    """
+    Installed version of pkg, None when it's not installed.
+    """
+    if _debian_like():
+        cmd = "dpkg-query -W -f='${Version}' %s" % pkg
+    else:
+        cmd = "rpm -q --qf '%%{VERSION}-%%{RELEASE}' %s" % pkg
+    result = process.run(cmd, shell=True, ignore_status=True, verbose=False)
+    return (result.stdout.strip() or None) if result.exit_status == 0 else None
+
+
+def package_upgradable(pkg):
+    """
+    Whether the repos offer another build of the installed pkg (nightly repo
+    URLs stay the same over builds). Refreshes the package metadata.
+    """
+    if _debian_like():
+        process.run('sudo apt-get update -qq', shell=True, ignore_status=True)
+        policy = process.run('apt-cache policy %s' % pkg, ignore_status=True).stdout
+        installed = re.search(r'Installed:\s*(\S+)', policy)
+        candidate = re.search(r'Candidate:\s*(\S+)', policy)
+        return bool(installed and candidate and installed.group(1) != candidate.group(1))
+    pm = 'dnf' if host_facts().distro_name.lower() == 'fedora' else 'yum'
+    # check-update exits with 100 when there are updates
+    return process.run('sudo %s -q check-update %s' % (pm, pkg), ignore_status=True).exit_status == 100
+
+
 def get_scylla_logs():
     try:
         journalctl_cmd = path.find_command('journalctl')
@@ -200,48 +467,197 @@ def get_scylla_logs():
                     verbose=True, ignore_status=True)
 
 
+SCYLLA_UNITS = ['scylla-io-setup.service', 'scylla-server.service', 'scylla-ami-setup.service',
+                'scylla-housekeeping-daily.service', 'scylla-housekeeping-restart.service',
+                'scylla-jmx.service']
+
+
+class ScyllaLogWatcher(object):
+    """
+    Follow the scylla logs in a background thread and match every new line
+    against the 'service' failure signatures, as soon as it's written.
+
+    The journal is followed with 'journalctl -f -o json', keeping the cursor
+    of the last entry so a restarted follower picks up where it stopped.
+    Without journalctl, /var/log/syslog is read from the last offset on.
+    """
+    syslog = '/var/log/syslog'
+    poll_interval = 0.5
+
+    def __init__(self):
+        # created on start(), the signatures are only loaded by the test setUp
+        self.scanner = None
+        self.cursor = None
+        self.offset = None
+        self._stopped = threading.Event()
+        self._unmatched = threading.Event()
+        self._proc = None
+        self._thread = None
+
+    @property
+    def error(self):
+        return self.scanner.fatal.text if self.scanner is not None and self.scanner.fatal else None
+
+    @property
+    def matched(self):
+        if self.scanner is None:
+            self.reset()
+        return self.scanner.fatal_event if self.scanner is not None else self._unmatched
+
+    def _check(self, line):
+        if self.scanner is not None:
+            self.scanner.feed_line(line)
+
+    def _follow_journal(self, journalctl_cmd, since):
+        while not self._stopped.is_set():
+            cmd = ['sudo', journalctl_cmd, '-f', '-o', 'json'] + ['-u%s' % unit for unit in SCYLLA_UNITS]
+            if self.cursor:
+                cmd.append('--after-cursor=%s' % self.cursor)
+            elif since:
+                cmd.append('--since=%s' % since)
+            else:
+                cmd.append('--no-tail')
+            self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            for line in iter(self._proc.stdout.readline, ''):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.cursor = entry.get('__CURSOR', self.cursor)
+                if isinstance(entry.get('MESSAGE'), basestring):
+                    self._check(entry['MESSAGE'])
+            self._proc.wait()
+            self._stopped.wait(self.poll_interval)
+
+    def _follow_syslog(self, since):
+        partial = ''
+        while not self._stopped.is_set():
+            try:
+                with open(self.syslog) as syslog:
+                    syslog.seek(0, os.SEEK_END)
+                    if self.offset is None or syslog.tell() < self.offset:
+                        # first read (the whole log unless there's a start
+                        # time to go by), or the log was rotated
+                        self.offset = syslog.tell() if self.offset is None and since else 0
+                        partial = ''
+                    syslog.seek(self.offset)
+                    data = syslog.read()
+                    self.offset = syslog.tell()
+            except IOError:
+                data = ''
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                if 'scylla' in line:
+                    self._check(line)
+            self._stopped.wait(self.poll_interval)
+
+    def start(self, since=None):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self.scanner is None:
+            self.reset()
+        self._stopped.clear()
+        try:
+            journalctl_cmd = path.find_command('journalctl')
+            target, args = self._follow_journal, (journalctl_cmd, since)
+        except path.CmdNotFoundError:
+            target, args = self._follow_syslog, (since,)
+        self._thread = threading.Thread(target=target, args=args, name='scylla-log-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.terminate()
+        if self._thread is not None:
+            self._thread.join(10)
+        self._thread = None
+
+    def reset(self):
+        self.scanner = signature_scanner('scylla logs', 'service')
+
+
 class ScyllaServiceManager(object):
 
     def __init__(self):
         self.services = ['scylla-server', 'scylla-jmx']
         self.start_time = None
+        self.started = None
+        self.log_watcher = ScyllaLogWatcher()
+        # time to the first CQL query of every start and restart
+        self.readiness = []
+
+    def _watch_logs(self):
+        self.log_watcher.stop()
+        self.log_watcher.reset()
+        self.log_watcher.start(self.start_time)
 
     def _scylla_service_is_up(self):
-        srv_manager = service.ServiceManager()
+        """
+        True once scylla serves CQL queries (a STARTUP and a SELECT from
+        system.local), only an open CQL port without cql_probe.
+        """
+        if self.log_watcher.error:
+            logging.getLogger('avocado.test').error('Failure signatures report: %s',
+                                                    json.dumps(self.log_watcher.scanner.report()))
+            raise StartServiceError('Fail to start scylla-server, err: %s' % self.log_watcher.error)
+
+        if query_cql is None:
+            return not network.is_port_free(9042, 'localhost')
         try:
-            journalctl_cmd = path.find_command('journalctl')
-            timestamp = '--since "%s"' % self.start_time if self.start_time else ''
-            result = process.run('sudo %s --no-tail '
-                                 '-u scylla-io-setup.service '
-                                 '-u scylla-server.service '
-                                 '-u scylla-ami-setup.service '
-                                 '-u scylla-housekeeping-daily.service '
-                                 '-u scylla-housekeeping-restart.service '
-                                 '-u scylla-jmx.service '
-                                 '%s' % (journalctl_cmd, timestamp),
-                                 ignore_status=True)
-        except path.CmdNotFoundError:
-            result = process.run('cat /var/log/syslog | grep scylla', shell=True,
-                                 ignore_status=True)
-        error_list = ['I/O Scheduler is not properly configured!', 'Failed to start Scylla Server', 'failed to write into /proc/irq']
-        for err in error_list:
-            if err in result.stdout:
-                raise StartServiceError('Fail to start scylla-server, err: %s' % err)
+            self.release_version = query_cql('localhost', timeout=1.0)
+            return True
+        except CQLProbeError as details:
+            self.probe_error = details
+            return False
 
-        for srv in self.services:
-            srv_manager.status(srv)
-        return not network.is_port_free(9042, 'localhost')
+    def services_up(self):
+        """
+        One readiness check without waiting, for a setup reused from an
+        earlier run.
+        """
+        self.probe_error = None
+        return self._scylla_service_is_up()
 
     def wait_services_up(self):
         service_start_timeout = 900
-        output = wait.wait_for(func=self._scylla_service_is_up,
-                               timeout=service_start_timeout, step=5)
-        if output is None:
-            e_msg = 'Scylla service does not appear to be up after %s s' % service_start_timeout
-            raise StartServiceError(e_msg)
+        self.log_watcher.start(self.start_time)
+        self.probe_error = None
+        self.release_version = None
+        backoff = Backoff(min_delay=0.1, max_delay=1.0) if query_cql is not None else None
+        attempts = 0
+        try:
+            deadline = time.time() + service_start_timeout
+            while time.time() < deadline:
+                attempts += 1
+                if self._scylla_service_is_up():
+                    self._record_readiness(attempts)
+                    return
+                # wakes up right away when a fatal line shows up in the logs
+                self.log_watcher.matched.wait(backoff.next() if backoff else 5)
+        finally:
+            self.log_watcher.stop()
+        e_msg = 'Scylla service does not appear to be up after %s s' % service_start_timeout
+        if self.probe_error:
+            e_msg += ', last CQL probe error: %s' % self.probe_error
+        raise StartServiceError(e_msg)
+
+    def _record_readiness(self, attempts):
+        if self.started is None:
+            return
+        readiness = {'time_to_cql': round(time.time() - self.started, 3), 'attempts': attempts,
+                     'probe': 'query' if query_cql is not None else 'port',
+                     'release_version': self.release_version, 'started': self.start_time}
+        self.readiness.append(readiness)
+        logging.getLogger('avocado.test').info('Scylla served CQL %ss after the start (%s probes)',
+                                               readiness['time_to_cql'], attempts)
 
     def start_services(self):
         self.start_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.started = time.time()
+        self._watch_logs()
         srv_manager = service.ServiceManager()
         for srv in self.services:
             srv_manager.start(srv)
@@ -267,6 +683,8 @@ class ScyllaServiceManager(object):
 
     def restart_services(self):
         self.start_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.started = time.time()
+        self._watch_logs()
         srv_manager = service.ServiceManager()
         for srv in self.services:
             srv_manager.restart(srv)
@@ -288,14 +706,20 @@ class ScyllaInstallGeneric(object):
         self.sw_repo_dst = None
         self.log = logging.getLogger('avocado.test')
         self.srv_manager = ScyllaServiceManager()
+        self.transaction = PackageTransaction(self.sw_manager)
+        self.package_cache = None
+        self.install_phase = 'all'
+        self.golden_fingerprint = None
+        self.timer = PhaseTimer()
+        # SetupCheckpoints of the install stages, None runs all of them
+        self.checkpoints = None
         self.is_enterprise = None
 
     def scylla_pkg(self):
         return 'scylla'
 
     def is_systemd(self):
-        result = process.run("cat /proc/1/comm")
-        return 'systemd' in result.stdout
+        return host_facts().is_systemd
 
     def try_report_uuid(self):
         uuid_path = '/var/lib/scylla-housekeeping/housekeeping.uuid'
@@ -318,34 +742,130 @@ class ScyllaInstallGeneric(object):
             last_id = self.cvdb.get_last_id(self.uuid, self.repoid, self.version)
         process.run('sudo curl %s -o %s -L' % (self.sw_repo_src, self.sw_repo_dst),
                     shell=True)
+        # private repos count the package downloads, they must reach the repo
+        if self.package_cache and not self.uuid:
+            self.package_cache.rewrite_repo_file(self.sw_repo_dst)
+        self.transaction.repo_changed()
         if self.uuid:
             assert self.cvdb.check_new_record(self.uuid, self.repoid, self.version, last_id)
 
+    def configure_package_cache(self):
+        pass
+
+    def unconfigure_package_cache(self):
+        pass
+
+    def prereq_setup(self):
+        """
+        Distro prerequisites, the same whatever scylla build is tested.
+        Golden snapshots are taken right after them (install_phase 'prereqs').
+        """
+        self.transaction.upgrade()
+
+    def env_setup(self):
+        """
+        Scylla specific setup, returns the packages to install.
+        """
+        self.download_scylla_repo()
+        return [self.scylla_pkg()]
+
+    def write_golden_marker(self):
+        # the proxy of this run must not outlive it in the snapshot, the
+        # runs on top of it configure their own or none if it's unavailable
+        self.unconfigure_package_cache()
+        marker = {'time': time.time(), 'fingerprint': self.golden_fingerprint,
+                  'distro': host_facts().distro_key}
+        process.run("sudo mkdir -p {}".format(os.path.dirname(GOLDEN_MARKER)))
+        process.run("echo '{}' | sudo tee {}".format(json.dumps(marker), GOLDEN_MARKER), shell=True)
+
+    def run_stage(self, stage, func, *args, **kwargs):
+        """
+        Run an install stage, timed as a phase, unless the setup checkpoints
+        have it completed. Returns its result, the recorded one if skipped.
+
+        :param deferred: the stage work is only done by the next stage (the
+                         package transaction commit), record them together
+        """
+        deferred = kwargs.pop('deferred', False)
+        if self.checkpoints is not None and self.checkpoints.completed(stage, self.validate_stage):
+            self.log.info('Setup stage %s completed by an earlier run, skipping it', stage)
+            self.checkpoints.skip(stage)
+            return self.checkpoints.result(stage)
+        with self.timer.phase(stage):
+            result = func(*args)
+        if self.checkpoints is not None:
+            self.checkpoints.record(stage, result, deferred=deferred)
+        return result
+
+    def validate_stage(self, stage):
+        """
+        Quick check that a stage completed by an earlier run still holds.
+        Services and the install verification are always run again.
+        """
+        if stage == 'prereq_setup':
+            return True
+        if stage == 'env_setup':
+            return not self.sw_repo_dst or os.path.exists(self.sw_repo_dst)
+        if stage == 'install':
+            installed = self.checkpoints.result(stage) or {}
+            return package_version(installed.get('package') or self.scylla_pkg()) == installed.get('version')
+        if stage == 'scylla_setup':
+            return os.path.exists('/etc/scylla.d/io.conf')
+        return False
+
     def run(self):
-        wait.wait_for(self.sw_manager.upgrade, timeout=300, step=30,
-                      text="Wait until system is up to date...")
+        if self.package_cache:
+            self.package_cache.start_run()
+            self.configure_package_cache()
+        else:
+            # golden snapshots saved with the proxy of their run still have it
+            self.unconfigure_package_cache()
+        if self.install_phase == 'scylla' and not os.path.exists(GOLDEN_MARKER):
+            self.log.warning('Not a golden snapshot (%s missing), setting up the prerequisites', GOLDEN_MARKER)
+            self.install_phase = 'all'
+        if self.install_phase != 'scylla':
+            self.run_stage('prereq_setup', self.prereq_setup, deferred=True)
+        if self.install_phase == 'prereqs':
+            with self.timer.phase('install'):
+                self.transaction.commit()
+            if self.checkpoints is not None:
+                self.checkpoints.flush()
+            self.write_golden_marker()
+            return
         # setup software repo and other environment before install test packages
-        pkgs = self.env_setup()
+        pkgs = self.run_stage('env_setup', self.env_setup, deferred=True)
+        self.run_stage('install', self.install_packages, pkgs)
+        devlist = self.run_stage('scylla_setup', self.setup_scylla)
+        self.run_stage('start_services', self.srv_manager.start_services)
+        self.run_stage('wait_services_up', self.srv_manager.wait_services_up)
+        self.try_report_uuid()
+        self.run_stage('verify', self.verify_install, devlist)
+
+    def install_packages(self, pkgs):
+        """
+        Install pkgs, returns the installed scylla package and version.
+        """
+        self.transaction.install(*pkgs)
         # check install
         if self.uuid:
             version = self.version.replace('scylladb-', '')
             last_id = self.cvdb.get_last_id(self.uuid, self.repoid, self.version, table='housekeeping.repodownload', add_filter="and file_name like 'scylla%server%{}%'".format(version))
-        for pkg in pkgs:
-            if not self.sw_manager.install(pkg):
-                e_msg = ('Package %s could not be installed '
-                         '(see logs for details)' % os.path.basename(pkg))
-                raise InstallPackageError(e_msg)
+        self.transaction.commit()
         # check install
         if self.uuid:
             assert self.cvdb.check_new_record(self.uuid, self.repoid, self.version, last_id, table='housekeeping.repodownload', add_filter="and file_name like 'scylla%server%{}%'".format(version))
+        return {'package': self.scylla_pkg(), 'version': package_version(self.scylla_pkg())}
 
+    def setup_scylla(self):
+        """
+        Run scylla_setup, returns the disks given to it.
+        """
+        # scylla_setup was just installed
+        facts = refresh_host_facts('scylla_setup_options')
+        self.log.debug('Host NICs: %s, disks: %s', facts.nics, facts.disks)
+        setup_cmd = '/usr/lib/scylla/scylla_setup --nic %s' % (facts.nics[0] if facts.nics else '')
         # enable raid setup when second disk exists
-        result = process.run('ip -o link show', shell=True, verbose=True)
-        result = process.run('ip -o link show |grep ether |awk -F": " \'{print $2}\'', shell=True, verbose=True)
-        devname = result.stdout.strip()
-        setup_cmd = '/usr/lib/scylla/scylla_setup --nic %s' % devname
-        result = process.run('ls /dev/[hvs]db', shell=True, ignore_status=True)
-        devlist = result.stdout.split()
+        devlist = list(facts.disks)
 
         if devlist and not os.path.ismount('/var/lib/scylla'):
             setup_cmd += ' --disks %s' % devlist[-1]
@@ -357,9 +877,7 @@ class ScyllaInstallGeneric(object):
 
         # disable cpuscaling setup for known issue:
         # https://github.com/scylladb/scylla/issues/2051
-        with open('/usr/lib/scylla/scylla_setup', 'r') as f:
-            script_content = f.read()
-        if '--no-cpuscaling-setup' in script_content:
+        if '--no-cpuscaling-setup' in (facts.scylla_setup_options or ()):
             setup_cmd += ' --no-cpuscaling-setup'
         # check setup
         if self.uuid:
@@ -369,19 +887,18 @@ class ScyllaInstallGeneric(object):
         # check setup
         if self.uuid:
             assert self.cvdb.check_new_record_v2("select * from housekeeping.checkversion where repoid='{}' and ruid='{}' and version like '{}%' and statuscode='i'".format(self.repoid, self.uuid, version), last_id)
+        return devlist
 
-        self.srv_manager.start_services()
-        self.srv_manager.wait_services_up()
-        self.try_report_uuid()
-
+    def verify_install(self, devlist):
         # verify SELinux setup on Red Hat variants
-        detected_distro = distro.detect()
-        distro_name = detected_distro.name.lower()
-        distro_version = detected_distro.version
+        facts = host_facts()
+        distro_name = facts.distro_name.lower()
+        distro_version = facts.distro_version
         is_debian_variant = 'ubuntu' in distro_name or 'debian' in distro_name
         if not is_debian_variant:
-            result = process.run('getenforce')
-            assert 'Enforcing' not in result.stdout, "SELinux is still actived"
+            # scylla_setup changed it
+            facts = refresh_host_facts('selinux')
+            assert facts.selinux != 'Enforcing', "SELinux is still actived"
         # verify node_exporter install
         assert os.path.exists('/usr/bin/node_exporter'), "node_exporter isn't installed"
         # verify raid setup
@@ -422,28 +939,56 @@ class ScyllaInstallDebian(ScyllaInstallGeneric):
         super(ScyllaInstallDebian, self).__init__(sw_repo)
         self.sw_repo_dst = '/etc/apt/sources.list.d/scylla.list'
 
+    # extra apt-get arguments of the java 8 install, None when the distro doesn't need it
+    JAVA_ARGS = None
+
+    def configure_package_cache(self):
+        self.package_cache.configure_apt()
+
+    def unconfigure_package_cache(self):
+        if PackageCacheClient is not None:
+            PackageCacheClient.unconfigure_apt()
+
+    def prereq_setup(self):
+        self.prepare_extend_repo()
+        self.transaction.refresh()
+        if self.JAVA_ARGS is not None and self.install_phase == 'prereqs':
+            # a golden snapshot gets it whatever the scylla version, env_setup()
+            # doesn't have anything left to install then
+            self.install_java18(args=self.JAVA_ARGS, force=True)
+        self.transaction.upgrade()
+
+    def env_setup(self):
+        self.download_scylla_repo()
+        if self.JAVA_ARGS is not None:
+            self.install_java18(args=self.JAVA_ARGS)
+        return [self.scylla_pkg()]
+
     def prepare_extend_repo(self):
         process.run('sudo apt-get install software-properties-common -y', shell=True)
         process.run("sudo apt-key adv --keyserver keyserver.ubuntu.com --recv-keys {}".format(self.GPG_KEY))
         process.run('sudo add-apt-repository -y ppa:scylladb/ppa', shell=True)
+        self.transaction.repo_changed()
 
-    def install_java18(self, args=''):
+    def install_java18(self, args='', force=False):
         # fixme: update the version for enterprise in future when it requests java 1.8
-        result = process.run('sudo apt-cache show {}'.format(self.scylla_pkg()))
-        ver = re.findall("Version: ([\d.]+)", result.stdout)[0].strip('.')
-        request_ver = '2017.666' if self.is_enterprise else '1.7'
-        if parse_version(ver) < parse_version(request_ver):
-            self.log.info("Java 1.8 isn't requested by current version {}".format(ver))
-            return
-        process.run('sudo apt-get update')
-        process.run('sudo apt-get install -y openjdk-8-jre-headless {}'.format(args), shell=True)
-        process.run('sudo update-java-alternatives -s java-1.8.0-openjdk-amd64', shell=True)
+        if not force:
+            self.transaction.ensure_metadata()
+            result = process.run('sudo apt-cache show {}'.format(self.scylla_pkg()))
+            ver = re.findall("Version: ([\d.]+)", result.stdout)[0].strip('.')
+            request_ver = '2017.666' if self.is_enterprise else '1.7'
+            if parse_version(ver) < parse_version(request_ver):
+                self.log.info("Java 1.8 isn't requested by current version {}".format(ver))
+                return
+        self.transaction.install('openjdk-8-jre-headless', args=args)
+        self.transaction.run_after_install('sudo update-java-alternatives -s java-1.8.0-openjdk-amd64')
 
     def scylla_pkg(self):
         """
         Get package name, compat both of scylla and scylla-enterprise.
         """
         if self.is_enterprise is None:
+            self.transaction.ensure_metadata()
             result = process.run('sudo apt-cache search scylla-enterprise')
             self.is_enterprise = True if 'scylla-enterprise' in result.stdout else False
         return 'scylla-enterprise' if self.is_enterprise else 'scylla'
@@ -451,36 +996,26 @@ class ScyllaInstallDebian(ScyllaInstallGeneric):
 
 class ScyllaInstallUbuntu1404(ScyllaInstallDebian):
 
-    def env_setup(self):
-        self.download_scylla_repo()
-        self.prepare_extend_repo()
-        process.run('sudo apt-get update')
-        self.install_java18()
-        self.sw_manager.upgrade()
-        return [self.scylla_pkg()]
+    JAVA_ARGS = ''
 
+    def install_java18(self, args='', force=False):
+        super(ScyllaInstallUbuntu1404, self).install_java18(args=args, force=force)
+        # java 8 has to be installed and the default before the scylla packages
+        self.transaction.commit()
 
-class ScyllaInstallUbuntu1604(ScyllaInstallDebian):
 
-    def env_setup(self):
-        self.download_scylla_repo()
-        self.prepare_extend_repo()
-        process.run('sudo apt-get update')
-        self.sw_manager.upgrade()
-        return [self.scylla_pkg()]
+class ScyllaInstallUbuntu1604(ScyllaInstallDebian):
+    pass
 
 
 class ScyllaInstallUbuntu1804(ScyllaInstallDebian):
-
-    def env_setup(self):
-        self.download_scylla_repo()
-        self.prepare_extend_repo()
-        process.run('sudo apt-get update')
-        self.sw_manager.upgrade()
-        return [self.scylla_pkg()]
+    pass
 
 
 class ScyllaInstallDebian8(ScyllaInstallDebian):
+
+    JAVA_ARGS = ' -t jessie-backports'
+
     def __init__(self, sw_repo):
         process.run("sed -i -e 's/jessie-updates/stable-updates/g' /etc/apt/sources.list", shell=True)
         super(ScyllaInstallDebian8, self).__init__(sw_repo)
@@ -492,14 +1027,7 @@ class ScyllaInstallDebian8(ScyllaInstallDebian):
         process.run("apt-key adv --fetch-keys https://download.opensuse.org/repositories/home:/scylladb:/scylla-3rdparty-jessie/Debian_8.0/Release.key")
         process.run("sudo apt-key adv --keyserver keyserver.ubuntu.com --recv-keys {}".format(self.GPG_KEY))
         process.run("echo 'deb http://download.opensuse.org/repositories/home:/scylladb:/scylla-3rdparty-jessie/Debian_8.0/ /' > /etc/apt/sources.list.d/scylla-3rdparty.list", shell=True)
-
-    def env_setup(self):
-        self.download_scylla_repo()
-        self.prepare_extend_repo()
-        process.run('sudo apt-get update')
-        self.install_java18(args=' -t jessie-backports')
-        self.sw_manager.upgrade()
-        return [self.scylla_pkg()]
+        self.transaction.repo_changed()
 
 
 class ScyllaInstallDebian9(ScyllaInstallDebian):
@@ -508,13 +1036,7 @@ class ScyllaInstallDebian9(ScyllaInstallDebian):
         process.run("apt-key adv --fetch-keys https://download.opensuse.org/repositories/home:/scylladb:/scylla-3rdparty-stretch/Debian_9.0/Release.key")
         process.run("sudo apt-key adv --keyserver keyserver.ubuntu.com --recv-keys {}".format(self.GPG_KEY))
         process.run("echo 'deb http://download.opensuse.org/repositories/home:/scylladb:/scylla-3rdparty-stretch/Debian_9.0/ /' > /etc/apt/sources.list.d/scylla-3rdparty.list")
-
-    def env_setup(self):
-        self.download_scylla_repo()
-        self.prepare_extend_repo()
-        process.run('sudo apt-get update')
-        self.sw_manager.upgrade()
-        return [self.scylla_pkg()]
+        self.transaction.repo_changed()
 
 
 class ScyllaInstallDebian10(ScyllaInstallDebian):
@@ -523,13 +1045,7 @@ class ScyllaInstallDebian10(ScyllaInstallDebian):
         process.run("apt-key adv --fetch-keys https://download.opensuse.org/repositories/home:/scylladb:/scylla-3rdparty-buster/Debian_10.0/Release.key")
         process.run("sudo apt-key adv --keyserver keyserver.ubuntu.com --recv-keys {}".format(self.GPG_KEY))
         process.run("echo 'deb http://download.opensuse.org/repositories/home:/scylladb:/scylla-3rdparty-buster/Debian_10.0/ /' > /etc/apt/sources.list.d/scylla-3rdparty.list")
-
-    def env_setup(self):
-        self.download_scylla_repo()
-        self.prepare_extend_repo()
-        process.run('sudo apt-get update')
-        self.sw_manager.upgrade()
-        return [self.scylla_pkg()]
+        self.transaction.repo_changed()
 
 
 class ScyllaInstallFedora(ScyllaInstallGeneric):
@@ -538,13 +1054,16 @@ class ScyllaInstallFedora(ScyllaInstallGeneric):
         super(ScyllaInstallFedora, self).__init__(sw_repo)
         self.sw_repo_dst = '/etc/yum.repos.d/scylla.repo'
 
+    def configure_package_cache(self):
+        self.package_cache.configure_yum()
 
-class ScyllaInstallFedora22(ScyllaInstallFedora):
+    def unconfigure_package_cache(self):
+        if PackageCacheClient is not None:
+            PackageCacheClient.unconfigure_yum()
 
-    def env_setup(self):
-        self.download_scylla_repo()
-        self.sw_manager.upgrade()
-        return ['scylla']
+
+class ScyllaInstallFedora22(ScyllaInstallFedora):
+    pass
 
 
 class ScyllaInstallCentOS(ScyllaInstallGeneric):
@@ -553,6 +1072,13 @@ class ScyllaInstallCentOS(ScyllaInstallGeneric):
         super(ScyllaInstallCentOS, self).__init__(sw_repo)
         self.sw_repo_dst = '/etc/yum.repos.d/scylla.repo'
 
+    def configure_package_cache(self):
+        self.package_cache.configure_yum()
+
+    def unconfigure_package_cache(self):
+        if PackageCacheClient is not None:
+            PackageCacheClient.unconfigure_yum()
+
     def _centos_remove_system_packages(self):
         self.sw_manager.remove('boost-thread')
         self.sw_manager.remove('boost-system')
@@ -563,6 +1089,7 @@ class ScyllaInstallCentOS(ScyllaInstallGeneric):
         Get package name, compat both of scylla and scylla-enterprise.
         """
         if self.is_enterprise is None:
+            self.transaction.ensure_metadata()
             result = process.run('sudo yum search scylla-enterprise')
             self.is_enterprise = True if 'scylla-enterprise.x86_64' in result.stdout else False
         return 'scylla-enterprise' if self.is_enterprise else 'scylla'
@@ -570,11 +1097,9 @@ class ScyllaInstallCentOS(ScyllaInstallGeneric):
 
 class ScyllaInstallCentOS7(ScyllaInstallCentOS):
 
-    def env_setup(self):
+    def prereq_setup(self):
         self._centos_remove_system_packages()
-        self.download_scylla_repo()
-        self.sw_manager.upgrade()
-        return [self.scylla_pkg()]
+        self.transaction.upgrade()
 
 
 class ScyllaInstallAMI(ScyllaInstallGeneric):
@@ -677,17 +1202,67 @@ class ScyllaArtifactSanity(Test):
     1) Run cassandra-stress
     2) Run nodetool
     """
-    setup_done_file = None
+    checkpoints = None
     srv_manager = ScyllaServiceManager()
     cvdb = None
     uuid = None
     repoid = None
     version = None
+    _threshold_scopes = None
 
     def get_setup_file_done(self):
         tmpdir = os.path.dirname(self.workdir)
         return os.path.join(tmpdir, 'scylla-setup-done')
 
+    def get_setup_checkpoints(self):
+        """
+        Checkpoints of the setup stages, in the job tmp dir unless
+        setup_checkpoints has them resume across jobs. None without
+        setup_checkpoints.py.
+        """
+        if SetupCheckpoints is None:
+            return None
+        checkpoints_path = (self.params.get('setup_checkpoints', default='') or
+                            os.path.join(os.path.dirname(self.workdir), 'scylla-setup-checkpoints.json'))
+        inputs = {'distro': host_facts().distro_key,
+                  'sw_repo': self.sw_repo, 'version': self.version,
+                  'ami': self.params.get('ami', default=False) is True}
+        return SetupCheckpoints(checkpoints_path, inputs)
+
+    def setup_finished(self):
+        if self.checkpoints is None:
+            return os.path.isfile(self.get_setup_file_done())
+        return self.checkpoints.is_finished()
+
+    def validate_setup(self):
+        """
+        Quick check of a setup finished by an earlier test or run: the
+        scylla package it installed is still the installed one, and the
+        latest of the repo when that run was another job, otherwise the
+        install runs again. Then scylla must answer CQL queries, otherwise
+        the services stages run again.
+        """
+        installed = self.checkpoints.result('install')
+        if installed:
+            version = package_version(installed['package'])
+            if version != installed['version']:
+                self.log.warning('Reused setup installed %s %s, %s is installed now, installing again',
+                                 installed['package'], installed['version'], version)
+                self.checkpoints.invalidate('install')
+                return False
+            if (self.checkpoints.finished.get('job') != getattr(self.job, 'unique_id', None) and
+                    package_upgradable(installed['package'])):
+                self.log.warning('The repo has a newer build than the %s %s of the reused setup, installing again',
+                                 installed['package'], version)
+                self.checkpoints.invalidate('install')
+                return False
+        if self.srv_manager.services_up():
+            return True
+        self.log.warning('Reused setup does not answer CQL (%s), starting the services again',
+                         self.srv_manager.probe_error)
+        self.checkpoints.invalidate('start_services')
+        return False
+
     def scylla_setup(self):
         global TEST_PARAMS
         # Let's start the logs thread before package install
@@ -697,7 +1272,7 @@ class ScyllaArtifactSanity(Test):
         ami = self.params.get('ami', default=False) is True
         TEST_PARAMS = self.params
 
-        detected_distro = distro.detect()
+        detected_distro = host_facts().distro
         fedora_22 = (detected_distro.name.lower() == 'fedora' and
                      detected_distro.version == '22')
         ubuntu_14_04 = (detected_distro.name.lower() == 'ubuntu' and
@@ -754,11 +1329,44 @@ class ScyllaArtifactSanity(Test):
         installer.uuid = self.uuid
         installer.repoid = self.repoid
         installer.version = self.version
+        installer.install_phase = self.install_phase
+        installer.timer = self.timer
+        installer.srv_manager = self.srv_manager
+        installer.golden_fingerprint = self.params.get('golden_fingerprint', default=None)
+        installer.checkpoints = self.checkpoints
+        cache_url = self.params.get('package_cache', default='')
+        if cache_url and PackageCacheClient is not None and not ami:
+            package_cache = PackageCacheClient(cache_url)
+            if package_cache.available():
+                installer.package_cache = package_cache
 
-        installer.run()
-        os.mknod(self.get_setup_file_done())
+        try:
+            installer.run()
+        finally:
+            if self.checkpoints is not None:
+                with open(os.path.join(self.outputdir, 'setup-checkpoints.json'), 'w') as report:
+                    json.dump(self.checkpoints.report(), report, indent=2, sort_keys=True)
+            transaction = getattr(installer, 'transaction', None)
+            if transaction is not None:
+                with open(os.path.join(self.outputdir, 'package-transaction.json'), 'w') as report:
+                    json.dump(transaction.report(), report, indent=2, sort_keys=True)
+            if installer.package_cache:
+                cache_report = installer.package_cache.run_report()
+                self.log.info('Package cache: %s', json.dumps(cache_report, sort_keys=True))
+                with open(os.path.join(self.outputdir, 'package-cache.json'), 'w') as report:
+                    json.dump(cache_report, report, indent=2, sort_keys=True)
+        if self.install_phase != 'prereqs':
+            if self.checkpoints is not None:
+                self.checkpoints.finish(job=getattr(self.job, 'unique_id', None))
+            else:
+                os.mknod(self.get_setup_file_done())
 
     def setUp(self):
+        self.timer = PhaseTimer()
+        self.timer.instrument(process)
+        if default_signatures is not None:
+            # from the data dir copied to the VM with this test
+            default_signatures(os.path.join(self.datadir or '', 'failure_signatures.yaml'))
         if self.params.get('host') and self.params.get('user') and self.params.get('passwd'):
             self.cvdb = CheckVersionDB(self.params.get('host'),
                                        self.params.get('user'),
@@ -768,31 +1376,233 @@ class ScyllaArtifactSanity(Test):
         if priv_repo_flag:
             self.uuid, self.repoid, self.version = priv_repo_flag[0].split('/')
             assert self.cvdb, 'check version db must be connected for private repo'
-        if not os.path.isfile(self.get_setup_file_done()):
-            self.scylla_setup()
+        # 'prereqs' only sets up a golden snapshot, 'scylla' runs on top of one
+        self.install_phase = self.params.get('install_phase', default='all')
+        with self.timer.phase('host_facts'):
+            host_facts()
+        self.checkpoints = self.get_setup_checkpoints()
+        if self.checkpoints is not None and self.checkpoints.is_finished():
+            with self.timer.phase('validate_setup'):
+                self.validate_setup()
+        if not self.setup_finished():
+            with self.timer.phase('setup'):
+                self.scylla_setup()
+        if self.install_phase == 'prereqs':
+            self.skip('Golden snapshot prerequisites are set up, nothing to test')
+
+    def tearDown(self):
+        self.timer.restore()
+        self.report_phase_timing()
+        with open(os.path.join(self.outputdir, 'host-facts.json'), 'w') as report:
+            json.dump(host_facts().to_dict(), report, indent=2, sort_keys=True)
+        if self.srv_manager.readiness:
+            with open(os.path.join(self.outputdir, 'cql-readiness.json'), 'w') as report:
+                json.dump(self.srv_manager.readiness, report, indent=2, sort_keys=True)
+            del self.srv_manager.readiness[:]
+
+    def report_phase_timing(self):
+        """
+        Save the phase timeline (phase-timeline.json) and folded stacks for
+        flamegraph.pl (phase-flame.txt), record the phases in the history and
+        warn about the ones slower than their rolling baseline.
+        """
+        phases = self.timer.aggregate()
+        if not phases:
+            return
+        self.log.info('Phase timing:\n%s', self.timer.summary())
+        slow = []
+        db_path = self.params.get('phase_history', default='')
+        if db_path:
+            distro_key = host_facts().distro_key
+            history = PhaseHistory(db_path)
+            try:
+                slow = history.check_and_record('%s.%s' % (type(self).__name__, self._testMethodName),
+                                                self.version or self.sw_repo or 'unknown', distro_key, phases,
+                                                tolerance=self.params.get('phase_slow_tolerance', default=0.5),
+                                                runs=self.params.get('phase_baseline_runs', default=5))
+            finally:
+                history.close()
+        for phase in slow:
+            self.log.warning('Slow phase %(path)s: %(wall)ss, baseline %(baseline)ss', phase)
+        with open(os.path.join(self.outputdir, 'phase-timeline.json'), 'w') as report:
+            json.dump({'events': self.timer.timeline(), 'phases': phases, 'slow_phases': slow},
+                      report, indent=2, sort_keys=True)
+        with open(os.path.join(self.outputdir, 'phase-flame.txt'), 'w') as report:
+            report.write(self.timer.folded())
+
+    def run_scanned(self, name, cmd, categories, **kwargs):
+        """
+        Run cmd matching its output against the failure signatures while it
+        runs, fail the test right away on a fatal match. The matches are
+        saved to failure-signatures-<name>.json in the test output dir.
+        """
+        scanner = signature_scanner(name, categories)
+        if scanner is None:
+            return process.run(cmd, **kwargs)
+        try:
+            return run_scanned(cmd, scanner, **kwargs)
+        except FatalSignatureError as details:
+            self.fail('%s' % details)
+        finally:
+            if scanner.matches:
+                with open(os.path.join(self.outputdir, 'failure-signatures-%s.json' % name), 'w') as report:
+                    json.dump(scanner.report(), report, indent=2, sort_keys=True)
 
     def run_cassandra_stress(self):
-        def check_output(result):
-            output = result.stdout + result.stderr
-            lines = output.splitlines()
-            for line in lines:
-                if 'java.io.IOException' in line:
-                    self.fail('cassandra-stress: %s' % line.strip())
+        with self.timer.phase('cassandra_stress'):
+            self._run_cassandra_stress()
+
+    def _run_cassandra_stress(self):
+        if self.params.get('load_generator', default='cassandra-stress') == 'driver' and run_load is not None:
+            self._run_driver_load()
+            return
         cassandra_stress_exec = path.find_command('cassandra-stress')
+        hdr_log = self.params.get('stress_hdr_log', default=True) and parse_hdr_log is not None
         stress_populate = ('%s write n=10000 -mode cql3 native -pop seq=1..10000' %
                            cassandra_stress_exec)
-        result_populate = process.run(stress_populate, timeout=600)
-        check_output(result_populate)
+        if hdr_log:
+            stress_populate += ' -log hdrfile=%s' % os.path.join(self.outputdir, 'stress-populate.hdr')
+        result_populate = self.run_scanned('stress-populate', stress_populate, 'stress', timeout=600)
         stress_mixed = ('%s mixed duration=1m -mode cql3 native '
                         '-rate threads=10 -pop seq=1..10000' %
                         cassandra_stress_exec)
-        result_mixed = process.run(stress_mixed, shell=True, timeout=300)
-        check_output(result_mixed)
+        if hdr_log:
+            stress_mixed += ' -log hdrfile=%s' % os.path.join(self.outputdir, 'stress-mixed.hdr')
+        result_mixed = self.run_scanned('stress-mixed', stress_mixed, 'stress', shell=True, timeout=300)
+        populate_histogram = self.stress_latency('populate', 0) if hdr_log else None
+        mixed_histogram = self.stress_latency('mixed', 10) if hdr_log else None
+        if PerfHistory is not None:
+            self.check_stress_results([('populate', parse_stress_output(result_populate.stdout).summary,
+                                        populate_histogram),
+                                       ('mixed', parse_stress_output(result_mixed.stdout).summary, mixed_histogram)])
+
+    def stress_latency(self, name, threads):
+        """
+        Latency report of the histogram log of the cassandra-stress run name,
+        corrected for coordinated omission when it ran with a fixed number of
+        threads. Returns the service time histogram.
+        """
+        hdr_path = os.path.join(self.outputdir, 'stress-%s.hdr' % name)
+        if not os.path.exists(hdr_path):
+            self.log.warning('cassandra-stress %s wrote no histogram log', name)
+            return None
+        with open(hdr_path) as hdr_file:
+            hdr_log = parse_hdr_log(hdr_file.read())
+        with open(os.path.join(self.outputdir, 'stress-%s-latency.json' % name), 'w') as report:
+            json.dump(hdr_log.report(threads), report, indent=2, sort_keys=True)
+        return hdr_log.kind('st') or hdr_log.kind('')
+
+    def _run_driver_load(self):
+        """
+        The cassandra-stress runs, with the load generator of load_generator.py.
+        """
+        processes = self.params.get('load_processes', default=1)
+        runs = []
+        for name, opt, sub_opt in (('populate', 'write', 'n=10000 -pop seq=1..10000'),
+                                   ('mixed', 'mixed', 'duration=1m -rate threads=10 -pop seq=1..10000')):
+            result = run_load(['localhost'], opt, processes=processes, **stress_options(sub_opt))
+            with open(os.path.join(self.outputdir, 'load-%s.json' % name), 'w') as report:
+                json.dump(result.to_dict(), report, indent=2, sort_keys=True)
+            if result.errors:
+                self.fail('%s load: %s of %s requests failed, first error: %s' %
+                          (name, result.errors, result.ops + result.errors, result.first_error))
+            runs.append((name, result.summary, result.histogram))
+        if PerfHistory is not None:
+            self.check_stress_results(runs)
+
+    def check_stress_results(self, runs):
+        """
+        Check the stress runs, [(name, summary, latency histogram)], against
+        the stress_thresholds and the performance history. Fails with the
+        expected versus observed values of the runs out of their thresholds.
+        """
+        diffs = [self.check_stress_thresholds(name, summary) for name, summary, _ in runs]
+        for name, summary, histogram in runs:
+            self.check_stress_perf(name, summary, histogram)
+        diffs = [diff for diff in diffs if diff]
+        if diffs:
+            self.fail('cassandra-stress results out of thresholds (%s):\n%s' %
+                      (', '.join(self.threshold_scopes()), '\n'.join(diffs)))
+
+    def threshold_scopes(self):
+        """
+        Scopes of the stress_thresholds of this host, from the least to the
+        most specific one: distro name, <name>-<version>, instance type.
+        """
+        if self._threshold_scopes is None:
+            facts = host_facts()
+            name = facts.distro_name.lower()
+            scopes = [name, '%s-%s' % (name, facts.distro_version)]
+            instance_type = self.params.get('instance_type', default='')
+            if not instance_type and self.params.get('ami', default=False) is True:
+                result = process.run('curl -s --max-time 5 http://169.254.169.254/latest/meta-data/instance-type',
+                                     ignore_status=True)
+                instance_type = result.stdout.strip() if not result.exit_status else ''
+            if instance_type:
+                scopes.append(instance_type)
+            self._threshold_scopes = scopes
+        return self._threshold_scopes
+
+    def check_stress_thresholds(self, name, summary):
+        """
+        Compare the summary of stress run name with its thresholds, save the
+        comparison to stress-<name>-thresholds.json.
+
+        :return: the expected versus observed diff when a threshold is
+                 exceeded, else an empty string
+        """
+        thresholds = StressThresholds.from_rules(self.params.get('stress_thresholds', default=[]))
+        results = thresholds.check(name, summary, self.threshold_scopes())
+        if not results:
+            return ''
+        with open(os.path.join(self.outputdir, 'stress-%s-thresholds.json' % name), 'w') as report:
+            json.dump({'scopes': self.threshold_scopes(), 'summary': summary, 'thresholds': results}, report,
+                      indent=2, sort_keys=True)
+        if all(result['ok'] for result in results):
+            return ''
+        return format_diff(name, results)
+
+    def check_stress_perf(self, name, summary, histogram=None):
+        """
+        Record the stress summary in the performance history and fail on a
+        regression against the rolling baseline of the same distro. The
+        latency histogram is kept in the history too, the latencies of the
+        baseline runs merged with it go to stress-<name>-latency-history.json.
+        """
+        db_path = self.params.get('perf_history', default='')
+        if not db_path or PerfHistory is None:
+            return
+        if not summary:
+            self.log.warning('No cassandra-stress results found in %s output', name)
+            return
+        distro_key = host_facts().distro_key
+        history = PerfHistory(db_path)
+        test = '%s.%s:%s' % (type(self).__name__, self._testMethodName, name)
+        runs = self.params.get('perf_baseline_runs', default=5)
+        try:
+            regressions = history.check_and_record(test, self.version or self.sw_repo or 'unknown', distro_key,
+                                                   summary, tolerance=self.params.get('perf_tolerance', default=0.15),
+                                                   runs=runs, histograms={'latency': histogram} if histogram else None)
+            if histogram:
+                merged = history.merged_histogram(test, distro_key, 'latency', runs=runs)
+                with open(os.path.join(self.outputdir, 'stress-%s-latency-history.json' % name), 'w') as report:
+                    json.dump({'runs': runs, 'count': merged.total, 'latency': merged.summary()}, report,
+                              indent=2, sort_keys=True)
+        finally:
+            history.close()
+        if regressions and self.params.get('perf_gate', default=True):
+            self.fail('cassandra-stress %s performance regression: %s' % (name, '; '.join(regressions)))
+        for regression in regressions:
+            self.log.warning('cassandra-stress %s performance regression: %s', name, regression)
 
     def run_nodetool(self):
         nodetool_exec = path.find_command('nodetool')
         nodetool = '%s status' % nodetool_exec
-        process.run(nodetool)
+        result = process.run(nodetool)
+        if RingStatus is not None:
+            ring = RingStatus.from_nodetool(result.stdout)
+            if not ring.endpoints('UN'):
+                self.fail('nodetool status reports no UN node: %s' % ring.to_dict())
 
     def test_after_install(self):
         self.run_nodetool()
@@ -802,9 +1612,12 @@ class ScyllaArtifactSanity(Test):
                       ",".join(SCRIPTLET_FAILURE_LIST))
 
     def test_after_stop_start(self):
-        self.srv_manager.stop_services()
-        self.srv_manager.start_services()
-        self.srv_manager.wait_services_up()
+        with self.timer.phase('stop_services'):
+            self.srv_manager.stop_services()
+        with self.timer.phase('start_services'):
+            self.srv_manager.start_services()
+        with self.timer.phase('wait_services_up'):
+            self.srv_manager.wait_services_up()
         self.run_nodetool()
         self.run_cassandra_stress()
 
@@ -813,8 +1626,10 @@ class ScyllaArtifactSanity(Test):
         if self.uuid:
             version = self.version.replace('scylladb-', '')
             last_id = self.cvdb.get_last_id_v2("select * from housekeeping.checkversion where ruid='{}' and repoid='{}' and version like '{}%' and statuscode='r'".format(self.uuid, self.repoid, version))
-        self.srv_manager.restart_services()
-        self.srv_manager.wait_services_up()
+        with self.timer.phase('restart_services'):
+            self.srv_manager.restart_services()
+        with self.timer.phase('wait_services_up'):
+            self.srv_manager.wait_services_up()
         # check restart
         if self.uuid:
             assert self.cvdb.check_new_record_v2("select * from housekeeping.checkversion where ruid='{}' and repoid='{}' and version like '{}%' and statuscode='r'".format(self.uuid, self.repoid, version), last_id)
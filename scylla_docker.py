@@ -1,12 +1,34 @@
 #!/usr/bin/python
 
+import os
+import re
 import json
 import time
+import fcntl
+import contextlib
+import shlex
+import signal
+import socket
 import logging
+import threading
+import subprocess
+import collections
+from multiprocessing.pool import ThreadPool
 from avocado import Test
 from avocado.utils import process
 from avocado import main
 
+from cql_probe import Backoff, CQLProbeError, probe_cql
+from docker_api import DockerAPIClient, DockerAPIError, DEFAULT_SOCKET
+from docker_registry import RegistryError, registry_digest
+from failure_signatures import FatalSignatureError, default_signatures
+from latency_histogram import HdrLog, parse_hdr_log
+from load_generator import run_load, stress_options
+from perf_history import PerfHistory
+from scylla_rest import ring_status
+from resource_profile import plan_profiles
+from stress_results import StressStalledError, StressStreamParser, merge_stress_results, parse_stress_output
+
 log = logging.getLogger('scylla_docker')
 
 
@@ -18,22 +40,126 @@ class DockerContainerNotExists(Exception):
     pass
 
 
+class ReadinessResult(object):
+    """
+    Outcome of ScyllaDocker.wait_for_ready(), true when the cluster is usable.
+
+    nodes maps each ready node to its time to ready, in seconds.
+    """
+
+    def __init__(self, nodes):
+        self.expected = list(nodes)
+        self.nodes = dict()
+        self.probes = 0
+        self.ready = False
+        self.start = time.time()
+        self.time_to_ready = None
+
+    def finish(self, ready):
+        self.ready = ready
+        self.time_to_ready = round(time.time() - self.start, 3) if ready else None
+
+    def __nonzero__(self):
+        return self.ready
+
+    def to_dict(self):
+        return {'ready': self.ready, 'time_to_ready': self.time_to_ready, 'nodes': self.nodes,
+                'not_ready': sorted(set(self.expected) - set(self.nodes)), 'probes': self.probes}
+
+
 class ScyllaDocker(object):
     """
     Implements methods for deploying scylla with docker
+
+    Clusters with different `name_prefix` are isolated: their containers are
+    named '<prefix>node<N>' and attached to their own network, '<prefix>net'
+    unless `network` says otherwise, so several can run on one host.
     """
 
     def __init__(self, *args, **kwargs):
         self._image = kwargs.get('image', 'scylladb/scylla-nightly')
         self._node_cnt = kwargs.get('node_cnt', 1)
-        self._seed_name = 'node1'
+        self._prefix = kwargs.get('name_prefix', '')
+        self._network = kwargs.get('network') or ('{}net'.format(self._prefix) if self._prefix else None)
+        self._seed_name = self._node_name(1)
         self._nodes = list()
-        self._start_timeout = kwargs.get('start_timeout', 30)
+        self._provision_workers = kwargs.get('provision_workers', 1)
+        self._create_start = None
+        self._timeline = dict()
+        self._state = dict()
+        self._state_lock = threading.Lock()
+        self._events_thread = None
+        self._events_proc = None
+        self._events_cond = threading.Condition()
+        self._events_seen = 0
+        self._ready_timeout = kwargs.get('ready_timeout', 120)
+        self.readiness = None
+        self.last_stress = None
+        self.last_load = None
+        self.last_distributed_stress = dict()
+        # cassandra-stress HdrHistogram logs (-log hdrfile=) of the last runs
+        self._hdr_log = kwargs.get('hdr_log', False)
+        self.last_hdr_log = None
+        self.last_distributed_hdr_logs = dict()
+        self.image_update = None
+        self._registry_scheme = kwargs.get('registry_scheme')
+        self._loaders = list()
+        self._resources = kwargs.get('resources')
+        self._profiles = None
+        self._signatures = kwargs.get('signatures')
+        self.signature_scanners = list()
 
     @property
     def nodes(self):
         return self._nodes
 
+    @property
+    def profiles(self):
+        """
+        ResourceProfile of every node, planned from the host topology when
+        the `resources` kwarg (plan_profiles() arguments) is set, else empty.
+        """
+        if self._profiles is None:
+            self._profiles = dict()
+            if self._resources is not None:
+                names = [self._node_name(i) for i in range(1, self._node_cnt + 1)]
+                self._profiles = dict(zip(names, plan_profiles(self._node_cnt, **self._resources)))
+        return self._profiles
+
+    @property
+    def signatures(self):
+        if self._signatures is None:
+            self._signatures = default_signatures()
+        return self._signatures
+
+    def _scan_lines(self, lines, source, categories):
+        """
+        Pass lines through, matching them against the failure signatures.
+        Raise FatalSignatureError on a fatal match, the caller closing the
+        lines generator stops the command.
+        """
+        scanner = self.signatures.scanner(source, categories)
+        self.signature_scanners.append(scanner)
+        for line in lines:
+            scanner.feed_line(line.rstrip('\n'))
+            scanner.check()
+            yield line
+
+    def profiles_dict(self):
+        return dict((node, profile.to_dict()) for node, profile in self.profiles.items())
+
+    @property
+    def timeline(self):
+        """
+        Per-node startup timeline, seconds since create_cluster() began.
+
+        Example: {'node2': {'create': 1.2, 'running': 1.9, 'UN': 41.0, 'CQL': 43.5}}
+        """
+        return self._timeline
+
+    def _mark(self, node, event):
+        self._timeline.setdefault(node, dict())[event] = round(time.time() - self._create_start, 3)
+
     @staticmethod
     def _cmd(cmd, timeout=10, sudo=False):
         res = process.run('docker {}'.format(cmd), ignore_status=True, timeout=timeout, sudo=sudo)
@@ -43,101 +169,440 @@ class ScyllaDocker(object):
             raise DockerCommandError('command: {}, error: {}, output: {}'.format(cmd, res.stderr, res.stdout))
         return res.stdout
 
+    def _exec(self, node, cmd, timeout=10, sudo=False):
+        return self._cmd('exec {} {}'.format(node, cmd), timeout=timeout, sudo=sudo)
+
+    def _exec_lines(self, node, cmd, timeout=60):
+        """
+        Yield output lines of cmd while it runs, closing the generator early
+        kills the command.
+        """
+        proc = subprocess.Popen(['docker', 'exec', node] + shlex.split(cmd), stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+        def kill():
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        tail = collections.deque(maxlen=20)
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                tail.append(line)
+                yield line
+            proc.wait()
+        finally:
+            timer.cancel()
+            if proc.poll() is None:
+                kill()
+                proc.wait()
+        if proc.returncode:
+            output = ''.join(tail)
+            if 'No such container:' in output:
+                raise DockerContainerNotExists(output)
+            raise DockerCommandError('command: exec {} {}, exit status: {}, output: {}'.format(
+                node, cmd, proc.returncode, output))
+
     def clean_old_images(self):
         images = self._cmd('images -f "dangling=true" -q')
         if images:
             images_str = ' '.join(images.split())
             self._cmd('rmi {}'.format(images_str), timeout=90)
 
+    def local_image_digests(self):
+        try:
+            out = self._cmd("image inspect --format='{{{{json .RepoDigests}}}}' {}".format(self._image))
+        except DockerCommandError as ex:
+            log.debug('no local image: %s', ex)
+            return []
+        return [digest.split('@', 1)[1] for digest in json.loads(out) if '@' in digest]
+
+    def _pull_image(self):
+        self._cmd('pull {}'.format(self._image), timeout=600)
+
     def update_image(self):
+        """
+        Pull the image unless the local copy already has the digest the
+        registry serves for its tag, prune dangling images only when the
+        pull brought something new.
+
+        :return: dict with the digests compared, and the pull time if pulled
+        """
         log.debug('update scylla image')
-        self._cmd('pull {}'.format(self._image), timeout=600)
+        info = {'image': self._image, 'local_digests': self.local_image_digests(), 'registry_digest': None,
+                'pulled': False, 'pull_time': None, 'pruned': False}
         try:
-            self.clean_old_images()
+            info['registry_digest'] = registry_digest(self._image, scheme=self._registry_scheme)
+        except (RegistryError, IOError, ValueError) as ex:
+            log.debug('registry digest lookup failed, pull anyway: %s', ex)
+        if info['registry_digest'] is not None and info['registry_digest'] in info['local_digests']:
+            log.debug('image %s is up to date (%s)', self._image, info['registry_digest'])
+        else:
+            start = time.time()
+            self._pull_image()
+            info['pull_time'] = round(time.time() - start, 3)
+            info['pulled'] = True
+            if self.local_image_digests() != info['local_digests']:
+                try:
+                    self.clean_old_images()
+                    info['pruned'] = True
+                except Exception as ex:
+                    log.debug(ex)
+        self.image_update = info
+        return info
+
+    def _inspect_nodes(self, nodes):
+        """
+        Inspect all nodes with one call, return {name: {'ip', 'running', 'health'}}
+        """
+        state = dict()
+        for info in json.loads(self._cmd('inspect {}'.format(' '.join(nodes)))):
+            health = info['State'].get('Health')
+            networks = info['NetworkSettings'].get('Networks') or {}
+            ip = info['NetworkSettings']['IPAddress']
+            if self._network in networks:
+                ip = networks[self._network]['IPAddress']
+            state[info['Name'].lstrip('/')] = {'ip': ip,
+                                               'running': info['State']['Running'],
+                                               'health': health['Status'] if health else None}
+        return state
+
+    def node_state(self, node):
+        """
+        Cached state of node. All cluster nodes are refreshed by one batched
+        inspect, the cache is invalidated by lifecycle operations and docker
+        events (see watch_events()).
+        """
+        with self._state_lock:
+            if node not in self._state:
+                try:
+                    self._state.update(self._inspect_nodes(sorted(set(self.nodes + [node]))))
+                except (DockerCommandError, DockerContainerNotExists):
+                    # some cluster node is gone, don't let it hide the requested one
+                    self._state.update(self._inspect_nodes([node]))
+            return self._state[node]
+
+    def invalidate_state(self, node=None):
+        with self._state_lock:
+            if node is None:
+                self._state.clear()
+            else:
+                self._state.pop(node, None)
+
+    def _open_events(self):
+        return subprocess.Popen(['docker', 'events', '--format', '{{json .}}', '--filter', 'type=container'],
+                                stdout=subprocess.PIPE)
+
+    def _events(self, stream):
+        """
+        Yield the container events of stream as dicts until it's closed.
+        """
+        for line in iter(stream.stdout.readline, ''):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+    def _on_event(self, event):
+        node = event.get('Actor', {}).get('Attributes', {}).get('name')
+        if node:
+            log.debug('docker event: %s %s', node, event.get('Action', event.get('status')))
+            self.invalidate_state(node)
+            with self._events_cond:
+                self._events_seen += 1
+                self._events_cond.notify_all()
+
+    def _wait_change(self, backoff):
+        """
+        Sleep for the next backoff delay, wake up early on a docker event.
+        """
+        with self._events_cond:
+            seen = self._events_seen
+            self._events_cond.wait(backoff.next())
+            if self._events_seen != seen:
+                backoff.reset()
+
+    def _follow_events(self, stream):
+        try:
+            for event in self._events(stream):
+                self._on_event(event)
         except Exception as ex:
-            log.debug(ex)
+            log.debug('docker events stream closed: %s', ex)
+        # without events, lifecycle operations are the only invalidation
+        # source, be conservative about anything cached meanwhile
+        self.invalidate_state()
+
+    def watch_events(self):
+        if self._events_thread is None or not self._events_thread.is_alive():
+            # opened before the operations it reports on, and before
+            # stop_watching_events() can look for it
+            try:
+                self._events_proc = self._open_events()
+            except Exception as ex:
+                log.debug('docker events unavailable: %s', ex)
+                return
+            self._events_thread = threading.Thread(target=self._follow_events, args=(self._events_proc,),
+                                                   name='docker-events')
+            self._events_thread.daemon = True
+            self._events_thread.start()
+
+    def stop_watching_events(self):
+        if self._events_proc is not None and self._events_proc.poll() is None:
+            self._events_proc.terminate()
+            self._events_proc.wait()
+        self._events_proc = None
 
     def get_node_ip(self, node_name):
-        out = self._cmd("inspect --format='{{{{ .NetworkSettings.IPAddress }}}}' {}".format(node_name))
-        return out.strip()
+        return self.node_state(node_name)['ip']
 
     def node_status(self, node):
-        out = self._cmd("inspect --format='{{{{json .State.Running}}}}' {}".format(node))
-        return json.loads(out)
+        return self.node_state(node)['running']
+
+    def _container_action(self, action, node, timeout=10):
+        """
+        :param timeout: for stop and restart, the seconds scylla gets to shut
+                        down before it's killed, like 'docker stop -t'
+        """
+        if action in ('stop', 'restart'):
+            self._cmd('{} -t {} {}'.format(action, timeout, node), timeout=timeout + 30)
+        else:
+            self._cmd('{} {}'.format(action, node), timeout=timeout)
 
     def start_node(self, node):
-        self._cmd('start {}'.format(node))
+        self._container_action('start', node)
+        self.invalidate_state(node)
 
     def stop_node(self, node):
-        self._cmd('stop {}'.format(node), timeout=30)
+        self._container_action('stop', node, timeout=30)
+        self.invalidate_state(node)
 
     def restart_node(self, node):
-        self._cmd('restart {}'.format(node), timeout=30)
+        self._container_action('restart', node, timeout=30)
+        self.invalidate_state(node)
 
     def remove_node(self, node):
-        self._cmd('rm {}'.format(node))
+        self._container_action('rm', node)
+        self.invalidate_state(node)
+
+    def _node_name(self, idx):
+        return '{}node{}'.format(self._prefix, idx)
+
+    def create_network(self):
+        if self._network is None:
+            return
+        try:
+            self._cmd('network create {}'.format(self._network))
+        except DockerCommandError as ex:
+            if 'already exists' not in str(ex):
+                raise
+
+    def remove_network(self):
+        if self._network is None:
+            return
+        try:
+            self._cmd('network rm {}'.format(self._network))
+        except DockerCommandError as ex:
+            log.debug('failed to remove network %s: %s', self._network, ex)
+
+    def _docker_run(self, node_name, seed_ip=None):
+        seeds = ' --seeds="{}"'.format(seed_ip) if seed_ip else ''
+        profile = self.profiles.get(node_name)
+        docker_args = ''.join(' ' + arg for arg in profile.docker_args()) if profile else ''
+        scylla_args = ''.join(' ' + arg for arg in profile.scylla_args()) if profile else ''
+        if self._network:
+            docker_args += ' --network {}'.format(self._network)
+        self._cmd('run --name {}{} -d {} --api-address 0.0.0.0{}{}'.format(
+            node_name, docker_args, self._image, scylla_args, seeds))
+
+    def _docker_run_loader(self, name):
+        network = ' --network {}'.format(self._network) if self._network else ''
+        self._cmd('run --name {}{} -d --entrypoint sleep {} infinity'.format(name, network, self._image))
+
+    def create_loaders(self, loader_cnt):
+        """
+        Start dedicated loader containers (the scylla image, idle), so stress
+        doesn't compete with scylla for the node containers' CPUs.
+        """
+        for i in range(len(self._loaders) + 1, len(self._loaders) + loader_cnt + 1):
+            name = '{}loader{}'.format(self._prefix, i)
+            self._docker_run_loader(name)
+            self._loaders.append(name)
+        return self._loaders
+
+    def remove_loaders(self):
+        for loader in self._loaders:
+            self.stop_node(loader)
+            self.remove_node(loader)
+        self._loaders = list()
+
+    def _run_node(self, node_name, seed_ip=None):
+        self._docker_run(node_name, seed_ip)
+        self.invalidate_state(node_name)
+        self._mark(node_name, 'create')
 
     def create_cluster(self):
         log.debug('create cluster')
-        self._cmd('run --name {} -d {}'.format(self._seed_name, self._image))
+        self._create_start = time.time()
+        self._timeline = dict()
+        self.watch_events()
+        self.create_network()
+        self._run_node(self._seed_name)
         self.nodes.append(self._seed_name)
+        if self._provision_workers > 1:
+            return self._create_cluster_parallel()
         if self._node_cnt > 1:
             seed_ip = self.get_node_ip(self._seed_name)
             for i in range(2, self._node_cnt + 1):
-                node_name = '{}{}'.format(self._seed_name.strip('1'), i)
-                self._cmd('run --name {} -d {} --seeds="{}"'.format(node_name, self._image, seed_ip))
+                node_name = self._node_name(i)
+                self._run_node(node_name, seed_ip)
                 self.nodes.append(node_name)
-        status = False
-        try_cnt = 0
-        while not status and try_cnt < 10:
-            status = self.node_status(self._seed_name)
-            time.sleep(2)
-            try_cnt += 1
-        if not self.wait_for_cluster_up():
+        # same timeline events as the parallel path, within one ready_timeout
+        deadline = time.time() + self._ready_timeout
+        for node in self.nodes:
+            self.wait_for_node_running(node, deadline=deadline)
+        for node in self.nodes:
+            self.wait_for_node_up(node, deadline=deadline)
+        self.readiness = self.wait_for_ready(timeout=max(0, deadline - time.time()))
+        if not self.readiness:
             self.destroy_cluster()
             raise Exception('Failed to start cluster: timeout expired.')
-        if not self.wait_for_cql_available():
-            raise Exception('Failed to start cluster: timeout expired.')
+        for node, ready_at in self.readiness.nodes.items():
+            self._timeline[node]['CQL'] = round(ready_at + self.readiness.start - self._create_start, 3)
         return self.nodes
 
-    def wait_for_cluster_up(self):
-        node_ips = [self.get_node_ip(name) for name in self.nodes]
-        up_nodes = list()
-        try_cnt = 0
-        while len(up_nodes) < len(node_ips) and try_cnt < self._start_timeout:
-            try:
-                res = self.run_nodetool('status')
-                for line in res.splitlines():
-                    for ip in node_ips:
-                        if ip in line and ip not in up_nodes:
-                            if line.split()[0].strip() == 'UN':
-                                up_nodes.append(ip)
-            except Exception:
-                pass
-            time.sleep(2)
-            try_cnt += 1
-        return len(up_nodes) == len(node_ips)
+    def _create_cluster_parallel(self):
+        """
+        Start the seed, then launch the other nodes through a bounded worker
+        pool. Every node is gated on its own readiness (running, UN, CQL)
+        instead of waiting for the whole cluster at once.
+        """
+        seed_ip = self.get_node_ip(self._seed_name)
+        new_nodes = [self._node_name(i) for i in range(2, self._node_cnt + 1)]
+        self.nodes.extend(new_nodes)
 
-    def wait_for_cql_available(self):
-        try_cnt = 0
-        output = ''
-        while try_cnt < self._start_timeout:
+        readiness = ReadinessResult(self.nodes)
+
+        def provision(node_name):
             try:
-                output = self._cmd('exec {} cqlsh -e help'.format(self._seed_name))
-                log.debug(output)
-                if 'CQL help topics' in output:
-                    break
+                if node_name != self._seed_name:
+                    self._run_node(node_name, seed_ip)
+                result = self.wait_for_node_ready(node_name)
             except Exception as ex:
+                log.error('Failed to provision %s: %s', node_name, ex)
+                return False
+            if result:
+                readiness.nodes[node_name] = round(time.time() - readiness.start, 3)
+                readiness.probes += result.probes
+            return bool(result)
+
+        pool = ThreadPool(processes=min(self._provision_workers, len(self.nodes)))
+        try:
+            ready = pool.map(provision, self.nodes)
+        finally:
+            pool.close()
+            pool.join()
+        readiness.finish(ready=all(ready))
+        self.readiness = readiness
+        log.debug('cluster startup timeline: %s', json.dumps(self.timeline, sort_keys=True))
+        if not readiness:
+            not_ready = [node for node, ok in zip(self.nodes, ready) if not ok]
+            self.destroy_cluster()
+            raise Exception('Failed to start cluster: nodes {} not ready, timeout expired.'.format(not_ready))
+        return self.nodes
+
+    def wait_for_node_ready(self, node):
+        """
+        Wait for node to be running, UN, then CQL ready, all within one
+        ready_timeout.
+
+        :return: the CQL ReadinessResult of node, False when it isn't running
+                 or UN in time
+        """
+        deadline = time.time() + self._ready_timeout
+        return (self.wait_for_node_running(node, deadline=deadline) and
+                self.wait_for_node_up(node, deadline=deadline) and
+                self.wait_for_node_cql(node, deadline=deadline))
+
+    def wait_for_node_running(self, node, deadline=None):
+        backoff = Backoff()
+        deadline = deadline or time.time() + self._ready_timeout
+        while time.time() < deadline:
+            try:
+                if self.node_status(node):
+                    self._mark(node, 'running')
+                    return True
+            except DockerCommandError as ex:
                 log.debug(ex)
-                pass
-            time.sleep(1)
-            try_cnt += 1
-        return 'CQL help topics' in output
+            self._wait_change(backoff)
+        return False
+
+    def wait_for_node_up(self, node, deadline=None):
+        node_ip = self.get_node_ip(node)
+        backoff = Backoff(max_delay=2.0)
+        deadline = deadline or time.time() + self._ready_timeout
+        while time.time() < deadline:
+            try:
+                if self.ring_status().is_up_normal(node_ip):
+                    self._mark(node, 'UN')
+                    return True
+            except Exception as ex:
+                log.debug('%s: ring status unavailable: %s', node, ex)
+            backoff.sleep()
+        return False
+
+    def wait_for_node_cql(self, node, deadline=None):
+        res = self.wait_for_ready(nodes=[node], timeout=max(0, deadline - time.time()) if deadline else None)
+        if res:
+            self._mark(node, 'CQL')
+        return res
+
+    def wait_for_ready(self, nodes=None, timeout=None):
+        """
+        Wait until every node accepts a native protocol CQL session.
+
+        Nodes are probed directly on their CQL port, the poll interval backs
+        off adaptively and is cut short by docker events, so this returns as
+        soon as the cluster is usable.
+
+        :return: ReadinessResult, true when all nodes are ready
+        """
+        nodes = list(nodes or self.nodes)
+        timeout = self._ready_timeout if timeout is None else timeout
+        result = ReadinessResult(nodes)
+        backoff = Backoff()
+        pending = list(nodes)
+        while pending and time.time() - result.start < timeout:
+            for node in list(pending):
+                try:
+                    if not self.node_status(node):
+                        continue
+                    result.probes += 1
+                    probe_cql(self.get_node_ip(node))
+                except (CQLProbeError, DockerCommandError, DockerContainerNotExists) as ex:
+                    log.debug('%s is not ready: %s', node, ex)
+                    continue
+                result.nodes[node] = round(time.time() - result.start, 3)
+                pending.remove(node)
+                backoff.reset()
+            if pending:
+                self._wait_change(backoff)
+        result.finish(ready=not pending)
+        log.debug('readiness of %s: %s', nodes, result.to_dict())
+        return result
+
+    def wait_for_cluster_up(self):
+        self.readiness = self.wait_for_ready()
+        return self.readiness
+
+    def wait_for_cql_available(self):
+        return self.wait_for_ready(nodes=[self._seed_name])
 
     def stop_cluster(self, system=False):
         log.debug('stop cluster')
         if system:
-            self._cmd('exec {} systemctl stop scylla.service'.format(self._seed_name), sudo=True)
+            self._exec(self._seed_name, 'systemctl stop scylla.service', sudo=True)
         else:
             for node in self.nodes:
                 self.stop_node(node=node)
@@ -145,50 +610,428 @@ class ScyllaDocker(object):
     def start_cluster(self, system=False):
         log.debug('start cluster')
         if system:
-            self._cmd('exec {} systemctl start scylla.service'.format(self._seed_name), sudo=True)
+            self._exec(self._seed_name, 'systemctl start scylla.service', sudo=True)
         else:
             for node in self.nodes:
                 self.start_node(node=node)
 
     def restart_cluster(self):
-        self._cmd('exec {} systemctl restart scylla.service'.format(self._seed_name), sudo=True)
+        self._exec(self._seed_name, 'systemctl restart scylla.service', sudo=True)
 
     def destroy_cluster(self):
         log.debug('destroy cluster')
         self.stop_cluster()
         for node in self.nodes:
             self.remove_node(node)
+        self.remove_loaders()
+        self.remove_network()
+        self.stop_watching_events()
+
+    def adopt_cluster(self, nodes):
+        """
+        Manage an already running cluster, e.g. one handed out by ClusterPool.
+        """
+        self._nodes = list(nodes)
+        self.invalidate_state()
+        self.watch_events()
+
+    def reset_cluster(self, keyspaces=('keyspace1',)):
+        """
+        Drop the keyspaces created by cassandra-stress, so a reused cluster
+        starts from a clean state.
+        """
+        for keyspace in keyspaces:
+            self._exec(self._seed_name, 'cqlsh -e "DROP KEYSPACE IF EXISTS {}"'.format(keyspace), timeout=60)
 
     def run_nodetool(self, cmd):
         log.debug('run nodetool %s' % cmd)
-        return self._cmd('exec {} nodetool {}'.format(self._seed_name, cmd))
+        return self._exec(self._seed_name, 'nodetool {}'.format(cmd))
+
+    def ring_status(self, node=None):
+        """
+        Ring status as seen by node (the seed by default), over the REST API,
+        with 'nodetool status' as fallback.
+        """
+        node = node or self._seed_name
+        return ring_status(self.get_node_ip(node), nodetool=lambda: self._exec(node, 'nodetool status'))
 
-    def run_stress_test(self, opt, sub_opt, results=True):
+    def run_stress_test(self, opt, sub_opt, results=True, timeout=60, on_interval=None, stall_intervals=None):
+        """
+        Run cassandra-stress on the seed node, parsing its output while it runs.
+
+        :param on_interval: callback for every StressInterval, as it's printed
+        :param stall_intervals: stop the run early and raise StressStalledError
+                                after that many intervals without progress
+        :return: summary results dict, or the raw output if results is False
+        """
         log.debug('run stress %s' % opt)
-        out = self._cmd('exec {} cassandra-stress {} {} -node {}'.format(
-            self._seed_name, opt, sub_opt, self.get_node_ip(self._seed_name)), timeout=60)
-        return self.get_stress_results(out) if results else out
+        cmd = 'cassandra-stress {} {} -node {}'.format(opt, sub_opt, self.get_node_ip(self._seed_name))
+        hdr_path = self._hdr_path(opt)
+        if hdr_path:
+            cmd += ' -log hdrfile={}'.format(hdr_path)
+        parser = StressStreamParser(on_interval=on_interval)
+        self.last_stress = parser
+        self.last_hdr_log = None
+        output = list()
+        lines = self._exec_lines(self._seed_name, cmd, timeout=timeout)
+        try:
+            for line in self._scan_lines(lines, '{}: {}'.format(self._seed_name, cmd), 'stress'):
+                parser.feed_line(line)
+                if not results:
+                    output.append(line)
+                if stall_intervals and parser.stalled(stall_intervals):
+                    raise StressStalledError('cassandra-stress made no progress for {} intervals'.format(
+                        stall_intervals))
+        finally:
+            lines.close()
+        if hdr_path:
+            self.last_hdr_log = self._read_hdr_log(self._seed_name, hdr_path)
+        return parser.summary if results else ''.join(output)
+
+    def _hdr_path(self, opt):
+        if not self._hdr_log:
+            return None
+        return '/tmp/stress-{}-{}.hdr'.format(opt, int(time.time() * 1000))
+
+    def _read_hdr_log(self, node, hdr_path):
+        """
+        Parse and remove the HdrHistogram log cassandra-stress wrote in node,
+        None when it can't be read.
+        """
+        try:
+            text = self._exec(node, 'cat {}'.format(hdr_path), timeout=60)
+            self._exec(node, 'rm -f {}'.format(hdr_path))
+        except DockerCommandError as details:
+            log.warning('no cassandra-stress histograms in %s: %s', node, details)
+            return None
+        return parse_hdr_log(text)
+
+    def run_load(self, opt, sub_opt, processes=1):
+        """
+        Same as run_stress_test(), with the load generator of load_generator.py
+        running here against every node instead of cassandra-stress in the seed.
+
+        :return: summary results dict, the LoadResult is kept in self.last_load
+        """
+        log.debug('run load %s' % opt)
+        self.last_load = run_load([self.get_node_ip(node) for node in self.nodes], opt, processes=processes,
+                                  **stress_options(sub_opt))
+        return self.last_load.summary
+
+    def run_distributed_stress(self, opt, sub_opt, op_cnt=None, loaders=None, timeout=600):
+        """
+        Run one cassandra-stress per loader at the same time, every loader
+        targeting all the nodes, and merge their results.
+
+        :param op_cnt: split n=op_cnt operations over the loaders, each one
+                       gets its own slice of the population (the first ones
+                       one more for the remainder); with fewer operations
+                       than loaders only op_cnt loaders are used
+        :param loaders: containers to run stress in, the loader containers if
+                        any were created, else the cluster nodes
+        :return: merged results dict, see merge_stress_results(); per loader
+                 results are kept in self.last_distributed_stress. With the
+                 histogram logs of every loader the latency percentiles are
+                 the ones of their merged histograms.
+        """
+        loaders = list(loaders or self._loaders or self.nodes)
+        if op_cnt is not None:
+            loaders = loaders[:max(1, min(len(loaders), op_cnt))]
+        node_ips = ','.join(self.get_node_ip(node) for node in self.nodes)
+        log.debug('run distributed stress %s on %s', opt, loaders)
+
+        def loader_opts(idx):
+            if op_cnt is None:
+                return sub_opt
+            size, extra = divmod(op_cnt, len(loaders))
+            start = idx * size + min(idx, extra) + 1
+            count = size + (1 if idx < extra else 0)
+            return 'n={} {} -pop seq={}..{}'.format(count, sub_opt, start, start + count - 1)
+
+        def run(idx):
+            parser = StressStreamParser()
+            cmd = 'cassandra-stress {} {} -node {}'.format(opt, loader_opts(idx), node_ips)
+            hdr_path = self._hdr_path(opt)
+            if hdr_path:
+                cmd += ' -log hdrfile={}'.format(hdr_path)
+            lines = self._exec_lines(loaders[idx], cmd, timeout=timeout)
+            try:
+                for line in self._scan_lines(lines, '{}: {}'.format(loaders[idx], cmd), 'stress'):
+                    parser.feed_line(line)
+            finally:
+                lines.close()
+            return parser, self._read_hdr_log(loaders[idx], hdr_path) if hdr_path else None
+
+        pool = ThreadPool(processes=len(loaders))
+        try:
+            runs = pool.map(run, range(len(loaders)))
+        finally:
+            pool.close()
+            pool.join()
+        self.last_distributed_stress = dict((loader, parser) for loader, (parser, _) in zip(loaders, runs))
+        self.last_distributed_hdr_logs = dict((loader, hdr_log) for loader, (_, hdr_log) in zip(loaders, runs)
+                                              if hdr_log is not None)
+        merged = merge_stress_results([parser.summary for parser, _ in runs])
+        self.last_hdr_log = None
+        if merged and len(self.last_distributed_hdr_logs) == len(loaders):
+            self.last_hdr_log = HdrLog()
+            for hdr_log in self.last_distributed_hdr_logs.values():
+                self.last_hdr_log.merge(hdr_log)
+            service = self.last_hdr_log.kind('st') or self.last_hdr_log.kind('')
+            if service is not None:
+                merged.update(service.summary())
+        return merged
 
     @staticmethod
     def get_stress_results(stress_out):
-        results = {}
-        start = 0
-        for line in stress_out.splitlines():
-            if line.startswith('Results:'):
-                start = 1
+        return parse_stress_output(stress_out).summary
+
+
+class ScyllaDockerAPI(ScyllaDocker):
+    """
+    ScyllaDocker backend talking to the Engine API over the daemon socket
+    with a persistent connection, instead of forking the docker CLI.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ScyllaDockerAPI, self).__init__(*args, **kwargs)
+        self._api = DockerAPIClient(kwargs.get('docker_socket', DEFAULT_SOCKET))
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(self._api, method)(*args, **kwargs)
+        except DockerAPIError as ex:
+            if 'No such container' in ex.message:
+                raise DockerContainerNotExists(ex.message)
+            raise DockerCommandError('api call: {}{}, error: {}'.format(method, args, ex))
+
+    def _exec(self, node, cmd, timeout=10, sudo=False):
+        exit_code, stdout, stderr = self._call('exec_run', node, shlex.split(cmd), timeout=timeout)
+        if exit_code:
+            if 'No such container:' in stderr:
+                raise DockerContainerNotExists(stderr)
+            raise DockerCommandError('command: exec {} {}, error: {}, output: {}'.format(node, cmd, stderr, stdout))
+        return stdout
+
+    def _exec_lines(self, node, cmd, timeout=60):
+        partial = ''
+        try:
+            for _, data in self._api.exec_stream(node, shlex.split(cmd), timeout=timeout):
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    yield line + '\n'
+        except DockerAPIError as ex:
+            if 'No such container' in ex.message:
+                raise DockerContainerNotExists(ex.message)
+            raise DockerCommandError('command: exec {} {}, error: {}'.format(node, cmd, ex))
+        if partial:
+            yield partial
+
+    def clean_old_images(self):
+        for image in self._call('list_images', dangling=True):
+            self._call('remove_image', image['Id'])
+
+    def local_image_digests(self):
+        try:
+            info = self._api.inspect_image(self._image)
+        except DockerAPIError as ex:
+            log.debug('no local image: %s', ex)
+            return []
+        return [digest.split('@', 1)[1] for digest in info.get('RepoDigests') or [] if '@' in digest]
+
+    def _pull_image(self):
+        self._call('pull_image', self._image, timeout=600)
+
+    def _inspect_nodes(self, nodes):
+        state = dict()
+        for info in self._call('list_containers', names=nodes):
+            name = info['Names'][0].lstrip('/')
+            if name not in nodes:
                 continue
-            elif line.startswith('END'):
-                break
-            if start and line.strip():
-                try:
-                    res = line.split(':')
-                    key = res[0].strip()
-                    val = res[1].split()[0].strip().replace(',', '') if key != 'Total operation time' else\
-                        ':'.join([res[1], res[2], res[3]]).strip()
-                    results[key] = float(val) if val != 'NaN' and key != 'Total operation time' else val
-                except Exception as ex:
-                    log.error('Failed parsing stress results: %s, error: %s', line, ex)
-        return results
+            health = re.search(r'\((healthy|unhealthy|health: starting)\)', info.get('Status', ''))
+            networks = info['NetworkSettings']['Networks']
+            network = networks.get(self._network) or (networks.values()[0] if networks else {})
+            state[name] = {'ip': network.get('IPAddress', ''),
+                           'running': info['State'] == 'running',
+                           'health': health.group(1).replace('health: ', '') if health else None}
+        missing = set(nodes) - set(state)
+        if missing:
+            raise DockerContainerNotExists('No such container: {}'.format(', '.join(sorted(missing))))
+        return state
+
+    def _open_events(self):
+        return self._api.events()
+
+    def _events(self, stream):
+        return stream
+
+    def stop_watching_events(self):
+        if self._events_proc is not None:
+            self._events_proc.close()
+        self._events_proc = None
+
+    def create_network(self):
+        if self._network is None:
+            return
+        try:
+            self._call('create_network', self._network)
+        except DockerCommandError as ex:
+            if 'already exists' not in str(ex):
+                raise
+
+    def remove_network(self):
+        if self._network is None:
+            return
+        try:
+            self._call('remove_network', self._network)
+        except (DockerCommandError, DockerContainerNotExists) as ex:
+            log.debug('failed to remove network %s: %s', self._network, ex)
+
+    def _container_action(self, action, node, timeout=10):
+        method = {'start': 'start_container', 'stop': 'stop_container',
+                  'restart': 'restart_container', 'rm': 'remove_container'}[action]
+        if action in ('stop', 'restart'):
+            self._call(method, node, timeout=timeout)
+        else:
+            self._call(method, node)
+
+    def _docker_run(self, node_name, seed_ip=None):
+        cmd = ['--api-address', '0.0.0.0']
+        profile = self.profiles.get(node_name)
+        if profile:
+            cmd += profile.scylla_args()
+        if seed_ip:
+            cmd.append('--seeds={}'.format(seed_ip))
+        host_config = profile.host_config() if profile else dict()
+        if self._network:
+            host_config['NetworkMode'] = self._network
+        self._call('create_container', node_name, self._image, cmd=cmd, host_config=host_config)
+        self._call('start_container', node_name)
+
+    def _docker_run_loader(self, name):
+        self._call('create_container', name, self._image, cmd=['infinity'], entrypoint=['sleep'],
+                   host_config={'NetworkMode': self._network} if self._network else None)
+        self._call('start_container', name)
+
+
+class ClusterPool(object):
+    """
+    Warm clusters shared by the tests of one avocado job (the session),
+    keyed by (prefix, image, node_cnt, resources).
+
+    Avocado runs every test in its own process, so the pool lives in a json
+    file that outlives the jobs. A cluster is checked and reset before it's
+    handed out again, and destroyed after a failed health check. When the
+    last test of the job releases its cluster, every cluster of the session
+    is destroyed. A job that never gets there (other tests in the job, a
+    test failing before setUp) leaves its clusters to the next one: the
+    clusters of another session with the same prefix are destroyed on the
+    first acquire.
+    """
+
+    def __init__(self, path, session, total_tests=None, health_timeout=30):
+        self.path = os.path.expanduser(path)
+        self.session = session
+        self.total_tests = total_tests
+        self.health_timeout = health_timeout
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        if os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = {'clusters': {}, 'released': {}}
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    state = json.load(f)
+            if not isinstance(state.get('released'), dict):
+                state['released'] = {}
+            yield state
+            with open(self.path, 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+
+    @staticmethod
+    def _key(docker):
+        return '{}|{}|{}|{}'.format(docker._prefix, docker._image, docker._node_cnt,
+                                    json.dumps(docker._resources, sort_keys=True))
+
+    def _is_healthy(self, docker):
+        try:
+            if not all(docker.node_status(node) for node in docker.nodes):
+                return False
+            ring = docker.ring_status()
+            if not all(ring.is_up_normal(docker.get_node_ip(node)) for node in docker.nodes):
+                log.debug('pooled cluster is not all UN: %s', ring.to_dict())
+                return False
+            if not docker.wait_for_ready(timeout=self.health_timeout):
+                return False
+            docker.reset_cluster()
+            return True
+        except (DockerCommandError, DockerContainerNotExists) as ex:
+            log.debug('pooled cluster health check failed: %s', ex)
+            return False
+
+    @staticmethod
+    def _destroy(docker, entry):
+        log.debug('destroy pooled cluster %s', entry)
+        docker.adopt_cluster(entry['nodes'])
+        try:
+            docker.destroy_cluster()
+        except (DockerCommandError, DockerContainerNotExists) as ex:
+            log.debug(ex)
+        docker.adopt_cluster([])
+
+    def _sweep(self, state, docker):
+        """
+        Destroy the clusters with docker's prefix left over by other sessions.
+        """
+        for key, entry in state['clusters'].items():
+            if entry['session'] != self.session and entry.get('prefix', key.split('|')[0]) == docker._prefix:
+                del state['clusters'][key]
+                state['released'].pop(entry['session'], None)
+                self._destroy(docker, entry)
+
+    def acquire(self, docker):
+        """
+        Hand a warm cluster over to docker, return False when there's none
+        and the caller has to create it (then add() it to the pool).
+        """
+        with self._locked_state() as state:
+            self._sweep(state, docker)
+            entry = state['clusters'].pop(self._key(docker), None)
+            if entry is None:
+                return False
+            docker.adopt_cluster(entry['nodes'])
+            if self._is_healthy(docker):
+                state['clusters'][self._key(docker)] = entry
+                return True
+            self._destroy(docker, entry)
+            return False
+
+    def add(self, docker):
+        with self._locked_state() as state:
+            state['clusters'][self._key(docker)] = {'session': self.session, 'prefix': docker._prefix,
+                                                    'nodes': docker.nodes}
+
+    def release(self, docker):
+        """
+        Return the cluster to the pool, tear down every cluster of the
+        session after the last test.
+        """
+        with self._locked_state() as state:
+            released = state['released'].get(self.session, 0) + 1
+            state['released'][self.session] = released
+            if self.total_tests is None or released < self.total_tests:
+                return
+            del state['released'][self.session]
+            if state['clusters'].pop(self._key(docker), None) is not None:
+                docker.destroy_cluster()
+            for key, entry in state['clusters'].items():
+                if entry['session'] == self.session:
+                    del state['clusters'][key]
+                    self._destroy(docker, entry)
 
 
 class ScyllaDockerSanity(Test):
@@ -201,14 +1044,137 @@ class ScyllaDockerSanity(Test):
         super(ScyllaDockerSanity, self).__init__(*args, **kwargs)
         self.image = self.params.get('docker_image', default='scylladb/scylla-nightly')
         self.docker = None
-        self.node_cnt = 2
+        self.node_cnt = self.params.get('node_cnt', default=2)
         self.op_cnt = 300000
-        self.start_timeout = self.params.get('start_timeout', default=30)
+        self.provision_workers = self.params.get('provision_workers', default=1)
+        self.docker_backend = self.params.get('docker_backend', default='cli')
+        self.ready_timeout = self.params.get('ready_timeout', default=120)
+        self.reuse_cluster = self.params.get('reuse_cluster', default=False)
+        self.cluster_pool = self.params.get('cluster_pool', default='~/.scylla-artifact-tests/scylla-docker-pool.json')
+        self.stall_intervals = self.params.get('stress_stall_intervals', default=10)
+        self.stress_timeout = self.params.get('stress_timeout', default=60)
+        self.load_generator = self.params.get('load_generator', default='cassandra-stress')
+        self.load_processes = self.params.get('load_processes', default=1)
+        self.stress_hdr_log = self.params.get('stress_hdr_log', default=True)
+        self.loader_cnt = self.params.get('stress_loaders', default=0)
+        self.perf_history = self.params.get('perf_history', default='')
+        self.perf_gate = self.params.get('perf_gate', default=False)
+        self.perf_tolerance = self.params.get('perf_tolerance', default=0.15)
+        self.perf_baseline_runs = self.params.get('perf_baseline_runs', default=5)
+        # several jobs can run side by side, see scylla_docker_orchestrator.py
+        self.cluster_prefix = self.params.get('cluster_prefix', default='')
+        self.resources = None
+        if self.params.get('resource_profile', default=False):
+            self.resources = {'slot': self.params.get('cluster_slot', default=0),
+                              'slots': self.params.get('cluster_slots', default=1),
+                              'cpus': self.params.get('node_cpus', default=0),
+                              'memory': self.params.get('node_memory', default=None),
+                              'memory_per_cpu': self.params.get('node_memory_per_cpu', default='1G'),
+                              'reserved_cores': self.params.get('reserved_cores', default=1),
+                              'io_device': self.params.get('io_device', default=None),
+                              'io_read_bps': self.params.get('io_read_bps', default=None),
+                              'io_write_bps': self.params.get('io_write_bps', default=None)}
+        self.pool = None
+        self._stress_cnt = 0
+        self._image_version = None
+
+    def _record(self, name, data):
+        with open(os.path.join(self.outputdir, '{}.json'.format(name)), 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    def _run_stress(self, opt, sub_opt):
+        """
+        Run cassandra-stress, keep its interval time series in the test results.
+        """
+        if self.load_generator == 'driver':
+            return self._run_load(opt, sub_opt)
+        try:
+            res = self.docker.run_stress_test(opt, sub_opt, timeout=self.stress_timeout,
+                                              stall_intervals=self.stall_intervals)
+        except FatalSignatureError as ex:
+            self.fail(str(ex))
+        finally:
+            self._stress_cnt += 1
+            if self.docker.last_stress is not None:
+                self._record('stress_{}_{}'.format(self._stress_cnt, opt),
+                             dict(self.docker.last_stress.to_dict(), resources=self.docker.profiles_dict()))
+        self._gate_perf(opt, res, self._stress_latency(opt, sub_opt))
+        return res
+
+    def _stress_latency(self, name, sub_opt, loaders=1):
+        """
+        Record the latency report of the last cassandra-stress histogram log,
+        return its service time histogram.
+        """
+        hdr_log = self.docker.last_hdr_log
+        if hdr_log is None:
+            return None
+        # without -rate threads= there's no closed loop to correct for
+        concurrency = stress_options(sub_opt).get('concurrency', 0)
+        self._record('latency_{}_{}'.format(self._stress_cnt, name),
+                     dict(hdr_log.report(concurrency * loaders),
+                          histograms=hdr_log.to_dict()))
+        return hdr_log.kind('st') or hdr_log.kind('')
+
+    def _run_load(self, opt, sub_opt):
+        try:
+            res = self.docker.run_load(opt, sub_opt, self.load_processes)
+        finally:
+            self._stress_cnt += 1
+            if self.docker.last_load is not None:
+                self._record('stress_{}_{}'.format(self._stress_cnt, opt),
+                             dict(self.docker.last_load.to_dict(), resources=self.docker.profiles_dict()))
+        self._gate_perf(opt, res, self.docker.last_load.histogram)
+        return res
+
+    def _perf_setup(self):
+        """
+        The 'distro' of the perf history runs: host, node count and node
+        resource profiles, only runs on the same setup make a baseline.
+        """
+        profiles = set()
+        for profile in self.docker.profiles.values():
+            profiles.add('smp{}-mem{}M-io{}/{}'.format(profile.smp, (profile.memory or 0) // 1024 ** 2,
+                                                       profile.io_read_bps or 0, profile.io_write_bps or 0))
+        profiles = sorted(profiles)
+        return 'docker:{}:{}n:{}'.format(socket.gethostname(), self.node_cnt, '+'.join(profiles) or 'unlimited')
+
+    def _gate_perf(self, name, summary, histogram=None):
+        """
+        Store the stress summary in the performance history, fail the test
+        when it regressed against the rolling baseline. The latency histogram
+        is stored as well, the latencies of the runs in the baseline merged
+        with it are recorded.
+        """
+        if not self.perf_history:
+            return
+        if self._image_version is None:
+            digests = self.docker.local_image_digests()
+            self._image_version = digests[0] if digests else self.image
+        history = PerfHistory(self.perf_history)
+        test = '{}.{}:{}'.format(type(self).__name__, self._testMethodName, name)
+        setup = self._perf_setup()
+        try:
+            regressions = history.check_and_record(test, self._image_version, setup, summary,
+                                                   tolerance=self.perf_tolerance, runs=self.perf_baseline_runs,
+                                                   extra={'resources': self.docker.profiles_dict()},
+                                                   histograms={'latency': histogram} if histogram else None)
+            if histogram:
+                merged = history.merged_histogram(test, setup, 'latency', runs=self.perf_baseline_runs)
+                self._record('latency_history_{}'.format(name), {'runs': self.perf_baseline_runs,
+                                                                 'count': merged.total, 'latency': merged.summary()})
+        finally:
+            history.close()
+        if regressions:
+            msg = 'Performance regression in {}: {}'.format(name, '; '.join(regressions))
+            if self.perf_gate:
+                self.fail(msg)
+            log.warning(msg)
 
     def _cleanup(self):
         log.debug('cleanup cluster if exists')
         for i in range(1, self.node_cnt + 1):
-            node_name = 'node{}'.format(i)
+            node_name = self.docker._node_name(i)
             for method in ('stop_node', 'remove_node'):
                 try:
                     getattr(self.docker, method)(node_name)
@@ -219,17 +1185,42 @@ class ScyllaDockerSanity(Test):
         """
         Update scylla image, create cluster(cleanup if exists)
         """
-        self.docker = ScyllaDocker(image=self.image, node_cnt=self.node_cnt, start_timeout=self.start_timeout)
-        self.docker.update_image()
+        docker_cls = ScyllaDockerAPI if self.docker_backend == 'api' else ScyllaDocker
+        self.docker = docker_cls(image=self.image, node_cnt=self.node_cnt,
+                                 provision_workers=self.provision_workers, ready_timeout=self.ready_timeout,
+                                 resources=self.resources, name_prefix=self.cluster_prefix,
+                                 hdr_log=self.stress_hdr_log)
+        self._record('resource_profiles', self.docker.profiles_dict())
+        if self.reuse_cluster:
+            self.pool = ClusterPool(self.cluster_pool, session=self.job.unique_id,
+                                    total_tests=getattr(self.job.args, 'test_result_total', None))
+            if self.pool.acquire(self.docker):
+                log.debug('reuse warm cluster: %s', self.docker.nodes)
+                return
+        self._record('image_update', self.docker.update_image())
         self._cleanup()
-        log.debug('Wait cluster timeup: {} seconds'.format(self.start_timeout))
+        log.debug('Wait cluster timeup: {} seconds'.format(self.ready_timeout))
         self.docker.create_cluster()
+        self._record('cluster_timeline', self.docker.timeline)
+        if self.docker.readiness is not None:
+            self._record('cluster_readiness', self.docker.readiness.to_dict())
+        if self.pool is not None:
+            self.pool.add(self.docker)
 
     def tearDown(self):
         """
-        Destroy cluster
+        Destroy cluster, or give it back to the pool when clusters are reused
         """
-        self.docker.destroy_cluster()
+        reports = [scanner.report() for scanner in self.docker.signature_scanners if scanner.matches]
+        if reports:
+            self._record('failure_signatures', reports)
+        if self.pool is not None:
+            self.docker.remove_loaders()
+            self.pool.release(self.docker)
+            # the cluster outlives the test, its events watcher must not
+            self.docker.stop_watching_events()
+        else:
+            self.docker.destroy_cluster()
 
     def test_basic_stress(self):
         """
@@ -237,11 +1228,16 @@ class ScyllaDockerSanity(Test):
         """
         res = self.docker.run_nodetool('status')
         log.debug(res)
-        res = self.docker.run_stress_test('write', 'cl=QUORUM n={} -schema replication(factor={}) -rate threads=10'
-                                          .format(self.op_cnt, self.node_cnt))
+        ring = self.docker.ring_status()
+        self._record('ring_status', ring.to_dict())
+        for node in self.docker.nodes:
+            self.assertTrue(ring.is_up_normal(self.docker.get_node_ip(node)),
+                            '{} is not UN: {}'.format(node, ring.to_dict()))
+        res = self._run_stress('write', 'cl=QUORUM n={} -schema replication(factor={}) -rate threads=10'
+                               .format(self.op_cnt, self.node_cnt))
         self.assertGreaterEqual(res['Total partitions'], self.op_cnt)
         self.assertEquals(int(res['Total errors']), 0)
-        res = self.docker.run_stress_test('read', 'cl=QUORUM n={} -rate threads=10'.format(self.op_cnt))
+        res = self._run_stress('read', 'cl=QUORUM n={} -rate threads=10'.format(self.op_cnt))
         self.assertGreaterEqual(res['Total partitions'], self.op_cnt)
         self.assertEquals(int(res['Total errors']), 0)
 
@@ -249,17 +1245,45 @@ class ScyllaDockerSanity(Test):
         """
         Run cassandra stress write, restart cluster, run stress read
         """
-        res = self.docker.run_stress_test('write', 'cl=QUORUM n={} -schema replication(factor={}) -rate threads=10'
-                                          .format(self.op_cnt, self.node_cnt))
+        res = self._run_stress('write', 'cl=QUORUM n={} -schema replication(factor={}) -rate threads=10'
+                               .format(self.op_cnt, self.node_cnt))
         self.assertGreaterEqual(res['Total partitions'], self.op_cnt)
         self.assertEquals(int(res['Total errors']), 0)
         self.docker.stop_cluster()
         self.docker.start_cluster()
-        if not self.docker.wait_for_cluster_up():
-            raise Exception('Failed to start cluster: timeout expired.')
-        if not self.docker.wait_for_cql_available():
-            raise Exception('Failed to start cluster: timeout expired.')
-        res = self.docker.run_stress_test('read', 'n={} -rate threads=10'.format(self.op_cnt))
+        readiness = self.docker.wait_for_ready()
+        self._record('restart_readiness', readiness.to_dict())
+        self.assertTrue(readiness, 'Failed to start cluster: timeout expired, {}'.format(readiness.to_dict()))
+        log.debug('cluster ready after restart in %s seconds', readiness.time_to_ready)
+        res = self._run_stress('read', 'n={} -rate threads=10'.format(self.op_cnt))
+        self.assertGreaterEqual(res['Total partitions'], self.op_cnt)
+        self.assertEquals(int(res['Total errors']), 0)
+
+    def _run_distributed_stress(self, opt, sub_opt):
+        try:
+            res = self.docker.run_distributed_stress(opt, sub_opt, op_cnt=self.op_cnt, timeout=self.stress_timeout)
+        except FatalSignatureError as ex:
+            self.fail(str(ex))
+        loaders = dict((loader, parser.to_dict()) for loader, parser in self.docker.last_distributed_stress.items())
+        self._record('distributed_stress_{}'.format(opt), {'merged': res, 'loaders': loaders,
+                                                           'resources': self.docker.profiles_dict()})
+        log.debug('distributed stress %s: %s', opt, res)
+        self._stress_cnt += 1
+        name = 'distributed_{}'.format(opt)
+        self._gate_perf(name, res, self._stress_latency(name, sub_opt, len(self.docker.last_distributed_hdr_logs)))
+        return res
+
+    def test_distributed_stress(self):
+        """
+        Run cassandra stress write and read from several loaders at once
+        """
+        if self.loader_cnt:
+            self.docker.create_loaders(self.loader_cnt)
+        res = self._run_distributed_stress('write', 'cl=QUORUM -schema replication(factor={}) -rate threads=10'
+                                           .format(self.node_cnt))
+        self.assertGreaterEqual(res['Total partitions'], self.op_cnt)
+        self.assertEquals(int(res['Total errors']), 0)
+        res = self._run_distributed_stress('read', 'cl=QUORUM -rate threads=10')
         self.assertGreaterEqual(res['Total partitions'], self.op_cnt)
         self.assertEquals(int(res['Total errors']), 0)
 
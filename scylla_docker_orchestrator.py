@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Run ScyllaDocker test jobs side by side, each on its own isolated cluster.
+
+The host is split in slots. A slot is what one cluster needs: node_cnt
+times node_cpus worth of whole cores and node_cnt times node_memory (or
+node_memory_per_cpu for each of the node_cpus). The
+slot count is what the host has left after reserved_cores and the memory
+already in use. Queued jobs wait for a free slot, then run 'avocado run'
+with a yaml giving them that slot's cluster_prefix and share of the cores.
+"""
+
+import os
+import sys
+import json
+import time
+import Queue
+import argparse
+import threading
+import subprocess
+
+import yaml
+
+from resource_profile import host_cpu_topology, parse_size
+
+DEFAULT_YAML = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scylla-artifacts.py.data',
+                            'scylla-docker.yaml')
+
+
+def memory_available():
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def host_slots(params, topology=None, memory=None, max_slots=None):
+    """
+    How many clusters described by params fit on the host at once.
+    """
+    topology = topology or host_cpu_topology()
+    node_cnt = params.get('node_cnt', 2)
+    cores = max(1, len(topology) - params.get('reserved_cores', 1))
+    node_cores = -(-params.get('node_cpus', 0) // len(topology[0])) or 1
+    slots = cores // (node_cnt * node_cores)
+    node_memory = parse_size(params['node_memory']) if params.get('node_memory') else None
+    if not node_memory and params.get('node_memory_per_cpu'):
+        node_cpus = params.get('node_cpus', 0) or node_cores * len(topology[0])
+        node_memory = parse_size(params['node_memory_per_cpu']) * node_cpus
+    memory = memory if memory is not None else memory_available()
+    if node_memory and memory:
+        slots = min(slots, memory // (node_cnt * node_memory))
+    if max_slots:
+        slots = min(slots, max_slots)
+    return max(1, slots)
+
+
+class Orchestrator(object):
+
+    def __init__(self, params, tests, slots, results_dir, avocado='avocado'):
+        self.params = params
+        self.tests = tests
+        self.slots = slots
+        self.results_dir = results_dir
+        self.avocado = avocado
+        self.results = []
+        self._lock = threading.Lock()
+
+    def slot_params(self, slot):
+        params = dict(self.params)
+        params.update({'cluster_prefix': 'c{}-'.format(slot), 'cluster_slot': slot, 'cluster_slots': self.slots})
+        return params
+
+    def run_job(self, slot, idx, test):
+        job_dir = os.path.join(self.results_dir, 'slot{}'.format(slot))
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        yaml_path = os.path.join(job_dir, 'job{}.yaml'.format(idx))
+        with open(yaml_path, 'w') as yaml_file:
+            yaml.safe_dump(self.slot_params(slot), yaml_file, default_flow_style=False)
+        cmd = [self.avocado, 'run', test, '--mux-yaml', yaml_path, '--job-results-dir', job_dir]
+        start = time.time()
+        with open(os.path.join(job_dir, 'job{}.log'.format(idx)), 'w') as job_log:
+            exit_code = subprocess.call(cmd, stdout=job_log, stderr=subprocess.STDOUT)
+        result = {'job': idx, 'test': test, 'slot': slot, 'exit_code': exit_code,
+                  'duration': round(time.time() - start, 3)}
+        with self._lock:
+            self.results.append(result)
+        print('job {job} {test} on slot {slot}: exit code {exit_code} in {duration}s'.format(**result))
+        return result
+
+    def _worker(self, slot, jobs):
+        while True:
+            try:
+                idx, test = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            self.run_job(slot, idx, test)
+
+    def run(self):
+        jobs = Queue.Queue()
+        for job in enumerate(self.tests):
+            jobs.put(job)
+        start = time.time()
+        workers = [threading.Thread(target=self._worker, args=(slot, jobs), name='slot{}'.format(slot))
+                   for slot in range(self.slots)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        report = {'slots': self.slots, 'duration': round(time.time() - start, 3),
+                  'jobs': sorted(self.results, key=lambda res: res['job'])}
+        with open(os.path.join(self.results_dir, 'orchestrator.json'), 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('tests', nargs='*', default=['scylla_docker.py'], help='avocado test references')
+    parser.add_argument('--yaml', default=DEFAULT_YAML, help='base parameters of every job')
+    parser.add_argument('--repeat', type=int, default=1, help='queue every test this many times')
+    parser.add_argument('--slots', type=int, default=0, help='concurrent clusters, 0 sizes by host capacity')
+    parser.add_argument('--results-dir', default=os.path.expanduser('~/avocado/job-results/orchestrator'))
+    args = parser.parse_args()
+
+    with open(args.yaml) as yaml_file:
+        params = yaml.safe_load(yaml_file) or {}
+    params['resource_profile'] = True
+    slots = args.slots or host_slots(params)
+    results_dir = os.path.join(args.results_dir, time.strftime('%Y-%m-%dT%H.%M.%S'))
+    os.makedirs(results_dir)
+    print('running {} jobs on {} slots, results in {}'.format(len(args.tests) * args.repeat, slots, results_dir))
+    report = Orchestrator(params, args.tests * args.repeat, slots, results_dir).run()
+    failed = [job for job in report['jobs'] if job['exit_code']]
+    print('{} jobs in {}s, {} failed'.format(len(report['jobs']), report['duration'], len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
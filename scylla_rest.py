@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Node status over the Scylla REST API (port 10000).
+
+Asking the API for live, down, joining, leaving and moving endpoints is a
+few small HTTP requests, where 'nodetool status' starts a JVM every time.
+Both end up in the same RingStatus model, nodetool is only used when the
+API can't be reached.
+"""
+
+import json
+import socket
+import httplib
+import logging
+import collections
+
+from avocado import Test
+
+REST_PORT = 10000
+
+log = logging.getLogger('scylla_rest')
+
+NodeStatus = collections.namedtuple('NodeStatus', ['endpoint', 'status', 'state'])
+
+
+class RestAPIError(Exception):
+    pass
+
+
+class RingStatus(object):
+    """
+    Status of every endpoint in the ring, as in the first column of
+    'nodetool status': status is 'U' or 'D', state one of 'N' (normal),
+    'J' (joining), 'L' (leaving), 'M' (moving).
+    """
+
+    def __init__(self, nodes=None, source=None):
+        self.nodes = dict((node.endpoint, node) for node in nodes or [])
+        self.source = source
+
+    def __getitem__(self, endpoint):
+        return self.nodes[endpoint]
+
+    def __contains__(self, endpoint):
+        return endpoint in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def code(self, endpoint):
+        node = self.nodes.get(endpoint)
+        return node.status + node.state if node else None
+
+    def is_up_normal(self, endpoint):
+        return self.code(endpoint) == 'UN'
+
+    def endpoints(self, code):
+        return sorted(node.endpoint for node in self.nodes.values() if node.status + node.state == code)
+
+    def to_dict(self):
+        return {'source': self.source,
+                'nodes': dict((endpoint, self.code(endpoint)) for endpoint in self.nodes)}
+
+    @classmethod
+    def from_nodetool(cls, output):
+        """
+        Parse the 'nodetool status' table.
+        """
+        nodes = []
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) > 1 and len(fields[0]) == 2 and fields[0][0] in 'UD' and fields[0][1] in 'NJLM':
+                nodes.append(NodeStatus(fields[1], fields[0][0], fields[0][1]))
+        return cls(nodes, source='nodetool')
+
+
+class ScyllaRestClient(object):
+
+    def __init__(self, host, port=REST_PORT, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def get(self, path):
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            body = resp.read()
+        except (socket.error, httplib.HTTPException) as ex:
+            raise RestAPIError('GET {}:{}{}: {}'.format(self.host, self.port, path, ex))
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise RestAPIError('GET {}:{}{}: HTTP {} {}'.format(self.host, self.port, path, resp.status, body))
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise RestAPIError('GET {}:{}{}: not json: {}'.format(self.host, self.port, path, body[:200]))
+
+    def ring_status(self):
+        states = dict()
+        for state, path in (('J', '/storage_service/nodes/joining'),
+                            ('L', '/storage_service/nodes/leaving'),
+                            ('M', '/storage_service/nodes/moving')):
+            for endpoint in self.get(path):
+                states[endpoint] = state
+        nodes = [NodeStatus(endpoint, 'U', states.get(endpoint, 'N'))
+                 for endpoint in self.get('/gossiper/endpoint/live/')]
+        nodes += [NodeStatus(endpoint, 'D', states.get(endpoint, 'N'))
+                  for endpoint in self.get('/gossiper/endpoint/down/')]
+        return RingStatus(nodes, source='rest')
+
+
+def ring_status(host, nodetool=None, port=REST_PORT, timeout=2.0):
+    """
+    Ring status from the REST API of host, falling back to parsing the
+    output of nodetool() when the API is unavailable.
+    """
+    try:
+        return ScyllaRestClient(host, port=port, timeout=timeout).ring_status()
+    except RestAPIError as ex:
+        if nodetool is None:
+            raise
+        log.debug('REST API unavailable, using nodetool: %s', ex)
+    return RingStatus.from_nodetool(nodetool())
+
+
+class ScyllaRestEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
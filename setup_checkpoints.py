@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Checkpoints of the install stages, so a failed setup resumes where it
+stopped instead of starting over.
+
+Every completed stage is recorded with the inputs it was run with
+(distro, sw_repo, version; the distro prerequisites only depend on the
+distro). A rerun skips the stages recorded with the same inputs as long
+as none before them had to run again, and the installer still finds
+their effects in place. The file is rewritten atomically after every
+stage, setups only trust it once finish() marks it complete.
+"""
+
+import os
+import json
+import time
+import logging
+
+from avocado import Test
+
+log = logging.getLogger('setup_checkpoints')
+
+# stages that don't depend on the scylla build under test
+PREREQ_STAGES = ('prereq_setup',)
+
+
+class SetupCheckpoints(object):
+
+    def __init__(self, path, inputs):
+        self.path = os.path.expanduser(path)
+        self.inputs = dict(inputs)
+        self.stages = dict()
+        self.finished = None
+        self.skipped = []
+        self.executed = []
+        self._pending = []
+        self._resumed = True
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as checkpoints_file:
+                    data = json.load(checkpoints_file)
+                self.stages = data.get('stages', {})
+                self.finished = data.get('finished')
+            except ValueError:
+                log.warning('Ignoring corrupted setup checkpoints %s', self.path)
+
+    def stage_inputs(self, stage):
+        if stage in PREREQ_STAGES:
+            return {'distro': self.inputs.get('distro')}
+        return self.inputs
+
+    def completed(self, stage, validate=None):
+        """
+        True when stage can be skipped: it's recorded with the same inputs,
+        no stage before it ran in this setup and validate(stage), if given,
+        still holds.
+        """
+        record = self.stages.get(stage)
+        if not self._resumed or record is None or record['inputs'] != self.stage_inputs(stage):
+            return False
+        if validate is not None and not validate(stage):
+            log.info('Setup stage %s is recorded but does not validate, running it again', stage)
+            return False
+        return True
+
+    def result(self, stage):
+        return self.stages.get(stage, {}).get('result')
+
+    def skip(self, stage):
+        self.skipped.append(stage)
+
+    def record(self, stage, result=None, deferred=False):
+        """
+        Record stage as completed. A deferred stage is only written with the
+        next non deferred one, for stages whose work is committed later (the
+        package transaction runs on install).
+
+        The first stage run in a setup invalidates the records of the stages
+        after it, that is all but the ones skipped so far.
+        """
+        if self._resumed:
+            self.stages = dict((skipped, self.stages[skipped]) for skipped in self.skipped)
+            self._resumed = False
+        self.finished = None
+        self.executed.append(stage)
+        self._pending.append((stage, {'inputs': self.stage_inputs(stage), 'result': result, 'time': time.time()}))
+        if not deferred:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the deferred stages.
+        """
+        self.stages.update(self._pending)
+        del self._pending[:]
+        self.save()
+
+    def invalidate(self, stage=None):
+        """
+        Forget stage (everything when None) and mark the setup unfinished.
+        """
+        if stage is None:
+            self.stages.clear()
+        else:
+            self.stages.pop(stage, None)
+        self.finished = None
+        self.save()
+
+    def finish(self, **details):
+        """
+        Mark the setup complete, details (e.g. the job) are kept with it.
+        """
+        self.finished = dict(details, inputs=self.inputs, time=time.time())
+        self.save()
+
+    def is_finished(self):
+        return self.finished is not None and self.finished.get('inputs') == self.inputs
+
+    def save(self):
+        if os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as checkpoints_file:
+            json.dump({'stages': self.stages, 'finished': self.finished}, checkpoints_file, indent=2,
+                      sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def report(self):
+        return {'path': self.path, 'inputs': self.inputs, 'skipped': self.skipped, 'executed': self.executed,
+                'finished': self.is_finished()}
+
+
+class SetupCheckpointsEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
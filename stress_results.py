@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Incremental parser of cassandra-stress output.
+
+Lines are fed as they're produced, the per-interval rows become a typed
+time series (bounded, oldest intervals are dropped) and the 'Results:'
+block becomes the same summary dict ScyllaDocker.get_stress_results()
+always returned.
+"""
+
+import math
+import logging
+import collections
+
+from avocado import Test
+
+log = logging.getLogger('stress_results')
+
+StressInterval = collections.namedtuple('StressInterval', ['op_type', 'time', 'total_ops', 'op_rate',
+                                                           'latency_mean', 'latency_95', 'latency_99',
+                                                           'latency_max', 'errors'])
+
+# interval header column -> StressInterval field
+_COLUMNS = {'total ops': 'total_ops', 'op/s': 'op_rate', 'mean': 'latency_mean', '.95': 'latency_95',
+            '.99': 'latency_99', 'max': 'latency_max', 'time': 'time', 'errors': 'errors'}
+
+
+class StressStalledError(Exception):
+    pass
+
+
+class StressStreamParser(object):
+    """
+    Consume cassandra-stress output line by line.
+
+    :param max_intervals: how many intervals are kept in `intervals`, the
+                          running aggregates cover the whole run regardless
+    :param on_interval: optional callback, called with every new StressInterval
+    """
+
+    def __init__(self, max_intervals=3600, on_interval=None):
+        self.intervals = collections.deque(maxlen=max_intervals)
+        self.summary = dict()
+        self.on_interval = on_interval
+        self.interval_cnt = 0
+        self.errors = 0
+        self.max_latency_99 = 0.0
+        self._columns = None
+        self._in_results = False
+        self._done = False
+        self._partial = ''
+        self._rate_sum = 0.0
+        self._rate_sq_sum = 0.0
+        self._stalled_cnt = 0
+
+    @property
+    def done(self):
+        return self._done
+
+    def feed(self, data):
+        """
+        Feed a chunk of raw output, which may end in the middle of a line.
+        """
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.feed_line(line)
+        return self
+
+    def close(self):
+        if self._partial:
+            self.feed_line(self._partial)
+            self._partial = ''
+        return self
+
+    def feed_line(self, line):
+        line = line.rstrip('\r\n')
+        if self._done:
+            return
+        if line.startswith('Results:'):
+            self._in_results = True
+        elif line.startswith('END'):
+            self._in_results = False
+            self._done = True
+        elif self._in_results:
+            if line.strip():
+                self._parse_summary_line(line)
+        elif line.startswith('type'):
+            # 'type       total ops,    op/s, ...', the first two columns share a field
+            columns = [col.strip() for col in line.split(',')]
+            self._columns = columns[0].split(None, 1) + columns[1:]
+        elif self._columns and ',' in line:
+            self._parse_interval_line(line)
+
+    def _parse_summary_line(self, line):
+        try:
+            res = line.split(':')
+            key = res[0].strip()
+            val = res[1].split()[0].strip().replace(',', '') if key != 'Total operation time' else\
+                ':'.join([res[1], res[2], res[3]]).strip()
+            self.summary[key] = float(val) if val != 'NaN' and key != 'Total operation time' else val
+        except Exception as ex:
+            log.error('Failed parsing stress results: %s, error: %s', line, ex)
+
+    def _parse_interval_line(self, line):
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) != len(self._columns):
+            return
+        values = {'op_type': fields[0]}
+        for col, field in zip(self._columns[1:], fields[1:]):
+            name = _COLUMNS.get(col)
+            if name is None:
+                continue
+            try:
+                values[name] = float(field)
+            except ValueError:
+                values[name] = float('nan')
+        for name in StressInterval._fields:
+            values.setdefault(name, float('nan'))
+        interval = StressInterval(**values)
+        self.intervals.append(interval)
+        if interval.op_type == 'total':
+            self._account(interval)
+        if self.on_interval is not None:
+            self.on_interval(interval)
+
+    def _account(self, interval):
+        self.interval_cnt += 1
+        self._stalled_cnt = self._stalled_cnt + 1 if interval.op_rate == 0 else 0
+        if not math.isnan(interval.op_rate):
+            self._rate_sum += interval.op_rate
+            self._rate_sq_sum += interval.op_rate ** 2
+        if not math.isnan(interval.errors):
+            self.errors = max(self.errors, interval.errors)
+        if not math.isnan(interval.latency_99):
+            self.max_latency_99 = max(self.max_latency_99, interval.latency_99)
+
+    def series(self, op_type='total'):
+        return [interval for interval in self.intervals if interval.op_type == op_type]
+
+    def mean_op_rate(self):
+        return self._rate_sum / self.interval_cnt if self.interval_cnt else 0.0
+
+    def op_rate_cv(self):
+        """
+        Coefficient of variation of the per-interval op/s of the whole run,
+        0 means perfectly steady throughput.
+        """
+        mean = self.mean_op_rate()
+        if not mean:
+            return 0.0
+        variance = max(0.0, self._rate_sq_sum / self.interval_cnt - mean ** 2)
+        return math.sqrt(variance) / mean
+
+    def stalled(self, intervals):
+        """
+        True when the last `intervals` total rows made no progress.
+        """
+        return self._stalled_cnt >= intervals
+
+    def to_dict(self):
+        return {'summary': self.summary,
+                'intervals': [interval._asdict() for interval in self.series()],
+                'interval_cnt': self.interval_cnt,
+                'mean_op_rate': self.mean_op_rate(),
+                'op_rate_cv': self.op_rate_cv(),
+                'max_latency_99': self.max_latency_99}
+
+
+def parse_stress_output(stress_out):
+    return StressStreamParser().feed(stress_out).close()
+
+
+_SUMMED = ('Op rate', 'Partition rate', 'Row rate', 'Total partitions', 'Total errors', 'Total GC count')
+_QUANTILES = (('Latency median', 0.5), ('Latency 95th percentile', 0.95),
+              ('Latency 99th percentile', 0.99), ('Latency 99.9th percentile', 0.999))
+
+
+def _seconds(op_time):
+    hours, minutes, seconds = [int(part) for part in op_time.split(':')]
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _latency_cdf(summary):
+    """
+    Piecewise linear CDF through the percentiles a loader reported.
+    """
+    points = [(0.0, 0.0)]
+    for key, quantile in _QUANTILES:
+        points.append((summary[key], quantile))
+    points.append((summary['Latency max'], 1.0))
+
+    def cdf(latency):
+        prev_lat, prev_q = points[0]
+        for lat, q in points[1:]:
+            if latency < lat:
+                return prev_q + (q - prev_q) * (latency - prev_lat) / (lat - prev_lat)
+            prev_lat, prev_q = lat, q
+        return 1.0
+    return cdf
+
+
+def _mixture_quantile(cdfs, weights, quantile, upper):
+    low, high = 0.0, upper
+    for _ in range(60):
+        mid = (low + high) / 2
+        if sum(w * cdf(mid) for cdf, w in zip(cdfs, weights)) < quantile:
+            low = mid
+        else:
+            high = mid
+    return round(high, 3)
+
+
+def merge_stress_results(results):
+    """
+    Merge summary dicts of loaders that ran at the same time into one.
+
+    Rates and totals are summed. Latency percentiles are quantiles of the
+    op count weighted mixture of the loaders' latency distributions, each
+    interpolated from the percentiles it reported, max is the overall max.
+    """
+    results = [res for res in results if res]
+    if not results:
+        return dict()
+    merged = dict()
+    for key in _SUMMED:
+        if all(key in res for res in results):
+            merged[key] = sum(res[key] for res in results)
+    op_times = [res['Total operation time'] for res in results if 'Total operation time' in res]
+    if op_times:
+        merged['Total operation time'] = max(op_times, key=_seconds)
+    ops = [res.get('Op rate', 0) * max(1, _seconds(res.get('Total operation time', '0:0:1'))) for res in results]
+    weights = [op / sum(ops) if sum(ops) else 1.0 / len(results) for op in ops]
+    if all('Latency mean' in res for res in results):
+        merged['Latency mean'] = round(sum(w * res['Latency mean'] for w, res in zip(weights, results)), 3)
+    if all('Latency max' in res for res in results):
+        merged['Latency max'] = max(res['Latency max'] for res in results)
+        try:
+            cdfs = [_latency_cdf(res) for res in results]
+        except KeyError:
+            cdfs = None
+        if cdfs:
+            for key, quantile in _QUANTILES:
+                merged[key] = _mixture_quantile(cdfs, weights, quantile, merged['Latency max'])
+    merged['Loaders'] = len(results)
+    return merged
+
+
+class StressResultsEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (c) 2019 ScyllaDB
+
+"""
+Absolute limits on the results of the stress runs.
+
+Thresholds are rules like 'mixed centos-7: op_rate >= 500': the stress
+run, an optional scope (a distro name, <name>-<version> or an instance
+type), a metric of perf_history.METRICS, <= or >= and a value (latencies
+in ms). For every run and metric the most specific matching scope wins,
+the scopes being given from the least to the most specific one.
+"""
+
+import re
+import collections
+
+from avocado import Test
+
+from perf_history import METRICS
+
+_RULE = re.compile(r'^\s*(?P<run>[\w.-]+)(?:\s+(?P<scope>[\w.-]+))?\s*:\s*'
+                   r'(?P<metric>\w+)\s*(?P<op><=|>=)\s*(?P<value>-?[\d.]+)\s*$')
+
+Threshold = collections.namedtuple('Threshold', ['run', 'scope', 'metric', 'op', 'value'])
+
+
+def parse_threshold(rule):
+    match = _RULE.match(rule)
+    if match is None:
+        raise ValueError("bad stress threshold '{}', expected '<run> [<scope>]: <metric> <=|>= <value>'".format(
+            rule))
+    if match.group('metric') not in METRICS:
+        raise ValueError("unknown metric in stress threshold '{}', one of: {}".format(
+            rule, ', '.join(sorted(METRICS))))
+    return Threshold(match.group('run'), match.group('scope'), match.group('metric'), match.group('op'),
+                     float(match.group('value')))
+
+
+class StressThresholds(object):
+
+    def __init__(self, thresholds):
+        self.thresholds = list(thresholds)
+
+    @classmethod
+    def from_rules(cls, rules):
+        return cls(parse_threshold(rule) for rule in rules or [])
+
+    def limits(self, run, scopes=()):
+        """
+        {metric: Threshold} applying to run for the given scopes.
+        """
+        rank = dict((scope, idx + 1) for idx, scope in enumerate(scopes) if scope)
+        selected = dict()
+        for threshold in self.thresholds:
+            if threshold.run != run or (threshold.scope is not None and threshold.scope not in rank):
+                continue
+            current = selected.get(threshold.metric)
+            if current is None or rank.get(threshold.scope, 0) >= rank.get(current.scope, 0):
+                selected[threshold.metric] = threshold
+        return selected
+
+    def check(self, run, summary, scopes=()):
+        """
+        Compare a stress summary with the limits of run.
+
+        :return: one dict per limit ('metric', 'expected', 'observed',
+                 'scope', 'ok'), observed None when the summary lacks it
+        """
+        results = []
+        for metric, threshold in sorted(self.limits(run, scopes).items()):
+            try:
+                observed = float(summary[METRICS[metric][0]])
+            except (KeyError, TypeError, ValueError):
+                observed = None
+            if observed is None:
+                ok = False
+            elif threshold.op == '>=':
+                ok = observed >= threshold.value
+            else:
+                ok = observed <= threshold.value
+            results.append({'metric': metric, 'expected': '{} {:g}'.format(threshold.op, threshold.value),
+                            'observed': observed, 'scope': threshold.scope or 'default', 'ok': ok})
+        return results
+
+
+def format_diff(run, results):
+    """
+    Expected versus observed values of a check(), failed limits marked
+    with '!', as text.
+    """
+    lines = ['{} thresholds:'.format(run),
+             '  {:<14} {:>12} {:>12}  {}'.format('metric', 'expected', 'observed', 'scope')]
+    for result in results:
+        observed = 'missing' if result['observed'] is None else '{:g}'.format(result['observed'])
+        lines.append('{} {:<14} {:>12} {:>12}  {}'.format(' ' if result['ok'] else '!', result['metric'],
+                                                          result['expected'], observed, result['scope']))
+    return '\n'.join(lines)
+
+
+class StressThresholdsEmptyTest(Test):
+    """
+    Placeholder so Avocado copies this module to the VM as well, see
+    check_version.EmptyTest.
+
+    :avocado: enable
+    """
+    def test_empty(self):
+        pass